@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "foodgram.settings")
+# See foodgram.async_views, ASYNC_VIEWS=false serves the sync views instead.
+os.environ.setdefault("ASYNC_VIEWS", "true")
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+from foodgram.async_views import ASGIHandler  # noqa: E402
+
+application = ASGIHandler()
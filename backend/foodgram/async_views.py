@@ -0,0 +1,137 @@
+"""Async views serving the API under ASGI.
+
+Django 3.2 has no async ORM, and an ASGI process runs all of its sync views
+one at a time in a single thread. An async view instead hands the sync
+view to a pool of ASYNC_VIEW_THREADS threads with sync_to_async(), so a
+process serves that many requests at once, each of them waiting on the
+database without holding the others back. With DB_POOL_MAX_SIZE the
+threads share the pooled connections, which go back to the pool after
+every request.
+
+A streaming response is read while it is sent, ASGIHandler pulls its parts
+one by one in a thread of its own, so slow clients of several streams
+don't wait on each other.
+"""
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers import asgi
+from django.db import close_old_connections, connections
+from django.urls import URLPattern
+
+from foodgram.middleware import count_queries
+
+# Starts its threads when they are needed, after gunicorn forked.
+_executor = ThreadPoolExecutor(
+    settings.ASYNC_VIEW_THREADS, thread_name_prefix="async-view"
+)
+
+
+def async_view(view):
+    """Return an async view running the sync ``view`` in a pool thread."""
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        return await sync_to_async(
+            _call, thread_sensitive=False, executor=_executor
+        )(view, request, *args, **kwargs)
+
+    return wrapper
+
+
+def async_patterns(patterns):
+    """Return ``patterns`` with their views wrapped in async_view()."""
+    return [
+        URLPattern(
+            pattern.pattern,
+            async_view(pattern.callback),
+            pattern.default_args,
+            pattern.name,
+        )
+        if isinstance(pattern, URLPattern)
+        else pattern
+        for pattern in patterns
+    ]
+
+
+def _call(view, request, *args, **kwargs):
+    # The thread serves other requests too, this one starts and ends with
+    # its connections checked like a request of a sync worker.
+    close_old_connections()
+    try:
+        with count_queries():
+            response = view(request, *args, **kwargs)
+            if callable(getattr(response, "render", None)):
+                response = response.render()
+    finally:
+        close_old_connections()
+
+    return response
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    """ASGI handler reading streaming responses outside of the event loop.
+
+    Django 3.2 iterates a streaming response in the event loop, where the
+    queries of its iterator can't run. Here every part is pulled with
+    sync_to_async() and sent before the next one is read. The parts of a
+    response are all pulled in one thread started for it, a server-side
+    cursor of the iterator stays on the connection of that thread, which
+    is closed with the response.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        headers = [
+            (
+                header.encode("ascii") if isinstance(header, str) else header,
+                value.encode("latin1") if isinstance(value, str) else value,
+            )
+            for header, value in response.items()
+        ]
+        headers.extend(
+            (b"Set-Cookie", c.output(header="").encode("ascii").strip())
+            for c in response.cookies.values()
+        )
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": headers,
+            }
+        )
+
+        parts = iter(response)
+        executor = ThreadPoolExecutor(1, thread_name_prefix="async-stream")
+        pull = sync_to_async(next, thread_sensitive=False, executor=executor)
+        try:
+            while True:
+                part = await pull(parts, None)
+                if part is None:
+                    break
+                for chunk, _ in self.chunk_bytes(part):
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": chunk,
+                            "more_body": True,
+                        }
+                    )
+            await send({"type": "http.response.body"})
+        finally:
+            await sync_to_async(
+                _close, thread_sensitive=False, executor=executor
+            )(response)
+            executor.shutdown(wait=False)
+
+
+def _close(response):
+    try:
+        response.close()
+    finally:
+        # The thread ends with the response.
+        connections.close_all()
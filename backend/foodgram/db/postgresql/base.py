@@ -0,0 +1,101 @@
+"""PostgreSQL backend with connection pooling and health checks.
+
+Besides the usual ones, a database using it reads these settings:
+
+- ``CONN_HEALTH_CHECKS``: a reused connection is checked with ``SELECT 1``
+  before the first query of a request and replaced if it's broken, as
+  Django 4.1 does.
+- ``POOL``: at most ``MAX_SIZE`` connections per process are shared by its
+  threads (0 disables pooling, see pool.py). A thread waits up to
+  ``TIMEOUT`` seconds for a free connection. Connections older than
+  ``MAX_LIFETIME`` or idle for ``MAX_IDLE`` seconds are closed. Pooled
+  connections go back to the pool after every request, ``CONN_MAX_AGE``
+  doesn't apply to them.
+- ``TRANSACTION_POOLING``: the database is reached through PgBouncer in
+  transaction pooling mode, where consecutive transactions may run on
+  different server connections. Server-side cursors must be disabled with
+  ``DISABLE_SERVER_SIDE_CURSORS`` and no session state may be set.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.postgresql import base
+
+from foodgram.db.postgresql import pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.health_check_done = False
+
+    @property
+    def pool(self):
+        return pool.get_pool(self.alias, self.settings_dict.get("POOL") or {})
+
+    def get_new_connection(self, conn_params):
+        connection = self.pool.getconn(
+            lambda: super(DatabaseWrapper, self).get_new_connection(
+                conn_params
+            ),
+            pool.is_usable if self._health_checks else None,
+        )
+        # Set for new connections only, a reused one needs it as well.
+        self.isolation_level = self.settings_dict["OPTIONS"].get(
+            "isolation_level", connection.isolation_level
+        )
+        self.health_check_done = True
+
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.putconn(self.connection)
+
+    def ensure_connection(self):
+        if (
+            self.connection is not None
+            and self._health_checks
+            and not self.health_check_done
+            and not self.in_atomic_block
+        ):
+            if not self.is_usable():
+                self.close()
+            self.health_check_done = True
+
+        super().ensure_connection()
+
+    def close_if_unusable_or_obsolete(self):
+        # Called when a request starts and when it finishes.
+        self.health_check_done = False
+        super().close_if_unusable_or_obsolete()
+
+        if (
+            self.connection is not None
+            and self.pool.max_size
+            and not self.in_atomic_block
+        ):
+            self.close()
+
+    def ensure_timezone(self):
+        if not self.settings_dict.get("TRANSACTION_POOLING"):
+            return super().ensure_timezone()
+
+        # SET TIME ZONE would stay on a server connection that PgBouncer
+        # hands to other clients.
+        timezone_name = self.timezone_name
+        if (
+            self.connection is not None
+            and timezone_name
+            and self.connection.get_parameter_status("TimeZone")
+            != timezone_name
+        ):
+            raise ImproperlyConfigured(
+                f"The database time zone must be {timezone_name} with "
+                f"TRANSACTION_POOLING, set it with ALTER DATABASE ... SET "
+                f"timezone TO '{timezone_name}'."
+            )
+        return False
+
+    @property
+    def _health_checks(self):
+        return self.settings_dict.get("CONN_HEALTH_CHECKS", False)
@@ -0,0 +1,225 @@
+"""Bounded pool of PostgreSQL connections shared by the threads of a process.
+
+Django gives every thread its own connection and closes it at the end of a
+request. Through the pool, closing returns the connection instead, and the
+next request of any thread takes it again without connecting and
+authenticating anew. At most ``max_size`` connections are open in a
+process: a thread asking for one while all of them are in use waits up to
+``timeout`` seconds for one to be returned.
+
+A pool with ``max_size`` 0 keeps no connections and only counts them, so
+the metrics are the same with and without pooling.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pid = os.getpid()
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(
+        self, max_size=0, timeout=10, max_lifetime=3600, max_idle=600
+    ):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+
+        self._condition = threading.Condition()
+        # (connection, opened at, returned at), the last returned on the right.
+        self._idle = deque()
+        # Checked out connection: when it was opened.
+        self._in_use = {}
+        self._size = 0
+        self._counts = dict.fromkeys(
+            ("checkouts", "waits", "timeouts", "opened", "closed"), 0
+        )
+        self._wait_time = 0.0
+
+    def getconn(self, connect, check=None):
+        """Return an idle connection, or a new one made by ``connect()``.
+
+        ``check(connection)`` tells whether an idle connection still works,
+        the ones that don't are closed.
+        """
+        with self._condition:
+            self._counts["checkouts"] += 1
+
+        while True:
+            connection, opened_at = self._reserve()
+            if connection is None:
+                try:
+                    connection = connect()
+                except Exception:
+                    self._discard(None)
+                    raise
+                opened_at = time.monotonic()
+                with self._condition:
+                    self._counts["opened"] += 1
+            elif check is not None and not check(connection):
+                self._discard(connection)
+                continue
+
+            with self._condition:
+                self._in_use[connection] = opened_at
+            return connection
+
+    def putconn(self, connection):
+        """Return ``connection``, it's kept if it's reusable."""
+        with self._condition:
+            opened_at = self._in_use.pop(connection, None)
+            if opened_at is None and any(
+                idle is connection for idle, _, _ in self._idle
+            ):
+                # Returned twice.
+                return
+
+        if opened_at is None:
+            # Not checked out of this pool, e.g. opened before a fork, so
+            # it holds none of its slots.
+            try:
+                connection.close()
+            except psycopg2.Error:
+                pass
+            return
+
+        if (
+            not connection.closed
+            and connection.info.transaction_status
+            != extensions.TRANSACTION_STATUS_IDLE
+        ):
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                pass
+
+        now = time.monotonic()
+        if (
+            self.max_size
+            and not connection.closed
+            and connection.info.transaction_status
+            == extensions.TRANSACTION_STATUS_IDLE
+            and now - opened_at < self.max_lifetime
+        ):
+            with self._condition:
+                self._idle.append((connection, opened_at, now))
+                self._condition.notify()
+            return
+
+        self._discard(connection)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                **self._counts,
+                "wait_ms": round(self._wait_time * 1000, 1),
+            }
+
+    def _reserve(self):
+        """Take an idle connection, or a slot for a new one (``None``)."""
+        started = time.monotonic()
+        waited = False
+        with self._condition:
+            try:
+                while True:
+                    now = time.monotonic()
+                    while self._idle:
+                        connection, opened_at, returned_at = self._idle.pop()
+                        if (
+                            now - opened_at < self.max_lifetime
+                            and now - returned_at < self.max_idle
+                        ):
+                            return connection, opened_at
+                        self._close(connection)
+
+                    if not self.max_size or self._size < self.max_size:
+                        self._size += 1
+                        return None, None
+
+                    remaining = started + self.timeout - now
+                    if remaining <= 0:
+                        self._counts["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection was returned to the "
+                            f"pool of {self.max_size} in {self.timeout} s."
+                        )
+                    if not waited:
+                        self._counts["waits"] += 1
+                        waited = True
+                    self._condition.wait(remaining)
+            finally:
+                if waited:
+                    self._wait_time += time.monotonic() - started
+
+    def _discard(self, connection):
+        """Close ``connection`` and free its slot."""
+        with self._condition:
+            if connection is None:
+                self._size -= 1
+            else:
+                self._close(connection)
+            self._condition.notify()
+
+    def _close(self, connection):
+        # Called with the condition held.
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        self._size -= 1
+        self._counts["closed"] += 1
+
+
+def get_pool(alias, options):
+    """Return the pool of the database ``alias`` in this process."""
+    global _pid
+
+    with _pools_lock:
+        # The connections of a forked parent can't be shared with it.
+        if os.getpid() != _pid:
+            _pools.clear()
+            _pid = os.getpid()
+        if alias not in _pools:
+            _pools[alias] = ConnectionPool(
+                max_size=options.get("MAX_SIZE", 0),
+                timeout=options.get("TIMEOUT", 10),
+                max_lifetime=options.get("MAX_LIFETIME", 3600),
+                max_idle=options.get("MAX_IDLE", 600),
+            )
+
+        return _pools[alias]
+
+
+def stats():
+    """Return the metrics of the pools of this process by database alias."""
+    with _pools_lock:
+        pools = dict(_pools)
+
+    return {alias: pool.stats() for alias, pool in pools.items()}
+
+
+def is_usable(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        if not connection.autocommit:
+            connection.rollback()
+    except psycopg2.Error:
+        return False
+
+    return True
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Stats of the request being served.
+_stats = ContextVar("query_stats", default=None)
+
+
+class QueryStats:
+    """Database execute wrapper collecting the queries of one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            # The SQL still has placeholders instead of the parameters, so
+            # it identifies the shape of the query.
+            self.shapes[sql] += 1
+
+    @property
+    def duplicates(self):
+        return self.count - len(self.shapes)
+
+
+@contextmanager
+def count_queries():
+    """Count the queries of this thread in the stats of the current request.
+
+    The middleware counts the queries of the thread it runs in, views that
+    query from another thread run their work in this.
+    """
+    stats = _stats.get()
+    with ExitStack() as stack:
+        if stats is not None:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(stats))
+        yield
+
+
+class QueryInstrumentationMiddleware:
+    """Reports the SQL queries of every request in the response headers.
+
+    ``X-DB-Queries`` holds the number of queries and ``Server-Timing`` the
+    time spent in the database and in the whole request. Requests over
+    SQL_QUERY_BUDGET queries or REQUEST_TIME_BUDGET_MS milliseconds are
+    logged as warnings. Queries run while a streaming response is being
+    sent happen after the headers and are not counted.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Marks the instance as a coroutine function, as MiddlewareMixin
+            # does, so an ASGI request doesn't take a thread through it.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        stats = QueryStats()
+        start = time.perf_counter()
+        token = _stats.set(stats)
+        try:
+            with count_queries():
+                response = self.get_response(request)
+        finally:
+            _stats.reset(token)
+
+        return self._report(request, response, stats, start)
+
+    async def __acall__(self, request):
+        stats = QueryStats()
+        start = time.perf_counter()
+        token = _stats.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _stats.reset(token)
+
+        return self._report(request, response, stats, start)
+
+    def _report(self, request, response, stats, start):
+        duration_ms = (time.perf_counter() - start) * 1000
+        sql_ms = stats.duration * 1000
+        response["X-DB-Queries"] = str(stats.count)
+        response["Server-Timing"] = (
+            f'db;dur={sql_ms:.1f};desc="{stats.count} queries", '
+            f"total;dur={duration_ms:.1f}"
+        )
+
+        if (
+            stats.count > settings.SQL_QUERY_BUDGET
+            or duration_ms > settings.REQUEST_TIME_BUDGET_MS
+        ):
+            self._log_over_budget(request, response, stats, duration_ms)
+
+        return response
+
+    def _log_over_budget(self, request, response, stats, duration_ms):
+        repeated = [
+            {"sql": sql[:200], "count": count}
+            for sql, count in stats.shapes.most_common(3)
+            if count > 1
+        ]
+        logger.warning(
+            "%s %s ran %d queries in %.1f ms",
+            request.method,
+            request.path,
+            stats.count,
+            duration_ms,
+            extra={
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "queries": stats.count,
+                "duplicate_queries": stats.duplicates,
+                "repeated_queries": repeated,
+                "sql_ms": round(stats.duration * 1000, 1),
+                "duration_ms": round(duration_ms, 1),
+            },
+        )
@@ -48,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "foodgram.middleware.QueryInstrumentationMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -81,19 +82,60 @@ WSGI_APPLICATION = "foodgram.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
+# Behind PgBouncer in transaction pooling mode.
+DB_TRANSACTION_POOLING = (
+    os.getenv("DB_TRANSACTION_POOLING", default="false").lower() == "true"
+)
+
 DATABASES = {
     "default": {
-        "ENGINE": os.getenv(
-            "DB_ENGINE", default="django.db.backends.postgresql"
-        ),
+        # foodgram.db.postgresql adds the health checks and the pool below.
+        "ENGINE": os.getenv("DB_ENGINE", default="foodgram.db.postgresql"),
         "NAME": os.getenv("DB_NAME", default=None),
         "USER": os.getenv("POSTGRES_USER", default=None),
         "PASSWORD": os.getenv("POSTGRES_PASSWORD", default=None),
         "HOST": os.getenv("DB_HOST", default=None),
         "PORT": os.getenv("DB_PORT", default=None),
+        "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", default=60)),
+        "CONN_HEALTH_CHECKS": (
+            os.getenv("DB_CONN_HEALTH_CHECKS", default="true").lower()
+            == "true"
+        ),
+        "POOL": {
+            "MAX_SIZE": int(os.getenv("DB_POOL_MAX_SIZE", default=0)),
+            "TIMEOUT": float(os.getenv("DB_POOL_TIMEOUT", default=10)),
+            "MAX_LIFETIME": int(
+                os.getenv("DB_POOL_MAX_LIFETIME", default=3600)
+            ),
+            "MAX_IDLE": int(os.getenv("DB_POOL_MAX_IDLE", default=600)),
+        },
+        "TRANSACTION_POOLING": DB_TRANSACTION_POOLING,
+        "DISABLE_SERVER_SIDE_CURSORS": DB_TRANSACTION_POOLING,
     }
 }
 
+CACHE_BACKEND = os.getenv(
+    "CACHE_BACKEND",
+    default="django.core.cache.backends.filebased.FileBasedCache",
+)
+
+CACHES = {
+    "default": {
+        "BACKEND": CACHE_BACKEND,
+        "LOCATION": os.getenv(
+            "CACHE_LOCATION", default=os.path.join(BASE_DIR, "cache", "django")
+        ),
+    }
+}
+# Memcached evicts by itself and passes OPTIONS on to its client. The other
+# backends keep 300 entries by default, fewer than the fragments and version
+# stamps of a few list pages. FileBasedCache lists its directory on every
+# write, so a much bigger cache belongs in memcached.
+if "memcached" not in CACHE_BACKEND:
+    CACHES["default"]["OPTIONS"] = {
+        "MAX_ENTRIES": int(os.getenv("CACHE_MAX_ENTRIES", default=10000)),
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -161,5 +203,30 @@ DJOSER = {
 }
 
 SHOPPING_LIST_FILE_NAME = "shopping_list.txt"
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    "SHOPPING_LIST_PDF_FONT",
+    default="/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+)
+INGREDIENT_INDEX_PATH = os.getenv(
+    "INGREDIENT_INDEX_PATH",
+    default=os.path.join(BASE_DIR, "cache", "ingredient_index.bin"),
+)
+INGREDIENT_SEARCH_LIMIT = int(os.getenv("INGREDIENT_SEARCH_LIMIT", default=50))
+SQL_QUERY_BUDGET = int(os.getenv("SQL_QUERY_BUDGET", default=20))
+REQUEST_TIME_BUDGET_MS = int(os.getenv("REQUEST_TIME_BUDGET_MS", default=500))
+RECIPE_CACHE_TIMEOUT = int(os.getenv("RECIPE_CACHE_TIMEOUT", default=3600))
+REFERENCE_DATA_MAX_AGE = int(
+    os.getenv("REFERENCE_DATA_MAX_AGE", default=24 * 60 * 60)
+)
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", default=15 * 1024 * 1024))
+RENDITION_WORKERS = int(os.getenv("RENDITION_WORKERS", default=2))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", default=100))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", default=100))
+PAGINATION_COUNT_TIMEOUT = int(
+    os.getenv("PAGINATION_COUNT_TIMEOUT", default=60)
+)
+# The API is served by async views, set by foodgram.asgi.
+ASYNC_VIEWS = os.getenv("ASYNC_VIEWS", default="false").lower() == "true"
+ASYNC_VIEW_THREADS = int(os.getenv("ASYNC_VIEW_THREADS", default=16))
 MIN_AMOUNT = 1
 MIN_COOK_TIME = 1
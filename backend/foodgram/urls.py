@@ -5,13 +5,19 @@ from django.urls import include, path
 from django.views.generic import TemplateView
 from rest_framework import routers
 
+from foodgram.async_views import async_patterns
+from foodgram.views import health
 from recipes.views import FollowViewSet
 
 router = routers.DefaultRouter()
 router.register("users", FollowViewSet, basename="follow")
+routes = router.urls
+if settings.ASYNC_VIEWS:
+    routes = async_patterns(routes)
 
 urlpatterns = [
-    path("api/", include(router.urls)),
+    path("api/health/", health),
+    path("api/", include(routes)),
     path("admin/", admin.site.urls),
     path("docs/", TemplateView.as_view(template_name="redoc.html")),
     path("api/", include("recipes.urls")),
@@ -0,0 +1,34 @@
+from django.db import DatabaseError, connections
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+
+from foodgram.db.postgresql import pool
+
+
+@api_view(("GET",))
+@permission_classes((AllowAny,))
+def health(request):
+    """Reports whether the databases answer. Staff also get the pool
+    metrics of the process that served the request."""
+    databases = {}
+    for alias in connections:
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except DatabaseError:
+            databases[alias] = "unavailable"
+        else:
+            databases[alias] = "ok"
+
+    data = {"databases": databases}
+    try:
+        is_staff = request.user.is_staff
+    except DatabaseError:
+        # The token can't be checked without the database either.
+        is_staff = False
+    if is_staff:
+        data["pools"] = pool.stats()
+
+    healthy = all(state == "ok" for state in databases.values())
+    return Response(data, status=200 if healthy else 503)
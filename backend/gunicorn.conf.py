@@ -0,0 +1,43 @@
+"""Gunicorn settings, every one can be overridden by the environment.
+
+Requests spend most of their time waiting on PostgreSQL. Each worker
+process serves several of them at once with threads (the gthread worker),
+a thread waiting on the database doesn't hold the others back.
+
+Every thread has its own database connection. The workers share
+DB_MAX_CONNECTIONS (PostgreSQL's max_connections, 100 by default) less
+DB_RESERVED_CONNECTIONS left for migrations, management commands and
+psql. There are no more workers than connections, a worker runs at most
+its share of threads, and unless DB_POOL_MAX_SIZE is set its connections
+are pooled to that share too.
+
+With GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker the workers run
+the ASGI application instead, where the API is served by async views (see
+foodgram.async_views) and GUNICORN_THREADS doesn't apply, the pool keeps
+their threads within the share.
+"""
+import multiprocessing
+import os
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+if worker_class.startswith("uvicorn."):
+    wsgi_app = "foodgram.asgi:application"
+else:
+    wsgi_app = "foodgram.wsgi:application"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+connections = int(os.getenv("DB_MAX_CONNECTIONS", 100)) - int(
+    os.getenv("DB_RESERVED_CONNECTIONS", 10)
+)
+workers = min(
+    int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1)),
+    max(connections, 1),
+)
+connections_per_worker = max(connections // workers, 1)
+threads = min(int(os.getenv("GUNICORN_THREADS", 8)), connections_per_worker)
+# Read by foodgram.settings in the workers forked from this process.
+os.environ.setdefault("DB_POOL_MAX_SIZE", str(connections_per_worker))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+# Restarting the workers now and then returns the memory they piled up.
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 1000))
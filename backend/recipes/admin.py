@@ -1,32 +1,100 @@
+from django import forms
 from django.contrib import admin
+from django.contrib.admin.widgets import AutocompleteSelect
 from django.utils.html import format_html
 
 from recipes.models import (Follow, Ingredient, IngredientInRecipe, Recipe,
                             RecipeInCart, RecipeInFavorite, Tag)
+from recipes.pagination import EstimatedCountPaginator
+from recipes.search import search
+
+
+class EstimatedCountMixin:
+    """Change lists of big tables that don't count all rows per page."""
+
+    paginator = EstimatedCountPaginator
+    # The "N total" link runs a second COUNT(*) over the whole table.
+    show_full_result_count = False
+
+
+class JoinedAutocompleteSelect(AutocompleteSelect):
+    """Autocomplete that renders an already loaded choice without a query.
+
+    AutocompleteSelect looks its selected object up on every render, one
+    query per inline row.
+    """
+
+    selected = None
+
+    def optgroups(self, name, value, attr=None):
+        selected = self.selected
+        if selected is None or [str(v) for v in value] != [str(selected.pk)]:
+            return super().optgroups(name, value, attr)
+
+        label = self.choices.field.label_from_instance(selected)
+        option = self.create_option(name, selected.pk, label, True, 0)
+        return [(None, [option], 0)]
+
+
+class IngredientInRecipeForm(forms.ModelForm):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.ingredient_id is not None:
+            # Unwraps the RelatedFieldWidgetWrapper of the admin.
+            widget = self.fields["ingredient"].widget
+            getattr(widget, "widget", widget).selected = (
+                self.instance.ingredient
+            )
 
 
 class IngredientInRecipeInline(admin.TabularInline):
     model = IngredientInRecipe
+    form = IngredientInRecipeForm
     extra = 1
+    autocomplete_fields = ("ingredient",)
+
+    def get_queryset(self, request):
+        # Every row is titled with the ingredient's name.
+        return super().get_queryset(request).select_related("ingredient")
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == "ingredient":
+            kwargs["widget"] = JoinedAutocompleteSelect(
+                db_field, self.admin_site, using=kwargs.get("using")
+            )
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
 @admin.register(Recipe)
-class RecipeAdmin(admin.ModelAdmin):
+class RecipeAdmin(EstimatedCountMixin, admin.ModelAdmin):
     inlines = (IngredientInRecipeInline,)
+    autocomplete_fields = ("author",)
+    # Names, descriptions and ingredients are found by the full-text
+    # search, only the authors are matched with ILIKE.
     search_fields = (
-        "name",
         "author__first_name",
         "author__last_name",
         "author__username",
         "author__email",
-        "tags__name",
     )
     list_display = ("__str__", "get_favorites")
     list_filter = ("tags__name",)
 
-    @admin.display(description="Добавили в избранное")
+    def get_search_results(self, request, queryset, search_term):
+        by_author, use_distinct = super().get_search_results(
+            request, queryset, search_term
+        )
+        if not search_term.strip():
+            return by_author, use_distinct
+
+        found = search(queryset, search_term).values("pk")
+        return queryset.filter(pk__in=found) | by_author, use_distinct
+
+    @admin.display(
+        description="Добавили в избранное", ordering="favorites_count"
+    )
     def get_favorites(self, recipe):
-        return recipe.favorite_recipe.count()
+        return recipe.favorites_count
 
 
 @admin.register(Tag)
@@ -50,11 +118,15 @@ class IngredientAdmin(admin.ModelAdmin):
     list_display = ("name", "measurement_unit", "id")
     list_filter = ("measurement_unit",)
     search_fields = ("name",)
+    # Autocomplete results are paginated.
+    ordering = ("name",)
 
 
 @admin.register(IngredientInRecipe)
-class IngredientInRecipeAdmin(admin.ModelAdmin):
+class IngredientInRecipeAdmin(EstimatedCountMixin, admin.ModelAdmin):
     list_display = ("__str__", "recipe", "ingredient", "id")
+    list_select_related = ("recipe", "ingredient")
+    autocomplete_fields = ("recipe", "ingredient")
     list_filter = ("recipe__tags__name",)
     search_fields = (
         "recipe__name",
@@ -65,8 +137,10 @@ class IngredientInRecipeAdmin(admin.ModelAdmin):
 
 
 @admin.register(RecipeInCart)
-class RecipeInCartAdmin(admin.ModelAdmin):
+class RecipeInCartAdmin(EstimatedCountMixin, admin.ModelAdmin):
     list_display = ("__str__", "user", "recipe")
+    list_select_related = ("user", "recipe")
+    autocomplete_fields = ("user", "recipe")
     search_fields = (
         "recipe__name",
         "recipe__author__username",
@@ -75,8 +149,10 @@ class RecipeInCartAdmin(admin.ModelAdmin):
 
 
 @admin.register(RecipeInFavorite)
-class RecipeInFavoriteAdmin(admin.ModelAdmin):
+class RecipeInFavoriteAdmin(EstimatedCountMixin, admin.ModelAdmin):
     list_display = ("__str__", "user", "recipe")
+    list_select_related = ("user", "recipe")
+    autocomplete_fields = ("user", "recipe")
     search_fields = (
         "recipe__name",
         "recipe__author__username",
@@ -85,8 +161,10 @@ class RecipeInFavoriteAdmin(admin.ModelAdmin):
 
 
 @admin.register(Follow)
-class FollowAdmin(admin.ModelAdmin):
+class FollowAdmin(EstimatedCountMixin, admin.ModelAdmin):
     list_display = ("__str__", "user", "author")
+    list_select_related = ("user", "author")
+    autocomplete_fields = ("user", "author")
     search_fields = (
         "user__username",
         "user__email",
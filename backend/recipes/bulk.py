@@ -0,0 +1,321 @@
+"""Bulk export and import of recipes as NDJSON, one recipe per line.
+
+A line holds the recipe with its tags (by slug), its ingredients (by
+name and measurement unit) and its author, so a dump can be loaded into
+another catalog::
+
+    {"id": 1, "name": "...", "author": {"id": 1, "username": "...",
+     "email": "..."}, "tags": ["breakfast"], "ingredients": [{"name":
+     "...", "measurement_unit": "г", "amount": 100}], "image": "...",
+     "text": "...", "cooking_time": 10, "pub_date": "..."}
+
+Both directions work in chunks of a fixed number of recipes, so memory
+doesn't grow with the size of the catalog. The export reads the recipes
+through a server-side cursor and their tags and ingredients with two
+queries per chunk. The import writes every chunk with bulk_create() in
+its own transaction. Imported recipes get new ids and the current date.
+"""
+import json
+from collections import defaultdict, namedtuple
+from itertools import islice
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+
+from recipes import counters, search
+from recipes.cache import (RECIPES_VERSION_KEY, author_version_key,
+                           bump_versions_on_commit)
+from recipes.models import Ingredient, IngredientInRecipe, Recipe, Tag
+
+CHUNK_SIZE = 1000
+# Errors beyond this number are only counted.
+MAX_ERRORS = 100
+
+User = get_user_model()
+
+ImportResult = namedtuple("ImportResult", ("created", "failed", "errors"))
+
+
+def export_recipes(queryset=None, chunk_size=CHUNK_SIZE, build_uri=None):
+    """Yield every recipe of ``queryset`` as a dict, ordered by id.
+
+    ``build_uri`` turns the image URLs into absolute ones.
+    """
+    if queryset is None:
+        queryset = Recipe.objects.all()
+    build_uri = build_uri or (lambda url: url)
+
+    rows = (
+        queryset.order_by("id")
+        .values(
+            "id",
+            "name",
+            "author_id",
+            "author__username",
+            "author__email",
+            "image",
+            "text",
+            "cooking_time",
+            "pub_date",
+        )
+        .iterator(chunk_size=chunk_size)
+    )
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        ids = [row["id"] for row in chunk]
+        tags = defaultdict(list)
+        for recipe_id, slug in (
+            Recipe.tags.through.objects.filter(recipe_id__in=ids)
+            .order_by("tag__slug")
+            .values_list("recipe_id", "tag__slug")
+        ):
+            tags[recipe_id].append(slug)
+        ingredients = defaultdict(list)
+        for recipe_id, name, unit, amount in (
+            IngredientInRecipe.objects.filter(recipe_id__in=ids)
+            .order_by("id")
+            .values_list(
+                "recipe_id",
+                "ingredient__name",
+                "ingredient__measurement_unit",
+                "amount",
+            )
+        ):
+            ingredients[recipe_id].append(
+                {"name": name, "measurement_unit": unit, "amount": amount}
+            )
+
+        for row in chunk:
+            yield {
+                "id": row["id"],
+                "name": row["name"],
+                "author": {
+                    "id": row["author_id"],
+                    "username": row["author__username"],
+                    "email": row["author__email"],
+                },
+                "tags": tags[row["id"]],
+                "ingredients": ingredients[row["id"]],
+                "image": build_uri(default_storage.url(row["image"])),
+                "text": row["text"],
+                "cooking_time": row["cooking_time"],
+                "pub_date": row["pub_date"].isoformat(),
+            }
+
+
+def to_ndjson(records, chunk_size=CHUNK_SIZE):
+    """Yield ``records`` as NDJSON, ``chunk_size`` lines at a time."""
+    records = iter(records)
+    while True:
+        lines = [
+            json.dumps(record, ensure_ascii=False) + "\n"
+            for record in islice(records, chunk_size)
+        ]
+        if not lines:
+            break
+        yield "".join(lines)
+
+
+def import_recipes(lines, chunk_size=CHUNK_SIZE, default_author=None):
+    """Create a recipe from every NDJSON line of ``lines``.
+
+    Authors are found by email, recipes of unknown authors are given to
+    ``default_author`` or rejected without one. Invalid lines are skipped
+    and reported by their number, the rest of their chunk is imported.
+    """
+    importer = _Importer(
+        tags=dict(Tag.objects.values_list("slug", "id")),
+        ingredients={
+            (name, unit): pk
+            for pk, name, unit in Ingredient.objects.values_list(
+                "pk", "name", "measurement_unit"
+            )
+        },
+        default_author=default_author,
+    )
+
+    numbered = (
+        (number, line) for number, line in enumerate(lines, 1) if line.strip()
+    )
+    created, errors = 0, []
+    while True:
+        chunk = list(islice(numbered, chunk_size))
+        if not chunk:
+            break
+        created += importer.import_chunk(chunk, errors)
+
+    return ImportResult(created, len(errors), errors[:MAX_ERRORS])
+
+
+class _Importer:
+    def __init__(self, tags, ingredients, default_author):
+        self.tags = tags
+        self.ingredients = ingredients
+        self.default_author = default_author
+
+    def import_chunk(self, chunk, errors):
+        records = []
+        for number, line in chunk:
+            try:
+                records.append((number, self._parse(line)))
+            except ValueError as e:
+                errors.append({"line": number, "error": str(e)})
+
+        authors = self._authors({record["email"] for _, record in records})
+        default_author_id = getattr(self.default_author, "pk", None)
+        valid = []
+        for number, record in records:
+            author_id = authors.get(record["email"], default_author_id)
+            if author_id is None:
+                msg = f'Unknown author "{record["email"]}".'
+                errors.append({"line": number, "error": msg})
+                continue
+            valid.append((author_id, record))
+        if not valid:
+            return 0
+
+        with transaction.atomic():
+            recipes = self._create_recipes(valid)
+            self._create_relations(recipes, valid)
+            self._update_derived(recipes)
+
+        return len(recipes)
+
+    def _parse(self, line):
+        if isinstance(line, bytes):
+            try:
+                line = line.decode()
+            except UnicodeDecodeError:
+                raise ValueError("Not valid UTF-8.")
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Not valid JSON: {e}")
+        if not isinstance(data, dict):
+            raise ValueError("A recipe must be a JSON object.")
+
+        name = _get(data, "name", str)
+        if not 0 < len(name) <= 200:
+            raise ValueError('"name" must have 1 to 200 characters.')
+        cooking_time = _get(data, "cooking_time", int)
+        if not settings.MIN_COOK_TIME <= cooking_time <= 32767:
+            raise ValueError('"cooking_time" is out of range.')
+        image = _image_name(_get(data, "image", str))
+        author = data.get("author")
+        email = author.get("email") if isinstance(author, dict) else None
+
+        tag_ids = []
+        for slug in _get(data, "tags", list):
+            if not isinstance(slug, str) or slug not in self.tags:
+                raise ValueError(f'Unknown tag "{slug}".')
+            tag_ids.append(self.tags[slug])
+        if not tag_ids:
+            raise ValueError("A recipe needs at least one tag.")
+
+        amounts = {}
+        for item in _get(data, "ingredients", list):
+            if not isinstance(item, dict):
+                raise ValueError("An ingredient must be a JSON object.")
+            key = (item.get("name"), item.get("measurement_unit"))
+            if not all(isinstance(part, str) for part in key) or (
+                key not in self.ingredients
+            ):
+                raise ValueError(f'Unknown ingredient "{key[0]}, {key[1]}".')
+            amount = _get(item, "amount", int)
+            if not settings.MIN_AMOUNT <= amount <= 32767:
+                raise ValueError('"amount" is out of range.')
+            if self.ingredients[key] in amounts:
+                raise ValueError(f'Ingredient "{key[0]}" is repeated.')
+            amounts[self.ingredients[key]] = amount
+
+        return {
+            "name": name,
+            "text": _get(data, "text", str),
+            "cooking_time": cooking_time,
+            "image": image,
+            "email": email,
+            "tag_ids": set(tag_ids),
+            "amounts": amounts,
+        }
+
+    @staticmethod
+    def _authors(emails):
+        return dict(
+            User.objects.filter(email__in=emails - {None}).values_list(
+                "email", "pk"
+            )
+        )
+
+    def _create_recipes(self, valid):
+        recipes = [
+            Recipe(
+                author_id=author_id,
+                name=record["name"],
+                text=record["text"],
+                cooking_time=record["cooking_time"],
+                image=record["image"],
+            )
+            for author_id, record in valid
+        ]
+
+        features = connections[Recipe.objects.db].features
+        if features.can_return_rows_from_bulk_insert:
+            return Recipe.objects.bulk_create(recipes)
+
+        # Without RETURNING (SQLite) the new ids are only known when the
+        # rows are saved one by one. That also sends the signals, the
+        # derived data is refreshed idempotently below either way.
+        for recipe in recipes:
+            recipe.save(force_insert=True)
+        return recipes
+
+    def _create_relations(self, recipes, valid):
+        Recipe.tags.through.objects.bulk_create(
+            Recipe.tags.through(recipe_id=recipe.pk, tag_id=tag_id)
+            for recipe, (_, record) in zip(recipes, valid)
+            for tag_id in record["tag_ids"]
+        )
+        IngredientInRecipe.objects.bulk_create(
+            IngredientInRecipe(
+                recipe_id=recipe.pk,
+                ingredient_id=ingredient_id,
+                amount=amount,
+            )
+            for recipe, (_, record) in zip(recipes, valid)
+            for ingredient_id, amount in record["amounts"].items()
+        )
+
+    def _update_derived(self, recipes):
+        # bulk_create() sends no signals, the data the receivers keep in
+        # sync is refreshed for the whole chunk at once.
+        search.update_search_vectors([recipe.pk for recipe in recipes])
+        author_ids = {recipe.author_id for recipe in recipes}
+        counters.recount(counters.AUTHOR_RECIPES, author_ids)
+        bump_versions_on_commit(
+            RECIPES_VERSION_KEY, *map(author_version_key, author_ids)
+        )
+
+
+def _get(data, key, expected_type):
+    value = data.get(key)
+    # bool is an int, but not a valid number here.
+    if not isinstance(value, expected_type) or isinstance(value, bool):
+        raise ValueError(f'"{key}" must be of type {expected_type.__name__}.')
+    return value
+
+
+def _image_name(url):
+    """Return the storage name of an exported image URL or name."""
+    path = urlparse(url).path
+    if path.startswith(settings.MEDIA_URL):
+        path = path.replace(settings.MEDIA_URL, "", 1)
+    path = path.lstrip("/")
+    if not path or ".." in path.split("/"):
+        raise ValueError('"image" must be a path inside the media folder.')
+    return path
@@ -0,0 +1,99 @@
+"""Cache of the user-independent part of serialized recipes.
+
+A fragment is keyed by the recipe id and three version stamps: the recipe's
+own, its author's and a global one for the reference data (tags and
+ingredients). Writes bump the matching stamp instead of deleting fragments,
+so a stale fragment can never be read again and simply expires.
+
+The same stamps validate conditional GETs. Two more stamps exist for
+that: one bumped by any recipe change, for the lists, and one per user
+bumped by changes of their favorites, cart and subscriptions.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+GLOBAL_VERSION_KEY = "recipes:version"
+RECIPES_VERSION_KEY = "recipes:recipes:version"
+
+
+def recipe_version_key(recipe_id):
+    return f"recipes:recipe:{recipe_id}:version"
+
+
+def author_version_key(author_id):
+    return f"recipes:author:{author_id}:version"
+
+
+def user_version_key(user_id):
+    return f"recipes:user:{user_id}:version"
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The stamp is missing or was evicted, start from a fresh one so
+        # fragments cached under the old stamp don't match it by accident.
+        cache.set(key, time.time_ns(), None)
+
+
+def bump_versions_on_commit(*keys):
+    def bump():
+        for key in keys:
+            bump_version(key)
+
+    transaction.on_commit(bump)
+
+
+def get_versions(keys):
+    versions = cache.get_many(keys)
+    for key in set(keys) - versions.keys():
+        versions[key] = _init_version(key)
+
+    return versions
+
+
+def get_fragments(recipes):
+    """Return cache keys and cached fragments of ``recipes``.
+
+    Both are dicts keyed by recipe id, fragments that are not cached are
+    missing from the second one.
+    """
+    version_keys = {GLOBAL_VERSION_KEY}
+    for recipe in recipes:
+        version_keys.add(recipe_version_key(recipe.pk))
+        version_keys.add(author_version_key(recipe.author_id))
+
+    versions = get_versions(version_keys)
+    keys = {
+        recipe.pk: (
+            f"recipes:fragment:{recipe.pk}:"
+            f"{versions[GLOBAL_VERSION_KEY]}:"
+            f"{versions[recipe_version_key(recipe.pk)]}:"
+            f"{versions[author_version_key(recipe.author_id)]}"
+        )
+        for recipe in recipes
+    }
+    cached = cache.get_many(keys.values())
+    fragments = {
+        recipe_id: cached[key]
+        for recipe_id, key in keys.items()
+        if key in cached
+    }
+
+    return keys, fragments
+
+
+def set_fragments(fragments):
+    cache.set_many(fragments, settings.RECIPE_CACHE_TIMEOUT)
+
+
+def _init_version(key):
+    version = time.time_ns()
+    if cache.add(key, version, None):
+        return version
+
+    return cache.get(key, version)
@@ -0,0 +1,294 @@
+"""Shopping cart totals: how much of every ingredient a user's cart needs.
+
+The shopping list and the cart summary read the stored ``CartTotal``
+rows, nothing is aggregated when they are requested. Amounts in
+compatible units are added up in a canonical one (кг in г, л in мл),
+other units are kept as they are.
+
+The receivers in models.py add the ingredients of a recipe put in or taken
+out of a cart, and the changed rows of the ingredients of carted recipes,
+to the totals in the same transaction as the change, as deltas with F()
+expressions. A change takes a fixed number of queries however many
+ingredients and carts it touches. Writes that send no signals make the
+totals drift, rebuild_all() recomputes them from the carts.
+"""
+from collections import defaultdict
+from functools import reduce
+from itertools import islice
+from operator import or_
+
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models import BigIntegerField, Case, F, Q, Sum, Value, When
+
+from recipes import models
+
+BATCH_SIZE = 500
+
+# Unit as written in lower case: canonical unit, its amount in that unit.
+UNITS = {
+    "г": ("г", 1),
+    "гр": ("г", 1),
+    "g": ("г", 1),
+    "кг": ("г", 1000),
+    "kg": ("г", 1000),
+    "мл": ("мл", 1),
+    "ml": ("мл", 1),
+    "л": ("мл", 1000),
+    "l": ("мл", 1000),
+    "шт": ("шт.", 1),
+    "шт.": ("шт.", 1),
+}
+
+
+def normalize(measurement_unit, amount):
+    """Return ``amount`` of ``measurement_unit`` in its canonical unit."""
+    unit, factor = UNITS.get(
+        measurement_unit.strip().lower(), (measurement_unit, 1)
+    )
+    return unit, amount * factor
+
+
+def add(deltas, using="default"):
+    """Add ``deltas`` to the stored totals.
+
+    ``deltas`` maps (user id, name, canonical unit) to the change of the
+    amount. Increments are upserted, decrements subtract from the stored
+    rows and delete those they bring to zero, a total never goes below
+    zero.
+    """
+    totals = models.CartTotal.objects.using(using)
+
+    # The same order in every transaction, concurrent ones don't deadlock.
+    increments = sorted(
+        (key, amount) for key, amount in deltas.items() if amount > 0
+    )
+    for batch in _batches(increments):
+        _upsert(batch, using)
+
+    decrements = sorted(
+        (key, -amount) for key, amount in deltas.items() if amount < 0
+    )
+    for batch in _batches(decrements):
+        keys = [
+            Q(user_id=user_id, name=name, measurement_unit=unit)
+            for (user_id, name, unit), _ in batch
+        ]
+        amounts = [amount for _, amount in batch]
+        totals.filter(
+            reduce(
+                or_,
+                (
+                    key & Q(amount__lte=amount)
+                    for key, amount in zip(keys, amounts)
+                ),
+            )
+        ).delete()
+        subtracted = Case(
+            *(
+                When(key, then=Value(amount))
+                for key, amount in zip(keys, amounts)
+            ),
+            output_field=BigIntegerField(),
+        )
+        totals.filter(reduce(or_, keys)).update(
+            amount=F("amount") - subtracted
+        )
+
+
+def change_carts(carts, sign, using="default"):
+    """Add (``sign`` 1) or take away (-1) recipes of users' carts.
+
+    ``carts`` are (user id, recipe id) pairs.
+    """
+    users = defaultdict(list)
+    for user_id, recipe_id in carts:
+        users[recipe_id].append(user_id)
+    if not users:
+        return
+
+    deltas = defaultdict(int)
+    rows = (
+        models.IngredientInRecipe.objects.using(using)
+        .filter(recipe_id__in=users)
+        .values_list(
+            "recipe_id",
+            "ingredient__name",
+            "ingredient__measurement_unit",
+            "amount",
+        )
+    )
+    for recipe_id, name, measurement_unit, amount in rows.iterator():
+        unit, amount = normalize(measurement_unit, amount)
+        for user_id in users[recipe_id]:
+            deltas[user_id, name, unit] += sign * amount
+
+    add(deltas, using)
+
+
+def change_ingredients(changes, using="default"):
+    """Apply changed ingredient rows of recipes to the carts holding them.
+
+    ``changes`` are (recipe id, ingredient id, change of the amount)
+    triples, a removed row is a change by minus its amount.
+    """
+    changes = [change for change in changes if change[2]]
+    if not changes:
+        return
+
+    users = defaultdict(list)
+    carts = models.RecipeInCart.objects.using(using).filter(
+        recipe_id__in={recipe_id for recipe_id, _, _ in changes}
+    )
+    for recipe_id, user_id in carts.values_list("recipe_id", "user_id"):
+        users[recipe_id].append(user_id)
+    if not users:
+        return
+
+    ingredients = models.Ingredient.objects.using(using).in_bulk(
+        {ingredient_id for _, ingredient_id, _ in changes}
+    )
+    deltas = defaultdict(int)
+    for recipe_id, ingredient_id, amount in changes:
+        ingredient = ingredients.get(ingredient_id)
+        if ingredient is None:
+            continue
+        unit, amount = normalize(ingredient.measurement_unit, amount)
+        for user_id in users[recipe_id]:
+            deltas[user_id, ingredient.name, unit] += amount
+
+    add(deltas, using)
+
+
+def rename_ingredients(renames, using="default"):
+    """Move the amounts of renamed ingredients to their new totals.
+
+    ``renames`` maps ingredient ids to their previous and current
+    (name, measurement unit) pairs.
+    """
+    if not renames:
+        return
+
+    rows = (
+        models.IngredientInRecipe.objects.using(using)
+        .filter(ingredient_id__in=renames)
+        .values_list("recipe_id", "ingredient_id", "amount")
+    )
+    users = defaultdict(list)
+    carts = models.RecipeInCart.objects.using(using).filter(
+        recipe_id__in=rows.values("recipe_id")
+    )
+    for recipe_id, user_id in carts.values_list("recipe_id", "user_id"):
+        users[recipe_id].append(user_id)
+    if not users:
+        return
+
+    deltas = defaultdict(int)
+    for recipe_id, ingredient_id, amount in rows.filter(
+        recipe_id__in=users
+    ).iterator():
+        previous, current = renames[ingredient_id]
+        for (name, measurement_unit), sign in ((previous, -1), (current, 1)):
+            unit, normalized = normalize(measurement_unit, amount)
+            for user_id in users[recipe_id]:
+                deltas[user_id, name, unit] += sign * normalized
+
+    add(deltas, using)
+
+
+def rebuild(user_ids, using="default"):
+    """Recompute the totals of the users with ``user_ids``.
+
+    ``user_ids`` may be a queryset of ids. Returns the number of rows.
+    """
+    with transaction.atomic(using):
+        # Concurrent rebuilds of a user would both insert its rows.
+        users = list(
+            get_user_model().objects.using(using)
+            .select_for_update()
+            .filter(pk__in=user_ids)
+            .order_by("pk")
+            .values_list("pk", flat=True)
+        )
+        if not users:
+            return 0
+
+        totals = defaultdict(int)
+        rows = (
+            models.IngredientInRecipe.objects.using(using)
+            .filter(recipe__cart_recipe__user__in=users)
+            .values_list(
+                "recipe__cart_recipe__user",
+                "ingredient__name",
+                "ingredient__measurement_unit",
+            )
+            .annotate(amount=Sum("amount"))
+            .order_by()
+        )
+        for user_id, name, measurement_unit, amount in rows.iterator():
+            unit, amount = normalize(measurement_unit, amount)
+            totals[user_id, name, unit] += amount
+
+        stored = models.CartTotal.objects.using(using)
+        stored.filter(user_id__in=users).delete()
+        stored.bulk_create(
+            (
+                models.CartTotal(
+                    user_id=user_id,
+                    name=name,
+                    measurement_unit=unit,
+                    amount=amount,
+                )
+                for (user_id, name, unit), amount in totals.items()
+            ),
+            batch_size=1000,
+        )
+
+    return len(totals)
+
+
+def rebuild_all(batch_size=1000):
+    """Rebuild the totals of every user with a cart or stored totals."""
+    user_ids = sorted(
+        set(models.RecipeInCart.objects.values_list("user_id", flat=True))
+        | set(models.CartTotal.objects.values_list("user_id", flat=True))
+    )
+    ids = iter(user_ids)
+    rows = 0
+    while True:
+        batch = list(islice(ids, batch_size))
+        if not batch:
+            break
+        rows += rebuild(batch)
+
+    return len(user_ids), rows
+
+
+def _upsert(rows, using):
+    """Insert the (key, amount) ``rows``, adding to the existing totals."""
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    table = quote(models.CartTotal._meta.db_table)
+    columns = [
+        quote(models.CartTotal._meta.get_field(field).column)
+        for field in ("user", "name", "measurement_unit", "amount")
+    ]
+    amount = columns[-1]
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+            + ", ".join(["(%s, %s, %s, %s)"] * len(rows))
+            + f" ON CONFLICT ({', '.join(columns[:3])}) DO UPDATE"
+            f" SET {amount} = {table}.{amount} + EXCLUDED.{amount}",
+            [value for key, total in rows for value in (*key, total)],
+        )
+
+
+def _batches(items):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, BATCH_SIZE))
+        if not batch:
+            break
+        yield batch
@@ -0,0 +1,92 @@
+"""Deferred deletion of the media files of deleted and changed recipes.
+
+Files are queued when the transaction that dropped them commits, so a
+rolled back delete keeps its files, and a single background thread
+removes them in batches. An image that another recipe still uses (seeded
+recipes share theirs) is kept together with its renditions.
+
+Queued files are lost if the process exits first, the
+collect_orphaned_media command removes whatever is left behind.
+"""
+import logging
+import queue
+import threading
+
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+
+from recipes import models
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+_queue = queue.SimpleQueue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def delete_on_commit(image, renditions):
+    """Delete ``image`` and its ``renditions`` after the current commit."""
+    if not image:
+        return
+
+    names = [
+        name
+        for formats in renditions.values()
+        if isinstance(formats, dict)
+        for name in formats.values()
+    ]
+    transaction.on_commit(lambda: _enqueue(image, names))
+
+
+def delete_unused(groups):
+    """Delete the files of ``groups`` whose image no recipe uses.
+
+    ``groups`` is a list of (image, rendition names) pairs. Returns the
+    number of deleted images.
+    """
+    used = set(
+        models.Recipe.objects.filter(
+            image__in={image for image, _ in groups}
+        ).values_list("image", flat=True)
+    )
+
+    deleted = 0
+    for image, renditions in groups:
+        if image in used:
+            continue
+        for name in (image, *renditions):
+            default_storage.delete(name)
+        deleted += 1
+
+    return deleted
+
+
+def _enqueue(image, renditions):
+    global _worker
+
+    _queue.put((image, renditions))
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(
+                target=_work, name="media-cleanup", daemon=True
+            )
+            _worker.start()
+
+
+def _work():
+    while True:
+        groups = [_queue.get()]
+        while len(groups) < BATCH_SIZE:
+            try:
+                groups.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            delete_unused(groups)
+        except Exception:
+            logger.exception("Could not delete %d media files", len(groups))
+        finally:
+            connection.close()
@@ -0,0 +1,138 @@
+"""Denormalized counters of favorites, carts and recipes per author.
+
+The receivers in models.py change the counters with F() expressions in
+the same transaction as the rows they count, so concurrent requests
+don't overwrite each other's increments. Rows deleted together have their
+recipes recounted by one UPDATE. Writes that send no signals
+(bulk_create(), queryset.update(), raw SQL) make them drift, reconcile()
+recounts the rows whose counter is wrong.
+"""
+from collections import namedtuple
+from itertools import islice
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes import models
+
+# ``field`` of ``model`` counts the ``related_model`` rows pointing to it
+# with ``related_field``.
+Counter = namedtuple(
+    "Counter", ("model", "field", "related_model", "related_field")
+)
+
+RECIPE_FAVORITES = Counter(
+    "recipes.Recipe", "favorites_count", "recipes.RecipeInFavorite", "recipe"
+)
+RECIPE_CARTS = Counter(
+    "recipes.Recipe", "carts_count", "recipes.RecipeInCart", "recipe"
+)
+AUTHOR_RECIPES = Counter(
+    "recipes.Profile", "recipes_count", "recipes.Recipe", "author"
+)
+COUNTERS = (RECIPE_FAVORITES, RECIPE_CARTS, AUTHOR_RECIPES)
+
+
+def add(queryset, field, delta):
+    """Add ``delta`` to ``field`` of the rows of ``queryset``.
+
+    A counter never goes below zero. Returns the number of updated rows.
+    """
+    if delta < 0:
+        queryset = queryset.filter(**{f"{field}__gte": -delta})
+
+    return queryset.update(**{field: F(field) + delta})
+
+
+def add_recipes(author_id, delta):
+    """Change the recipe count of the author with ``author_id``."""
+    updated = add(
+        models.Profile.objects.filter(user_id=author_id),
+        "recipes_count",
+        delta,
+    )
+
+    # Users created without signals have no profile yet. It isn't created
+    # on a decrement, that may run while the user is being deleted.
+    if not updated and delta > 0:
+        models.Profile.objects.get_or_create(
+            user_id=author_id,
+            defaults={
+                "recipes_count": models.Recipe.objects.filter(
+                    author_id=author_id
+                ).count()
+            },
+        )
+
+
+def create_missing_profiles(batch_size=1000):
+    """Create the profiles of users that have none, return their number."""
+    user_ids = (
+        get_user_model()
+        .objects.filter(profile__isnull=True)
+        .values_list("pk", flat=True)
+    )
+    profiles = models.Profile.objects.bulk_create(
+        (
+            models.Profile(user_id=user_id)
+            for user_id in user_ids.iterator()
+        ),
+        batch_size=batch_size,
+        ignore_conflicts=True,
+    )
+
+    return len(profiles)
+
+
+def actual_count(counter):
+    """Expression counting the related rows of ``counter`` per row."""
+    related_model = apps.get_model(counter.related_model)
+    return Coalesce(
+        Subquery(
+            related_model.objects.filter(
+                **{counter.related_field: OuterRef("pk")}
+            )
+            .order_by()
+            .values(counter.related_field)
+            .annotate(count=Count("pk"))
+            .values("count")
+        ),
+        0,
+    )
+
+
+def find_drift(counter):
+    """Return the primary keys of the rows whose ``counter`` is wrong."""
+    model = apps.get_model(counter.model)
+    return (
+        model.objects.annotate(actual=actual_count(counter))
+        .exclude(**{counter.field: F("actual")})
+        .values_list("pk", flat=True)
+    )
+
+
+def reconcile(counter, batch_size=1000):
+    """Recount ``counter`` where it drifted, return the number of rows.
+
+    The rows are recounted by the UPDATE itself, so changes made since
+    they were found are not lost.
+    """
+    drifted = list(find_drift(counter))
+    ids = iter(drifted)
+    while True:
+        batch = list(islice(ids, batch_size))
+        if not batch:
+            break
+        recount(counter, batch)
+
+    return len(drifted)
+
+
+def recount(counter, pks):
+    """Recount ``counter`` of the rows with the primary keys ``pks``."""
+    model = apps.get_model(counter.model)
+    return model.objects.filter(pk__in=pks).update(
+        **{counter.field: actual_count(counter)}
+    )
@@ -1,6 +1,7 @@
 import django_filters as filters
 
 from recipes.models import Ingredient, Recipe
+from recipes.search import search
 
 
 class CharInFilter(filters.BaseInFilter, filters.CharFilter):
@@ -13,10 +14,20 @@ class RecipeFilter(filters.FilterSet):
     is_in_shopping_cart = filters.NumberFilter(
         method="get_is_in_shopping_cart"
     )
+    search = filters.CharFilter(method="get_search")
+
+    # Filters by the marks of the user, see MyPageNumberPagination.
+    personal_filters = ("is_favorited", "is_in_shopping_cart")
 
     class Meta:
         model = Recipe
-        fields = ("tags", "author", "is_favorited", "is_in_shopping_cart")
+        fields = (
+            "tags",
+            "author",
+            "is_favorited",
+            "is_in_shopping_cart",
+            "search",
+        )
 
     def get_is_favorited(self, queryset, name, value):
         user = self.request.user
@@ -30,6 +41,11 @@ class RecipeFilter(filters.FilterSet):
             return queryset.filter(cart_recipe__user=user)
         return queryset
 
+    def get_search(self, queryset, name, value):
+        if not value.strip():
+            return queryset
+        return search(queryset, value)
+
 
 class IngredientFilter(filters.FilterSet):
     name = filters.CharFilter(field_name="name", lookup_expr="istartswith")
@@ -0,0 +1,212 @@
+"""Prefix index of the ingredient catalog used for autocomplete.
+
+The catalog is written once to a binary snapshot sorted by the case-folded
+ingredient name. Every worker memory-maps the same file, so the gunicorn
+workers share one copy of it through the page cache, and a prefix lookup is
+a binary search that never touches the database. Changes of the catalog
+publish a new snapshot under the same path when they commit.
+
+Snapshot layout (little-endian)::
+
+    header   magic, number of records
+    offsets  one uint32 per record, pointing at the record
+    records  id, key/name/unit lengths, then the utf-8 key, name and unit
+"""
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+from recipes import models
+
+MAGIC = b"FGI1"
+HEADER = struct.Struct("<4sI")
+OFFSET = struct.Struct("<I")
+RECORD = struct.Struct("<IHHH")
+
+
+class IngredientIndex:
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._buffer = None
+        self._count = 0
+
+    @property
+    def path(self):
+        return self._path or settings.INGREDIENT_INDEX_PATH
+
+    def search(self, prefix="", limit=None):
+        """Return ingredients whose name starts with ``prefix``.
+
+        Matching is case-insensitive and the result is ordered by name.
+        """
+        buffer, count = self._snapshot()
+        key = prefix.casefold().encode()
+        position = self._lower_bound(buffer, count, key)
+
+        result = []
+        while position < count and (limit is None or len(result) < limit):
+            record_key, id_, name, unit = self._record(buffer, position)
+            if not record_key.startswith(key):
+                break
+            result.append(
+                {
+                    "id": id_,
+                    "name": name.decode(),
+                    "measurement_unit": unit.decode(),
+                }
+            )
+            position += 1
+
+        return result
+
+    def rebuild(self):
+        """Write a fresh snapshot of the catalog from the database.
+
+        The new snapshot replaces the old one in a single rename, a lookup
+        running meanwhile reads one or the other, never a missing file.
+        """
+        with self._file_lock():
+            self._write(self._read_catalog())
+
+    def rebuild_on_commit(self, using="default"):
+        """Rebuild the snapshot once the current transaction commits.
+
+        A transaction changing many ingredients rebuilds it once.
+        """
+        connection = transaction.get_connection(using)
+        if connection.in_atomic_block and any(
+            func == self.rebuild for _, func in connection.run_on_commit
+        ):
+            return
+
+        transaction.on_commit(self.rebuild, using)
+
+    def _rebuild_if_missing(self):
+        with self._file_lock():
+            # Another worker may have rebuilt it while we waited for the lock.
+            if not os.path.exists(self.path):
+                self._write(self._read_catalog())
+
+    def _snapshot(self):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            self._rebuild_if_missing()
+            f = open(self.path, "rb")
+
+        # The stamp and the mapping come from the same open file, however
+        # the path is replaced in the meantime.
+        with f:
+            stat = os.fstat(f.fileno())
+            stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            with self._lock:
+                if stamp != self._stamp:
+                    self._map(f)
+                    self._stamp = stamp
+                return self._buffer, self._count
+
+    def _map(self, f):
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not an ingredient index.")
+
+        # The previous mapping may still be read by another thread, it is
+        # released by the garbage collector once nothing references it.
+        self._buffer = buffer
+        self._count = count
+
+    def _read_catalog(self):
+        rows = models.Ingredient.objects.values_list(
+            "id", "name", "measurement_unit"
+        )
+
+        return sorted(
+            (name.casefold().encode(), id_, name.encode(), unit.encode())
+            for id_, name, unit in rows.iterator()
+        )
+
+    def _write(self, entries):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+
+        offsets = []
+        records = bytearray()
+        start = HEADER.size + OFFSET.size * len(entries)
+        for key, id_, name, unit in entries:
+            offsets.append(start + len(records))
+            records += RECORD.pack(id_, len(key), len(name), len(unit))
+            records += key + name + unit
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(HEADER.pack(MAGIC, len(entries)))
+                for offset in offsets:
+                    f.write(OFFSET.pack(offset))
+                f.write(records)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _file_lock(self):
+        return _FileLock(f"{self.path}.lock")
+
+    @staticmethod
+    def _record(buffer, position):
+        (offset,) = OFFSET.unpack_from(
+            buffer, HEADER.size + OFFSET.size * position
+        )
+        id_, key_len, name_len, unit_len = RECORD.unpack_from(buffer, offset)
+        key_start = offset + RECORD.size
+        key_end = key_start + key_len
+        name_end = key_end + name_len
+        unit_end = name_end + unit_len
+        key = buffer[key_start:key_end]
+        name = buffer[key_end:name_end]
+        unit = buffer[name_end:unit_end]
+
+        return key, id_, name, unit
+
+    @classmethod
+    def _lower_bound(cls, buffer, count, key):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if cls._record(buffer, middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+
+class _FileLock:
+    """Serializes the rebuilds across worker processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "a")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+ingredient_index = IngredientIndex()
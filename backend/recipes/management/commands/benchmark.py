@@ -0,0 +1,380 @@
+import json
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from recipes.models import Ingredient, Recipe, Tag
+from recipes.reference import reference_data
+
+User = get_user_model()
+
+# Measured on PostgreSQL with the default dataset sizes. Only its query
+# counts are compared by default, its wall times are those of the machine
+# it was saved on.
+BASELINE = Path(settings.BASE_DIR, "benchmark_baseline.json")
+
+Endpoint = namedtuple("Endpoint", ("name", "authenticated", "request"))
+
+ENDPOINTS = (
+    Endpoint(
+        "recipe list (anonymous)",
+        False,
+        lambda client, ctx: client.get("/api/recipes/", {"limit": 6}),
+    ),
+    Endpoint(
+        "recipe list",
+        True,
+        lambda client, ctx: client.get("/api/recipes/", {"limit": 6}),
+    ),
+    Endpoint(
+        "recipe list by tags",
+        True,
+        lambda client, ctx: client.get(
+            "/api/recipes/", {"limit": 6, "tags": ctx["tags"]}
+        ),
+    ),
+    Endpoint(
+        "recipe list of favorites",
+        True,
+        lambda client, ctx: client.get(
+            "/api/recipes/", {"limit": 6, "is_favorited": 1}
+        ),
+    ),
+    Endpoint(
+        "recipe list in cart",
+        True,
+        lambda client, ctx: client.get(
+            "/api/recipes/", {"limit": 6, "is_in_shopping_cart": 1}
+        ),
+    ),
+    Endpoint(
+        "recipe detail",
+        True,
+        lambda client, ctx: client.get(f"/api/recipes/{ctx['recipe']}/"),
+    ),
+    Endpoint(
+        "subscriptions",
+        True,
+        lambda client, ctx: client.get(
+            "/api/users/subscriptions/", {"recipes_limit": 3}
+        ),
+    ),
+    Endpoint(
+        "ingredient search",
+        True,
+        lambda client, ctx: client.get(
+            "/api/ingredients/", {"name": ctx["ingredient_prefix"]}
+        ),
+    ),
+    Endpoint(
+        "download shopping cart",
+        True,
+        lambda client, ctx: client.get("/api/recipes/download_shopping_cart/"),
+    ),
+    Endpoint(
+        "favorite toggle",
+        True,
+        lambda client, ctx: _toggle(
+            client, f"/api/recipes/{ctx['toggle_recipe']}/favorite/"
+        ),
+    ),
+    Endpoint(
+        "cart toggle",
+        True,
+        lambda client, ctx: _toggle(
+            client, f"/api/recipes/{ctx['toggle_recipe']}/shopping_cart/"
+        ),
+    ),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the hot API endpoints on a generated dataset and "
+        "compares the results with a baseline"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--recipes", type=int, default=10000)
+        parser.add_argument("--follows-per-user", type=int, default=20)
+        parser.add_argument("--favorites-per-user", type=int, default=20)
+        parser.add_argument("--carts-per-user", type=int, default=10)
+        parser.add_argument("--iterations", type=int, default=50)
+        parser.add_argument("--warmup", type=int, default=5)
+        parser.add_argument(
+            "--baseline",
+            type=Path,
+            help="JSON file with the results to compare against "
+            f"(default {BASELINE.name}, not used with --current-db).",
+        )
+        parser.add_argument(
+            "--save-baseline",
+            action="store_true",
+            help="Write the results to --baseline instead of comparing.",
+        )
+        parser.add_argument(
+            "--compare-latency",
+            action="store_true",
+            help="Also fail when the p95 wall time exceeds the baseline, "
+            "which must have been saved on the same machine.",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.25,
+            help="Allowed relative slowdown of the p95 wall time.",
+        )
+        parser.add_argument(
+            "--current-db",
+            action="store_true",
+            help="Run against the configured database as it is, "
+            "instead of a freshly seeded test database.",
+        )
+        parser.add_argument("--keepdb", action="store_true")
+
+    def handle(self, *args, **options):
+        baseline = options["baseline"]
+        if baseline is None and not options["current_db"]:
+            baseline = BASELINE
+        if options["save_baseline"] and baseline is None:
+            raise CommandError("--save-baseline requires --baseline.")
+
+        if options["current_db"]:
+            results = self._benchmark(options)
+        else:
+            with tempfile.TemporaryDirectory() as tmp_dir, _isolated(tmp_dir):
+                results = self._benchmark_test_db(options)
+
+        self._report(results)
+
+        if options["save_baseline"]:
+            baseline.write_text(json.dumps(results, indent=2) + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Saved {baseline}"))
+        elif baseline is not None:
+            self._compare(
+                results,
+                json.loads(baseline.read_text()),
+                options["tolerance"] if options["compare_latency"] else None,
+            )
+
+    def _benchmark_test_db(self, options):
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, keepdb=options["keepdb"]
+        )
+        try:
+            if not Recipe.objects.exists():
+                self._seed(options)
+            return self._benchmark(options)
+        finally:
+            connection.creation.destroy_test_db(
+                old_name, verbosity=0, keepdb=options["keepdb"]
+            )
+
+    def _seed(self, options):
+        call_command(
+            "seed",
+            users=options["users"],
+            recipes=options["recipes"],
+            follows_per_user=options["follows_per_user"],
+            favorites_per_user=options["favorites_per_user"],
+            carts_per_user=options["carts_per_user"],
+            stdout=self.stdout,
+        )
+
+    def _benchmark(self, options):
+        user = benchmark_user()
+        ctx = build_context(user, next(iter(free_recipes(user, 1)), None))
+        anonymous = APIClient()
+        authenticated = APIClient()
+        authenticated.force_authenticate(user)
+
+        results = {}
+        for endpoint in ENDPOINTS:
+            client = authenticated if endpoint.authenticated else anonymous
+            for _ in range(options["warmup"]):
+                self._call(endpoint, client, ctx)
+
+            wall_times = []
+            sql_times = []
+            query_counts = []
+            for _ in range(options["iterations"]):
+                wall_time, queries = self._call(endpoint, client, ctx)
+                wall_times.append(wall_time)
+                query_counts.append(len(queries))
+                sql_times.append(
+                    sum(float(query["time"]) for query in queries) * 1000
+                )
+
+            results[endpoint.name] = {
+                "p50_ms": percentile(wall_times, 50),
+                "p95_ms": percentile(wall_times, 95),
+                "p99_ms": percentile(wall_times, 99),
+                "queries": max(query_counts),
+                "sql_ms": round(statistics.median(sql_times), 3),
+            }
+
+        return results
+
+    def _call(self, endpoint, client, ctx):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = endpoint.request(client, ctx)
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+            wall_time = (time.perf_counter() - start) * 1000
+
+        if response.status_code >= 400:
+            raise CommandError(
+                f"{endpoint.name} returned {response.status_code}: "
+                f"{response.content[:200]!r}"
+            )
+
+        return wall_time, queries.captured_queries
+
+    def _report(self, results):
+        header = (
+            f"{'endpoint':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+            f"{'queries':>10}{'sql ms':>10}"
+        )
+        self.stdout.write(header)
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<28}{result['p50_ms']:>10}{result['p95_ms']:>10}"
+                f"{result['p99_ms']:>10}{result['queries']:>10}"
+                f"{result['sql_ms']:>10}"
+            )
+
+    def _compare(self, results, baseline, tolerance=None):
+        """Fail on more queries than ``baseline``, or on a slower p95.
+
+        Query counts don't depend on the machine and are always compared,
+        wall times only with a ``tolerance``.
+        """
+        regressions = []
+        for name, expected in baseline.items():
+            result = results.get(name)
+            if result is None:
+                continue
+            if result["queries"] > expected["queries"]:
+                regressions.append(
+                    f"{name}: {result['queries']} queries, "
+                    f"baseline {expected['queries']}"
+                )
+            if tolerance is not None and result["p95_ms"] > expected[
+                "p95_ms"
+            ] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: p95 {result['p95_ms']} ms, "
+                    f"baseline {expected['p95_ms']} ms"
+                )
+
+        if regressions:
+            raise CommandError(
+                "Performance regressions:\n" + "\n".join(regressions)
+            )
+
+        self.stdout.write(self.style.SUCCESS("No regressions"))
+
+
+@contextmanager
+def _isolated(tmp_dir):
+    """Keep the test database's caches and files apart from the real ones.
+
+    Fragments, cached counts, the ingredient index and the reference data
+    built from the test database must not be served for the real one,
+    and what is cached for the real one must not skew the results.
+    """
+    cache = {
+        **settings.CACHES["default"],
+        "KEY_PREFIX": f"benchmark-{uuid.uuid4().hex}",
+    }
+    if cache["BACKEND"].endswith(".FileBasedCache"):
+        cache["LOCATION"] = os.path.join(tmp_dir, "cache")
+
+    reference_data.reset()
+    try:
+        with override_settings(
+            CACHES={"default": cache},
+            INGREDIENT_INDEX_PATH=os.path.join(
+                tmp_dir, "ingredient_index.bin"
+            ),
+            MEDIA_ROOT=os.path.join(tmp_dir, "media"),
+        ):
+            yield
+    finally:
+        reference_data.reset()
+
+
+def benchmark_user():
+    """Return the user the requests are made as."""
+    user = (
+        User.objects.filter(
+            purchases__isnull=False,
+            follower__isnull=False,
+            recipes__isnull=False,
+        )
+        .order_by("id")
+        .first()
+    )
+    if user is None:
+        raise CommandError(
+            "The database has no user with recipes, a cart and subscriptions."
+        )
+
+    return user
+
+
+def free_recipes(user, count):
+    """Return ``count`` recipes of ``user`` for the toggles, unmarked yet.
+
+    Only the author of a recipe may mark it (IsAuthorOrReadOnly).
+    """
+    return list(
+        Recipe.objects.filter(author=user)
+        .exclude(favorite_recipe__user=user)
+        .exclude(cart_recipe__user=user)
+        .values_list("id", flat=True)[:count]
+    )
+
+
+def build_context(user, toggle_recipe):
+    """Return the values the ENDPOINTS requests are built from."""
+    return {
+        "recipe": Recipe.objects.values_list("id", flat=True).first(),
+        "toggle_recipe": toggle_recipe,
+        "tags": list(Tag.objects.values_list("slug", flat=True)[:2]),
+        "ingredient_prefix": Ingredient.objects.values_list(
+            "name", flat=True
+        ).first()[:2],
+    }
+
+
+def _toggle(client, url):
+    """Add and remove again, so every iteration starts from the same state."""
+    response = client.post(url)
+    if response.status_code >= 400:
+        return response
+
+    return client.delete(url)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+    return round(values[index], 3)
@@ -0,0 +1,119 @@
+import os
+import time
+from functools import reduce
+from itertools import islice
+from operator import or_
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from recipes import renditions
+from recipes.models import Recipe
+
+DIRECTORY = "recipes"
+
+
+class Command(BaseCommand):
+    help = "Deletes the files in MEDIA_ROOT/recipes/ that no recipe refers to"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only list the files that would be deleted.",
+        )
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=3600,
+            help="Keep files modified less than this many seconds ago, "
+            "they may belong to an upload that isn't committed yet.",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=100,
+            help="Delete at most this many files per second.",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        root = os.path.join(settings.MEDIA_ROOT, DIRECTORY)
+        cutoff = time.time() - options["min_age"]
+        files = (
+            os.path.relpath(entry.path, settings.MEDIA_ROOT).replace(
+                os.sep, "/"
+            )
+            for entry in _scan(root)
+            if entry.stat().st_mtime < cutoff
+        )
+
+        checked = deleted = 0
+        interval = 1 / options["rate"] if options["rate"] > 0 else 0
+        while True:
+            batch = list(islice(files, options["batch_size"]))
+            if not batch:
+                break
+            checked += len(batch)
+
+            for name in sorted(set(batch) - self._used(batch)):
+                if options["dry_run"]:
+                    self.stdout.write(name)
+                else:
+                    started = time.monotonic()
+                    default_storage.delete(name)
+                    time.sleep(max(0, interval - (time.monotonic() - started)))
+                deleted += 1
+
+        verb = "Would delete" if options["dry_run"] else "Deleted"
+        msg = f"{verb} {deleted} of {checked} files"
+        self.stdout.write(self.style.SUCCESS(msg))
+
+    def _used(self, names):
+        """Return the ``names`` that a recipe image or rendition uses."""
+        images = set(
+            Recipe.objects.filter(image__in=names).values_list(
+                "image", flat=True
+            )
+        )
+
+        # A rendition is kept while an image it could be made from exists,
+        # generate() would reuse it for that image.
+        stems = {}
+        for name in names:
+            if name.startswith(f"{renditions.DIRECTORY}/"):
+                stem = os.path.basename(name).rsplit("_", 1)[0]
+                stems.setdefault(stem, []).append(name)
+        used_renditions = set()
+        if stems:
+            sources = Recipe.objects.filter(
+                reduce(
+                    or_,
+                    (
+                        Q(image__startswith=f"{DIRECTORY}/{stem}.")
+                        for stem in stems
+                    ),
+                )
+            ).values_list("image", flat=True)
+            for source in sources.iterator():
+                stem = os.path.splitext(os.path.basename(source))[0]
+                used_renditions.update(stems.get(stem, ()))
+
+        return images | used_renditions
+
+
+def _scan(path):
+    """Yield the files under ``path`` without listing whole directories."""
+    try:
+        entries = os.scandir(path)
+    except FileNotFoundError:
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
@@ -0,0 +1,182 @@
+import re
+from collections import namedtuple
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import BooleanField, F, Value
+
+from recipes.models import CartTotal, Ingredient, Recipe, Tag
+from recipes.search import search
+
+User = get_user_model()
+
+HotPath = namedtuple("HotPath", ("name", "queryset"))
+
+HOT_PATHS = (
+    HotPath(
+        "recipe list",
+        lambda ctx: Recipe.objects.with_user_flags(ctx["user"])[:6],
+    ),
+    HotPath(
+        "recipe list by tags",
+        lambda ctx: Recipe.objects.with_user_flags(ctx["user"])
+        .filter(tags__slug__in=ctx["tags"])
+        .distinct()[:6],
+    ),
+    HotPath(
+        "recipe list of favorites",
+        lambda ctx: Recipe.objects.with_user_flags(ctx["user"]).filter(
+            favorite_recipe__user=ctx["user"]
+        )[:6],
+    ),
+    HotPath(
+        "recipe list in cart",
+        lambda ctx: Recipe.objects.with_user_flags(ctx["user"]).filter(
+            cart_recipe__user=ctx["user"]
+        )[:6],
+    ),
+    HotPath(
+        "recipes of an author",
+        lambda ctx: Recipe.objects.filter(author=ctx["author"])[:6],
+    ),
+    HotPath(
+        "subscriptions",
+        lambda ctx: User.objects.filter(following__user=ctx["user"])
+        .annotate(
+            recipes_count=F("profile__recipes_count"),
+            is_subscribed=Value(True, output_field=BooleanField()),
+        )
+        .order_by("following__id")[:10],
+    ),
+    HotPath(
+        "newest recipes of subscriptions",
+        lambda ctx: Recipe.objects.filter(
+            author__in=ctx["user"].follower.values("author")[:10]
+        )
+        .newest_per_author(3)
+        .order_by("-pub_date", "-id"),
+    ),
+    HotPath(
+        "recipe search",
+        lambda ctx: search(
+            Recipe.objects.with_user_flags(ctx["user"]), ctx["search_term"]
+        )[:6],
+    ),
+    HotPath(
+        "ingredient search",
+        lambda ctx: Ingredient.objects.filter(
+            name__istartswith=ctx["ingredient_prefix"]
+        ),
+    ),
+    HotPath(
+        "shopping cart",
+        lambda ctx: CartTotal.objects.filter(user=ctx["user"])
+        .order_by("name", "measurement_unit")
+        .values("name", "measurement_unit", "amount"),
+    ),
+)
+
+# Full table scans as PostgreSQL and SQLite report them.
+SEQ_SCAN_PATTERNS = {
+    "postgresql": re.compile(r"Seq Scan on (\w+)"),
+    "sqlite": re.compile(r"\bSCAN (?:TABLE )?(\w+)(?: AS \w+)?$"),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs EXPLAIN on the querysets of the hot endpoints and reports "
+        "sequential scans of big tables"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-rows",
+            type=int,
+            default=1000,
+            help="Ignore sequential scans of tables with fewer rows.",
+        )
+        parser.add_argument(
+            "--analyze",
+            action="store_true",
+            help="Run the queries and show the actual timings "
+            "(PostgreSQL only).",
+        )
+        parser.add_argument(
+            "--fail",
+            action="store_true",
+            help="Exit with an error when a sequential scan is found.",
+        )
+
+    def handle(self, *args, **options):
+        pattern = SEQ_SCAN_PATTERNS.get(connection.vendor)
+        if pattern is None:
+            raise CommandError(f"{connection.vendor} is not supported.")
+
+        ctx = self._context()
+        explain_options = {}
+        if options["analyze"] and connection.vendor == "postgresql":
+            explain_options["analyze"] = True
+
+        tables = {model._meta.db_table: model for model in apps.get_models()}
+        row_counts = {}
+        flagged = []
+        for path in HOT_PATHS:
+            plan = path.queryset(ctx).explain(**explain_options)
+            if options["verbosity"] > 1:
+                self.stdout.write(self.style.MIGRATE_HEADING(path.name))
+                self.stdout.write(plan + "\n")
+
+            scans = set()
+            for line in plan.splitlines():
+                match = pattern.search(line.strip())
+                if match is None or match[1] not in tables:
+                    continue
+                table = match[1]
+                if table not in row_counts:
+                    row_counts[table] = tables[table]._base_manager.count()
+                if row_counts[table] >= options["min_rows"]:
+                    scans.add(table)
+
+            if scans:
+                flagged.append(path.name)
+                self.stdout.write(
+                    self.style.WARNING(
+                        f"{path.name}: sequential scan of "
+                        f"{', '.join(sorted(scans))}"
+                    )
+                )
+            else:
+                self.stdout.write(f"{path.name}: OK")
+
+        if flagged and options["fail"]:
+            raise CommandError(
+                f"Sequential scans in {len(flagged)} of "
+                f"{len(HOT_PATHS)} querysets."
+            )
+
+    def _context(self):
+        user = (
+            User.objects.filter(
+                purchases__isnull=False, follower__isnull=False
+            )
+            .order_by("id")
+            .first()
+        )
+        ingredient = Ingredient.objects.order_by("id").first()
+        if user is None or ingredient is None:
+            raise CommandError(
+                "Seed the database first, for example with "
+                "manage.py seed --users 1000 --recipes 10000 "
+                "--follows-per-user 20 --carts-per-user 10"
+            )
+
+        return {
+            "user": user,
+            "author": Recipe.objects.values_list("author", flat=True)[0],
+            "tags": list(Tag.objects.values_list("slug", flat=True)[:2]),
+            "ingredient_prefix": ingredient.name[:2],
+            "search_term": ingredient.name,
+        }
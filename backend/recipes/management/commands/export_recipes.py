@@ -0,0 +1,32 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from recipes import bulk
+
+
+class Command(BaseCommand):
+    help = "Exports all recipes with their tags and ingredients as NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output",
+            type=Path,
+            help="File to write, the standard output by default.",
+        )
+        parser.add_argument("--chunk-size", type=int, default=bulk.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        records = bulk.export_recipes(chunk_size=options["chunk_size"])
+        lines = bulk.to_ndjson(records, options["chunk_size"])
+
+        if options["output"] is None:
+            for chunk in lines:
+                self.stdout.write(chunk, ending="")
+            return
+
+        with open(options["output"], "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        self.stderr.write(
+            self.style.SUCCESS(f"Exported to {options['output']}")
+        )
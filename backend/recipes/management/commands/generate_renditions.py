@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from recipes import renditions
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = "Generates the missing resized copies of the recipe images"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Regenerate the renditions of every image.",
+        )
+        parser.add_argument("--workers", type=int, default=4)
+
+    def handle(self, *args, **options):
+        recipes = (
+            Recipe.objects.exclude(image="")
+            .only("id", "image", "renditions")
+            .order_by("id")
+        )
+        sources = {
+            recipe.image.name
+            for recipe in recipes.iterator()
+            if options["force"] or not renditions.is_current(recipe)
+        }
+
+        # Every image is handled once, however many recipes share it.
+        with ThreadPoolExecutor(options["workers"]) as executor:
+            results = list(
+                executor.map(
+                    lambda source: self._generate(source, options["force"]),
+                    sorted(sources),
+                )
+            )
+
+        done = [updated for updated in results if updated is not None]
+        msg = (
+            f"Generated renditions of {len(done)} of {len(sources)} images "
+            f"for {sum(done)} recipes"
+        )
+        self.stdout.write(self.style.SUCCESS(msg))
+
+    def _generate(self, source, force):
+        try:
+            return renditions.generate(source, force=force)
+        except OSError as e:
+            self.stderr.write(f"{source}: {e}")
+            return None
+        finally:
+            connection.close()
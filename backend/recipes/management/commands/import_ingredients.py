@@ -0,0 +1,294 @@
+import csv
+import io
+import json
+from collections import defaultdict
+from itertools import islice
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from recipes import cart_totals, search
+from recipes.cache import GLOBAL_VERSION_KEY, bump_versions_on_commit
+from recipes.ingredient_index import ingredient_index
+from recipes.models import Ingredient, IngredientInRecipe
+
+MAX_LENGTH = 200
+READ_SIZE = 64 * 1024
+
+
+class Command(BaseCommand):
+    help = "Imports the ingredient catalog from a CSV or JSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", type=Path)
+        parser.add_argument(
+            "--format",
+            choices=("csv", "json"),
+            help="File format, detected from the extension by default.",
+        )
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"] or path.suffix.lstrip(".").lower()
+        if file_format not in ("csv", "json"):
+            raise CommandError(f'Unknown file format "{file_format}".')
+
+        with open(path, encoding="utf-8", newline="") as f:
+            if file_format == "csv":
+                rows = _read_csv(f)
+            else:
+                rows = _read_json(f)
+
+            with transaction.atomic():
+                if connection.vendor == "postgresql":
+                    stats, renamed = self._import_copy(rows)
+                else:
+                    stats, renamed = self._import_batches(
+                        rows, options["batch_size"]
+                    )
+                _refresh_recipes(renamed)
+
+        ingredient_index.rebuild_on_commit()
+        bump_versions_on_commit(GLOBAL_VERSION_KEY)
+
+        msg = "Inserted {inserted}, updated {updated}, skipped {skipped}"
+        self.stdout.write(self.style.SUCCESS(msg.format(**stats)))
+
+    def _import_copy(self, rows):
+        """Load the file with COPY and upsert it with two statements.
+
+        Ingredients are unique by lower(name) and lower(measurement_unit),
+        the unique_ingredient_lower index, so every row matches at most one
+        existing ingredient. The first of the rows that only differ in case
+        wins.
+        """
+        stats = {"total": 0}
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE ingredient_import "
+                "(position serial, name text, measurement_unit text) "
+                "ON COMMIT DROP"
+            )
+            cursor.copy_expert(
+                "COPY ingredient_import (name, measurement_unit) "
+                "FROM STDIN WITH (FORMAT csv)",
+                _CSVStream(_normalize(rows, stats)),
+            )
+            cursor.execute(
+                "CREATE TEMPORARY TABLE ingredient_import_unique "
+                "ON COMMIT DROP AS "
+                "SELECT DISTINCT ON (lower(name), lower(measurement_unit)) "
+                "name, measurement_unit FROM ingredient_import "
+                "ORDER BY lower(name), lower(measurement_unit), position"
+            )
+            cursor.execute(
+                f"""
+                UPDATE {Ingredient._meta.db_table} AS i
+                SET name = s.name, measurement_unit = s.measurement_unit
+                FROM ingredient_import_unique AS s,
+                    {Ingredient._meta.db_table} AS old
+                WHERE lower(i.name) = lower(s.name)
+                    AND lower(i.measurement_unit) = lower(s.measurement_unit)
+                    AND (i.name, i.measurement_unit)
+                        <> (s.name, s.measurement_unit)
+                    AND old.id = i.id
+                RETURNING i.id, old.name, old.measurement_unit,
+                    s.name, s.measurement_unit
+                """
+            )
+            # The joined copy of the table still has the previous names.
+            renamed = {
+                id_: ((old_name, old_unit), (name, unit))
+                for id_, old_name, old_unit, name, unit in cursor.fetchall()
+            }
+            cursor.execute(
+                f"""
+                INSERT INTO {Ingredient._meta.db_table}
+                    (name, measurement_unit)
+                SELECT name, measurement_unit
+                FROM ingredient_import_unique AS s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {Ingredient._meta.db_table} AS i
+                    WHERE lower(i.name) = lower(s.name)
+                        AND lower(i.measurement_unit)
+                            = lower(s.measurement_unit)
+                )
+                ON CONFLICT DO NOTHING
+                """
+            )
+            inserted = cursor.rowcount
+            # Dropped at commit anyway, unless the caller's transaction
+            # runs another import first.
+            cursor.execute(
+                "DROP TABLE ingredient_import, ingredient_import_unique"
+            )
+
+        return _stats(stats, inserted, len(renamed)), renamed
+
+    def _import_batches(self, rows, batch_size):
+        """Upsert the rows in chunks, matching them case-insensitively.
+
+        SQLite's lower() only folds ASCII letters, so the catalog is matched
+        in Python: its keys are read once, before the first chunk.
+        """
+        stats = {"total": 0}
+        inserted = 0
+        renamed = {}
+        seen = set()
+        rows = _normalize(rows, stats)
+
+        catalog = defaultdict(list)
+        for id_, name, unit in Ingredient.objects.values_list(
+            "id", "name", "measurement_unit"
+        ).iterator():
+            catalog[name.lower(), unit.lower()].append((id_, name, unit))
+
+        while True:
+            chunk = list(islice(rows, batch_size))
+            if not chunk:
+                break
+
+            to_create = []
+            to_update = []
+            for name, unit in chunk:
+                key = (name.lower(), unit.lower())
+                if key in seen:
+                    continue
+                seen.add(key)
+
+                existing = catalog.get(key)
+                if not existing:
+                    to_create.append(
+                        Ingredient(name=name, measurement_unit=unit)
+                    )
+                # Several spellings the index doesn't tell apart are left
+                # as they are, renaming one could collide with another.
+                elif len(existing) == 1 and existing[0][1:] != (name, unit):
+                    id_, *previous = existing[0]
+                    to_update.append(
+                        Ingredient(id=id_, name=name, measurement_unit=unit)
+                    )
+                    renamed[id_] = (tuple(previous), (name, unit))
+
+            Ingredient.objects.bulk_update(
+                to_update, ("name", "measurement_unit"), batch_size=batch_size
+            )
+            Ingredient.objects.bulk_create(
+                to_create, batch_size=batch_size, ignore_conflicts=True
+            )
+            inserted += len(to_create)
+
+        return _stats(stats, inserted, len(renamed)), renamed
+
+
+def _stats(stats, inserted, updated):
+    return {
+        "inserted": inserted,
+        "updated": updated,
+        "skipped": stats["total"] - inserted - updated,
+    }
+
+
+def _refresh_recipes(renamed, batch_size=1000):
+    """Refresh what the renamed ingredients were copied into.
+
+    ``renamed`` maps ingredient ids to their previous and current
+    (name, measurement unit). The bulk updates send no signals, so this
+    does what handle_ingredient_rename does for a saved ingredient: the
+    search vectors of the recipes using them are rebuilt after commit and
+    their amounts moved to the new cart totals.
+    """
+    ids = iter(renamed)
+    while True:
+        batch = list(islice(ids, batch_size))
+        if not batch:
+            break
+        recipe_ids = set(
+            IngredientInRecipe.objects.filter(
+                ingredient_id__in=batch
+            ).values_list("recipe_id", flat=True)
+        )
+        search.update_on_commit(recipe_ids)
+        cart_totals.rename_ingredients({id_: renamed[id_] for id_ in batch})
+
+
+def _normalize(rows, stats):
+    """Strip the values and drop rows that don't fit the model."""
+    for name, unit in rows:
+        stats["total"] += 1
+        name = (name or "").strip()
+        unit = (unit or "").strip()
+        if name and unit and max(len(name), len(unit)) <= MAX_LENGTH:
+            yield name, unit
+
+
+def _read_csv(f):
+    for row in csv.reader(f):
+        if row == ["name", "measurement_unit"]:
+            continue
+        yield (row + [None, None])[:2]
+
+
+def _read_json(f):
+    """Yield ingredients of a JSON array without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    eof = False
+
+    while True:
+        buffer = buffer.lstrip(" \t\r\n[,]")
+        if not buffer:
+            if eof:
+                return
+            chunk = f.read(READ_SIZE)
+            eof = not chunk
+            buffer = chunk
+            continue
+
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                raise CommandError("The JSON file is truncated.")
+            buffer += chunk
+            continue
+
+        buffer = buffer[end:]
+        if isinstance(item, dict):
+            yield item.get("name"), item.get("measurement_unit")
+        else:
+            # Rejected with the other invalid rows.
+            yield None, None
+
+
+class _CSVStream(io.TextIOBase):
+    """File-like object feeding normalized rows to COPY as CSV."""
+
+    def __init__(self, rows):
+        self._rows = rows
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._pending = ""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) < size:
+            rows = list(islice(self._rows, 1000))
+            if not rows:
+                break
+            self._writer.writerows(rows)
+            self._pending += self._buffer.getvalue()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+
+        if size < 0:
+            size = len(self._pending)
+        data = self._pending[:size]
+        self._pending = self._pending[len(data):]
+
+        return data
@@ -0,0 +1,38 @@
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from recipes import bulk
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Imports recipes from an NDJSON file written by export_recipes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", type=Path)
+        parser.add_argument(
+            "--author",
+            help="Email of the user who gets the recipes of authors "
+            "missing from this database.",
+        )
+        parser.add_argument("--chunk-size", type=int, default=bulk.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        author = None
+        if options["author"]:
+            author = User.objects.filter(email=options["author"]).first()
+            if author is None:
+                raise CommandError(f'No user "{options["author"]}".')
+
+        with open(options["path"], encoding="utf-8") as f:
+            result = bulk.import_recipes(
+                f, options["chunk_size"], default_author=author
+            )
+
+        for error in result.errors:
+            self.stderr.write(f"line {error['line']}: {error['error']}")
+        msg = f"Imported {result.created} recipes, {result.failed} failed"
+        self.stdout.write(self.style.SUCCESS(msg))
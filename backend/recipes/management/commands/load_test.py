@@ -0,0 +1,184 @@
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+
+from recipes.management.commands.benchmark import (ENDPOINTS, benchmark_user,
+                                                   build_context, free_recipes,
+                                                   percentile)
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends the benchmark requests to a running server from many "
+        "concurrent clients and reports the throughput and latencies"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url",
+            action="append",
+            help="Server to load (default http://localhost:8000). Repeat to "
+            "compare servers, e.g. the WSGI and the ASGI deployment, "
+            "loaded one after the other.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=32,
+            help="Number of clients sending requests at the same time.",
+        )
+        parser.add_argument(
+            "--duration", type=float, default=10, help="In seconds."
+        )
+        parser.add_argument(
+            "--endpoint",
+            action="append",
+            help="Only call the endpoint with this name, can be repeated.",
+        )
+        parser.add_argument("--timeout", type=float, default=30)
+
+    def handle(self, *args, **options):
+        endpoints = [
+            endpoint
+            for endpoint in ENDPOINTS
+            if options["endpoint"] is None
+            or endpoint.name in options["endpoint"]
+        ]
+        if not endpoints:
+            raise CommandError("No endpoint with that name.")
+
+        user = benchmark_user()
+        token, _ = Token.objects.get_or_create(user=user)
+        # Every client toggles its own recipe, so they don't collide.
+        toggle_recipes = free_recipes(user, options["concurrency"]) or [None]
+        contexts = [
+            build_context(user, toggle_recipes[i % len(toggle_recipes)])
+            for i in range(options["concurrency"])
+        ]
+
+        summary = []
+        failed = False
+        for url in options["url"] or ["http://localhost:8000"]:
+            self.stdout.write(url)
+            latencies, errors = self._load(
+                url, options, endpoints, token.key, contexts
+            )
+            self._report(endpoints, latencies, errors)
+            calls = sum(len(values) for values in latencies.values())
+            summary.append(
+                f"{url}: {calls / options['duration']:.1f} calls/s, "
+                f"{sum(errors.values())} errors"
+            )
+            failed = failed or bool(errors)
+
+        msg = "\n".join(summary)
+        if failed:
+            raise CommandError(msg)
+        self.stdout.write(self.style.SUCCESS(msg))
+
+    def _load(self, url, options, endpoints, token, contexts):
+        deadline = time.monotonic() + options["duration"]
+        with ThreadPoolExecutor(options["concurrency"]) as executor:
+            results = list(
+                executor.map(
+                    lambda i: self._client(
+                        url,
+                        options,
+                        endpoints,
+                        token,
+                        contexts[i],
+                        i,
+                        deadline,
+                    ),
+                    range(options["concurrency"]),
+                )
+            )
+
+        latencies = defaultdict(list)
+        errors = Counter()
+        for client_latencies, client_errors in results:
+            for name, values in client_latencies.items():
+                latencies[name].extend(values)
+            errors.update(client_errors)
+
+        return latencies, errors
+
+    @staticmethod
+    def _client(url, options, endpoints, token, ctx, offset, deadline):
+        anonymous = _HTTPClient(url, options["timeout"])
+        authenticated = _HTTPClient(url, options["timeout"], token)
+        latencies = defaultdict(list)
+        errors = Counter()
+
+        # The clients start at different endpoints, so all of them are
+        # called concurrently.
+        i = offset
+        while time.monotonic() < deadline:
+            endpoint = endpoints[i % len(endpoints)]
+            i += 1
+            client = authenticated if endpoint.authenticated else anonymous
+            start = time.perf_counter()
+            try:
+                failed = endpoint.request(client, ctx).status_code >= 400
+            except requests.RequestException:
+                failed = True
+            if failed:
+                errors[endpoint.name] += 1
+            else:
+                latencies[endpoint.name].append(
+                    (time.perf_counter() - start) * 1000
+                )
+
+        return latencies, errors
+
+    def _report(self, endpoints, latencies, errors):
+        header = (
+            f"{'endpoint':<28}{'calls':>8}{'errors':>8}{'p50 ms':>10}"
+            f"{'p95 ms':>10}{'p99 ms':>10}"
+        )
+        self.stdout.write(header)
+        for endpoint in endpoints:
+            values = latencies[endpoint.name]
+            if values:
+                percentiles = "".join(
+                    f"{percentile(values, percent):>10}"
+                    for percent in (50, 95, 99)
+                )
+            else:
+                percentiles = f"{'-':>10}" * 3
+            self.stdout.write(
+                f"{endpoint.name:<28}{len(values):>8}"
+                f"{errors[endpoint.name]:>8}{percentiles}"
+            )
+
+
+class _HTTPClient:
+    """Sends the ENDPOINTS requests over HTTP, as APIClient does in process."""
+
+    def __init__(self, base_url, timeout, token=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        if token is not None:
+            self.session.headers["Authorization"] = f"Token {token}"
+
+    def get(self, path, data=None):
+        return self._request("GET", path, params=data)
+
+    def post(self, path):
+        return self._request("POST", path)
+
+    def delete(self, path):
+        return self._request("DELETE", path)
+
+    def _request(self, method, path, **kwargs):
+        response = self.session.request(
+            method, self.base_url + path, timeout=self.timeout, **kwargs
+        )
+        # Reads the whole body, streamed responses included.
+        response.content
+        return response
@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, Min
+from django.db.models.functions import Lower
+
+from recipes import cart_totals
+from recipes.models import Ingredient, IngredientInRecipe, RecipeInCart
+
+
+class Command(BaseCommand):
+    help = (
+        "Merges the ingredients whose name and measurement unit differ only "
+        "in case into the oldest of them, as migration "
+        "0014_ingredient_unique_ingredient_lower requires"
+    )
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        ingredients = Ingredient.objects.annotate(
+            lower_name=Lower("name"), lower_unit=Lower("measurement_unit")
+        )
+        duplicates = (
+            ingredients.values("lower_name", "lower_unit")
+            .annotate(keep=Min("id"), count=Count("id"))
+            .filter(count__gt=1)
+            .order_by()
+        )
+        merged = {}
+        for duplicate in duplicates:
+            others = ingredients.filter(
+                lower_name=duplicate["lower_name"],
+                lower_unit=duplicate["lower_unit"],
+            ).exclude(id=duplicate["keep"])
+            for other in others.values_list("id", flat=True):
+                merged[other] = duplicate["keep"]
+
+        rows = IngredientInRecipe.objects.filter(
+            ingredient__in=[*merged, *merged.values()]
+        ).order_by("id")
+        kept = {}
+        removed = []
+        for row in rows:
+            ingredient_id = merged.get(row.ingredient_id, row.ingredient_id)
+            key = row.recipe_id, ingredient_id
+            if key in kept:
+                kept[key].amount += row.amount
+                removed.append(row.pk)
+            else:
+                row.ingredient_id = ingredient_id
+                kept[key] = row
+
+        # A recipe that had several of the spellings keeps one row with the
+        # amounts added up, unless they don't fit in the column.
+        _, max_amount = connection.ops.integer_field_range(
+            IngredientInRecipe._meta.get_field("amount").get_internal_type()
+        )
+        overflowing = sorted(
+            f"recipe {row.recipe_id}, ingredient {row.ingredient_id}: "
+            f"{row.amount}"
+            for row in kept.values()
+            if row.amount > max_amount
+        )
+        if overflowing:
+            raise CommandError(
+                f"Merged amounts over {max_amount}, fix these recipes "
+                f"first: {'; '.join(overflowing)}"
+            )
+
+        IngredientInRecipe.objects.filter(pk__in=removed).delete()
+        IngredientInRecipe.objects.bulk_update(
+            kept.values(), ("ingredient", "amount"), batch_size=1000
+        )
+        Ingredient.objects.filter(id__in=merged).delete()
+
+        # The totals of these carts listed the spellings separately.
+        recipe_ids = {recipe_id for recipe_id, _ in kept}
+        user_ids = set(
+            RecipeInCart.objects.filter(recipe_id__in=recipe_ids).values_list(
+                "user_id", flat=True
+            )
+        )
+        cart_totals.rebuild(user_ids)
+
+        msg = (
+            f"Successfully merged {len(merged)} ingredients, "
+            f"{len(removed)} recipe rows"
+        )
+        self.stdout.write(self.style.SUCCESS(msg))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from recipes import cart_totals
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the stored shopping cart totals of every user, e.g. "
+        "after carts were changed without signals"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        users, rows = cart_totals.rebuild_all(options["batch_size"])
+
+        msg = f"Successfully rebuilt {rows} cart totals of {users} users"
+        self.stdout.write(self.style.SUCCESS(msg))
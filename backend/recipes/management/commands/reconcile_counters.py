@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from recipes import counters
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the stored favorites, carts and recipes counters that "
+        "differ from the rows they count"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the number of wrong counters.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not options["dry_run"]:
+            created = counters.create_missing_profiles(options["batch_size"])
+            self.stdout.write(f"Created {created} missing profiles")
+
+        for counter in counters.COUNTERS:
+            name = f"{counter.model.split('.')[1]}.{counter.field}"
+            if options["dry_run"]:
+                drifted = counters.find_drift(counter).count()
+                self.stdout.write(f"{name}: {drifted} wrong")
+            else:
+                fixed = counters.reconcile(counter, options["batch_size"])
+                self.stdout.write(f"{name}: fixed {fixed}")
+
+        if not options["dry_run"]:
+            msg = "Successfully reconciled the counters"
+            self.stdout.write(self.style.SUCCESS(msg))
@@ -1,4 +1,4 @@
-import json
+import multiprocessing
 import os
 import random
 import shutil
@@ -6,37 +6,96 @@ from operator import itemgetter
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.management.base import BaseCommand
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, connections, transaction
+from django.db.models import Max
 
-from recipes.models import Ingredient, IngredientInRecipe, Recipe, Tag
+from recipes.cache import (GLOBAL_VERSION_KEY, RECIPES_VERSION_KEY,
+                           bump_versions_on_commit)
+from recipes.models import (Follow, Ingredient, IngredientInRecipe, Recipe,
+                            RecipeInCart, RecipeInFavorite, Tag)
+from recipes.search import update_search_vectors
 
 User = get_user_model()
 
+IMAGES = (
+    "lomtik-hleba.jpg",
+    "pirojki.png",
+    "egg.png",
+    "pelmen.jfif",
+    "hlopya.jpg",
+    "arbuz.jpg",
+    "pizza.jpg",
+    "french-fries.jpg",
+)
+WORDS = (
+    "берем",
+    "варим",
+    "жарим",
+    "режем",
+    "солим",
+    "перчим",
+    "смешиваем",
+    "запекаем",
+    "подаем",
+    "горячим",
+    "холодным",
+    "минут",
+    "тесто",
+    "соус",
+    "готово",
+)
+
+# Every block of generated rows gets its own random stream, so the dataset
+# only depends on --seed and not on the number of processes.
+BLOCK_SIZE = 1000
+
 
 class Command(BaseCommand):
     help = "Seeds the database with test data"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--users",
+            type=int,
+            default=0,
+            help="Generate a load testing dataset with this many users.",
+        )
+        parser.add_argument("--recipes", type=int, default=0)
+        parser.add_argument("--follows-per-user", type=int, default=0)
+        parser.add_argument("--favorites-per-user", type=int, default=0)
+        parser.add_argument("--carts-per-user", type=int, default=0)
+        parser.add_argument("--seed", type=int, default=420)
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of processes writing the dataset.",
+        )
+        parser.add_argument("--batch-size", type=int, default=5000)
+
     def handle(self, *args, **options):
         ingredients = self._create_ingredients()
         tags = self._create_tags()
-        users = self._create_users()
-        self._create_recipes(users, tags, ingredients)
+        self._copy_images()
+
+        if options["users"]:
+            self._generate(options, tags, ingredients)
+        else:
+            users = self._create_users()
+            self._create_recipes(users, tags, ingredients)
+
         msg = "Successfully seeded the database"
         self.stdout.write(self.style.SUCCESS(msg))
 
     def _create_ingredients(self):
         path = settings.BASE_DIR / "data" / "ingredients.json"
-        with open(path, encoding="utf-8") as f:
-            ingredients_data = json.loads(f.read())
-            return list(
-                map(
-                    itemgetter(0),
-                    [
-                        Ingredient.objects.get_or_create(**data)
-                        for data in ingredients_data
-                    ],
-                )
-            )
+        call_command("import_ingredients", path, stdout=self.stdout)
+
+        return list(Ingredient.objects.all())
 
     def _create_tags(self):
         tags_data = [
@@ -52,6 +111,17 @@ class Command(BaseCommand):
             )
         )
 
+    def _copy_images(self):
+        dest_dir = os.path.join(settings.MEDIA_ROOT, "recipes")
+        os.makedirs(dest_dir, exist_ok=True)
+
+        for image in IMAGES:
+            dest_path = os.path.join(dest_dir, image)
+            if not os.path.exists(dest_path):
+                shutil.copy(
+                    os.path.join(settings.BASE_DIR, "data", image), dest_path
+                )
+
     def _create_users(self):
         users = []
 
@@ -124,29 +194,198 @@ class Command(BaseCommand):
             },
         ]
 
-        for data in recipes_data:
-            image = data.pop("image")
-            data["author"] = random.choice(users)
-            recipe, created = Recipe.objects.get_or_create(
-                **data, image=f"recipes/{image}"
-            )
-            src_path = os.path.join(settings.BASE_DIR, f"data/{image}")
-            dest_path = os.path.join(settings.BASE_DIR, f"static/{image}")
-            if created:
-                shutil.copy(
-                    src_path,
-                    dest_path,
+        # The search vectors are built on commit, after the ingredients.
+        with transaction.atomic():
+            for data in recipes_data:
+                image = data.pop("image")
+                data["author"] = random.choice(users)
+                recipe, created = Recipe.objects.get_or_create(
+                    **data, image=f"recipes/{image}"
                 )
-                recipe.tags.set(
-                    random.sample(tags, random.randrange(1, len(tags)))
-                )
-                IngredientInRecipe.objects.bulk_create(
-                    IngredientInRecipe(
-                        recipe=recipe,
-                        ingredient=ingredient,
-                        amount=random.randrange(1, 500),
+                if created:
+                    recipe.tags.set(
+                        random.sample(tags, random.randrange(1, len(tags)))
                     )
-                    for ingredient in random.sample(
-                        ingredients, random.randrange(7)
+                    IngredientInRecipe.objects.bulk_create(
+                        IngredientInRecipe(
+                            recipe=recipe,
+                            ingredient=ingredient,
+                            amount=random.randrange(1, 500),
+                        )
+                        for ingredient in random.sample(
+                            ingredients, random.randrange(7)
+                        )
                     )
+
+    def _generate(self, options, tags, ingredients):
+        users = options["users"]
+        recipes = options["recipes"]
+        if users < 2 or recipes < 1:
+            raise CommandError("Use at least 2 users and 1 recipe.")
+
+        # Generated rows get explicit primary keys right after the existing
+        # ones, which lets every process pick related rows by index without
+        # reading back what the others have written.
+        params = {
+            "seed": options["seed"],
+            "batch_size": options["batch_size"],
+            "users": users,
+            "recipes": recipes,
+            "user_base": User.objects.aggregate(id=Max("id"))["id"] or 0,
+            "recipe_base": Recipe.objects.aggregate(id=Max("id"))["id"] or 0,
+            "tag_ids": [tag.id for tag in tags],
+            "ingredient_ids": [ingredient.id for ingredient in ingredients],
+            "password": make_password("password"),
+            "follows": min(options["follows_per_user"], users - 1),
+            "favorites": min(options["favorites_per_user"], recipes),
+            "carts": min(options["carts_per_user"], recipes),
+        }
+
+        for phase, total in (
+            (_generate_users, users),
+            (_generate_recipes, recipes),
+            (_generate_relations, users),
+        ):
+            tasks = [
+                (phase, params, start, min(start + BLOCK_SIZE, total))
+                for start in range(0, total, BLOCK_SIZE)
+            ]
+            created = self._run(tasks, options["processes"])
+            self.stdout.write(f"{phase.__name__[10:]}: {created} rows")
+
+        # bulk_create() sends no signals.
+        update_search_vectors(
+            Recipe.objects.filter(pk__gt=params["recipe_base"]).values("pk")
+        )
+        call_command("reconcile_counters", stdout=self.stdout)
+        call_command("rebuild_cart_totals", stdout=self.stdout)
+        # Cached lists and ETags of a running instance don't show the rows.
+        bump_versions_on_commit(GLOBAL_VERSION_KEY, RECIPES_VERSION_KEY)
+
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(
+                no_style(), [User, Recipe]
+            ):
+                cursor.execute(sql)
+
+    def _run(self, tasks, processes):
+        if processes <= 1:
+            return sum(map(_run_task, tasks))
+
+        # Forked children must not share the parent's database connection.
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        with context.Pool(processes) as pool:
+            return sum(pool.imap_unordered(_run_task, tasks))
+
+
+def _run_task(task):
+    phase, params, start, stop = task
+    rng = random.Random(f"{params['seed']}:{phase.__name__}:{start}")
+
+    with transaction.atomic():
+        return phase(rng, params, start, stop)
+
+
+def _bulk_create(model, objs, batch_size):
+    model.objects.bulk_create(objs, batch_size=batch_size)
+    return len(objs)
+
+
+def _generate_users(rng, params, start, stop):
+    users = []
+    for i in range(start, stop):
+        id_ = params["user_base"] + 1 + i
+        users.append(
+            User(
+                id=id_,
+                username=f"user{id_}",
+                email=f"user{id_}@example.com",
+                first_name=f"Имя {id_}",
+                last_name=f"Фамилия {id_}",
+                password=params["password"],
+            )
+        )
+
+    return _bulk_create(User, users, params["batch_size"])
+
+
+def _generate_recipes(rng, params, start, stop):
+    recipes = []
+    recipe_tags = []
+    ingredients = []
+    for i in range(start, stop):
+        id_ = params["recipe_base"] + 1 + i
+        recipes.append(
+            Recipe(
+                id=id_,
+                name=f"Рецепт {id_}",
+                author_id=params["user_base"]
+                + 1
+                + rng.randrange(params["users"]),
+                image=f"recipes/{rng.choice(IMAGES)}",
+                text=" ".join(rng.choices(WORDS, k=rng.randint(5, 30))),
+                cooking_time=rng.randint(1, 180),
+            )
+        )
+        for tag_id in rng.sample(
+            params["tag_ids"], rng.randint(1, len(params["tag_ids"]))
+        ):
+            recipe_tags.append(
+                Recipe.tags.through(recipe_id=id_, tag_id=tag_id)
+            )
+        for ingredient_id in rng.sample(
+            params["ingredient_ids"], rng.randint(3, 10)
+        ):
+            ingredients.append(
+                IngredientInRecipe(
+                    recipe_id=id_,
+                    ingredient_id=ingredient_id,
+                    amount=rng.randint(1, 500),
                 )
+            )
+
+    batch_size = params["batch_size"]
+    return (
+        _bulk_create(Recipe, recipes, batch_size)
+        + _bulk_create(Recipe.tags.through, recipe_tags, batch_size)
+        + _bulk_create(IngredientInRecipe, ingredients, batch_size)
+    )
+
+
+def _generate_relations(rng, params, start, stop):
+    user_base = params["user_base"] + 1
+    recipe_base = params["recipe_base"] + 1
+    follows = []
+    favorites = []
+    carts = []
+    for i in range(start, stop):
+        user_id = user_base + i
+        authors = [
+            author
+            for author in rng.sample(
+                range(params["users"]), params["follows"] + 1
+            )
+            if author != i
+        ]
+        follows.extend(
+            Follow(user_id=user_id, author_id=user_base + author)
+            for author in authors[: params["follows"]]
+        )
+        favorites.extend(
+            RecipeInFavorite(user_id=user_id, recipe_id=recipe_base + recipe)
+            for recipe in rng.sample(
+                range(params["recipes"]), params["favorites"]
+            )
+        )
+        carts.extend(
+            RecipeInCart(user_id=user_id, recipe_id=recipe_base + recipe)
+            for recipe in rng.sample(range(params["recipes"]), params["carts"])
+        )
+
+    batch_size = params["batch_size"]
+    return (
+        _bulk_create(Follow, follows, batch_size)
+        + _bulk_create(RecipeInFavorite, favorites, batch_size)
+        + _bulk_create(RecipeInCart, carts, batch_size)
+    )
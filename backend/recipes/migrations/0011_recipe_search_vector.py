@@ -0,0 +1,52 @@
+# Generated by Django 3.2.14 on 2026-10-18 23:40
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+SEARCH_VECTOR_INDEX = 'recipe_search_vector_idx'
+
+
+def create_search_vector_index(apps, schema_editor):
+    # GinIndex can't be created on SQLite, where search falls back to LIKE.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        f'CREATE INDEX IF NOT EXISTS {SEARCH_VECTOR_INDEX} '
+        f'ON recipes_recipe USING gin (search_vector)'
+    )
+    # Same vector as recipes.search.update_search_vectors().
+    schema_editor.execute(
+        "UPDATE recipes_recipe AS recipe SET search_vector = "
+        "setweight(to_tsvector('russian', COALESCE(recipe.name, '')), 'A')"
+        " || setweight(to_tsvector('russian', COALESCE(("
+        "SELECT STRING_AGG(ingredient.name, ' ') "
+        'FROM recipes_ingredientinrecipe AS item '
+        'JOIN recipes_ingredient AS ingredient '
+        'ON ingredient.id = item.ingredient_id '
+        "WHERE item.recipe_id = recipe.id), '')), 'B')"
+        " || setweight(to_tsvector('russian', COALESCE(recipe.text, '')), 'C')"
+    )
+
+
+def drop_search_vector_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP INDEX IF EXISTS {SEARCH_VECTOR_INDEX}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_recipe_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(
+            create_search_vector_index, drop_search_vector_index
+        ),
+    ]
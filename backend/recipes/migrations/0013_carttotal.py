@@ -0,0 +1,88 @@
+# Generated by Django 3.2.14 on 2026-10-19 14:05
+
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+
+# Same conversions as recipes.cart_totals.UNITS.
+UNITS = {
+    'г': ('г', 1),
+    'гр': ('г', 1),
+    'g': ('г', 1),
+    'кг': ('г', 1000),
+    'kg': ('г', 1000),
+    'мл': ('мл', 1),
+    'ml': ('мл', 1),
+    'л': ('мл', 1000),
+    'l': ('мл', 1000),
+    'шт': ('шт.', 1),
+    'шт.': ('шт.', 1),
+}
+
+
+def fill_cart_totals(apps, schema_editor):
+    CartTotal = apps.get_model('recipes', 'CartTotal')
+    IngredientInRecipe = apps.get_model('recipes', 'IngredientInRecipe')
+
+    totals = defaultdict(int)
+    rows = (
+        IngredientInRecipe.objects.filter(recipe__cart_recipe__isnull=False)
+        .values_list(
+            'recipe__cart_recipe__user',
+            'ingredient__name',
+            'ingredient__measurement_unit',
+        )
+        .annotate(amount=Sum('amount'))
+        .order_by()
+    )
+    for user_id, name, measurement_unit, amount in rows.iterator():
+        unit, factor = UNITS.get(
+            measurement_unit.strip().lower(), (measurement_unit, 1)
+        )
+        totals[user_id, name, unit] += amount * factor
+
+    CartTotal.objects.bulk_create(
+        (
+            CartTotal(
+                user_id=user_id,
+                name=name,
+                measurement_unit=unit,
+                amount=amount,
+            )
+            for (user_id, name, unit), amount in totals.items()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0012_recipe_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, verbose_name='Название')),
+                ('measurement_unit', models.CharField(max_length=200, verbose_name='Единица измерения')),
+                ('amount', models.PositiveBigIntegerField(verbose_name='Количество')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cart_totals', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Итог списка покупок',
+                'verbose_name_plural': 'Итоги списков покупок',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='carttotal',
+            constraint=models.UniqueConstraint(fields=('user', 'name', 'measurement_unit'), name='unique_cart_total'),
+        ),
+        migrations.RunPython(fill_cart_totals, migrations.RunPython.noop),
+    ]
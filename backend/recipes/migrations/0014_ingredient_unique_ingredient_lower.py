@@ -0,0 +1,41 @@
+# Generated by Django 3.2.14 on 2026-10-20 09:30
+
+from django.db import migrations
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+def check_case_duplicates(apps, schema_editor):
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+
+    duplicates = (
+        Ingredient.objects.values(
+            lower_name=Lower('name'), lower_unit=Lower('measurement_unit')
+        )
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+        .order_by()
+    )
+    if duplicates.exists():
+        raise RuntimeError(
+            'Some ingredients differ only in case, merge them with '
+            '"python manage.py merge_ingredient_duplicates" first.'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0013_carttotal'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_case_duplicates, migrations.RunPython.noop),
+        # Django 3.2 has no unique constraints on expressions, see
+        # recipes.models.Ingredient.validate_unique().
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX unique_ingredient_lower ON recipes_ingredient '
+            '(lower(name), lower(measurement_unit))',
+            'DROP INDEX unique_ingredient_lower',
+        ),
+    ]
@@ -1,12 +1,69 @@
-import os
-
 from django.conf import settings
+from django.contrib.postgres.search import SearchVectorField
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
 from django.core.validators import MinValueValidator
-from django.db import models
-from django.db.models.signals import post_delete
-from django.dispatch import receiver
+from django.db import models, transaction
+from django.db.models import Exists, F, OuterRef, Prefetch, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Lower, RowNumber
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import Signal, receiver
 
 from foodgram.settings import MIN_AMOUNT, MIN_COOK_TIME
+from recipes import cart_totals, cleanup, counters, renditions, search
+from recipes.cache import (GLOBAL_VERSION_KEY, RECIPES_VERSION_KEY,
+                           author_version_key, bump_versions_on_commit,
+                           recipe_version_key, user_version_key)
+from recipes.ingredient_index import ingredient_index
+
+# Sent with all ``rows`` of ``sender`` deleted by one delete() of a
+# BulkDeleteModel, each with the ``deleted_fields`` of the model as
+# attributes.
+rows_deleted = Signal()
+
+
+class BulkDeleteQuerySet(models.QuerySet):
+    def delete(self):
+        with transaction.atomic(using=self.db, savepoint=False):
+            # Only the keys the receivers need, not whole model instances.
+            rows = list(
+                self.values_list(*self.model.deleted_fields, named=True)
+            )
+            return _send_deleted(super().delete(), self.model, rows)
+
+
+class BulkDeleteModel(models.Model):
+    """Rows whose bookkeeping is done once for all rows deleted together.
+
+    A post_delete receiver would make the deletion collector load and
+    signal every row when their recipe or user is deleted, instead of
+    deleting them all with one query. These models have none and send
+    ``rows_deleted`` when deleted directly, the receivers of the deleted
+    recipe, ingredient or user handle the cascades.
+    """
+
+    # Fields of the rows sent with ``rows_deleted``.
+    deleted_fields = ()
+
+    objects = BulkDeleteQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def delete(self, using=None, keep_parents=False):
+        with transaction.atomic(using=using, savepoint=False):
+            return _send_deleted(
+                super().delete(using, keep_parents), type(self), [self]
+            )
+
+
+def _send_deleted(deleted, sender, rows):
+    """Send ``rows_deleted`` for ``rows``, return the result of delete()."""
+    if rows:
+        rows_deleted.send(sender=sender, rows=rows)
+
+    return deleted
 
 
 class Tag(models.Model):
@@ -24,7 +81,9 @@ class Tag(models.Model):
         return self.name
 
 
-class IngredientInRecipe(models.Model):
+class IngredientInRecipe(BulkDeleteModel):
+    deleted_fields = ("recipe_id", "ingredient_id", "amount")
+
     recipe = models.ForeignKey(
         "recipes.Recipe",
         verbose_name="Ингредиенты",
@@ -68,10 +127,219 @@ class Ingredient(models.Model):
     class Meta:
         verbose_name = "Ингредиент"
         verbose_name_plural = "Ингредиенты"
+        constraints = (
+            models.UniqueConstraint(
+                name="unique_ingredient",
+                fields=("name", "measurement_unit"),
+            ),
+        )
 
     def __str__(self):
         return self.name
 
+    def validate_unique(self, exclude=None):
+        super().validate_unique(exclude)
+
+        # The unique_ingredient_lower index of migration 0014, Django 3.2
+        # can't declare a unique constraint on expressions.
+        if exclude and {"name", "measurement_unit"} & set(exclude):
+            return
+        duplicates = (
+            Ingredient.objects.annotate(
+                lower_name=Lower("name"), lower_unit=Lower("measurement_unit")
+            )
+            .filter(
+                lower_name=self.name.lower(),
+                lower_unit=self.measurement_unit.lower(),
+            )
+            .exclude(pk=self.pk)
+        )
+        if duplicates.exists():
+            raise ValidationError(
+                {
+                    NON_FIELD_ERRORS: (
+                        "Ингредиент с таким названием и единицей измерения "
+                        "уже существует."
+                    )
+                }
+            )
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def handle_ingredient_change(**kwargs):
+    ingredient_index.rebuild_on_commit()
+    bump_versions_on_commit(GLOBAL_VERSION_KEY)
+
+
+@receiver(pre_save, sender=Ingredient)
+def handle_ingredient_pre_save(instance, raw, **kwargs):
+    if raw or instance.pk is None:
+        return
+
+    stored = (
+        Ingredient.objects.filter(pk=instance.pk)
+        .values_list("name", "measurement_unit")
+        .first()
+    )
+    if stored is not None and stored != (
+        instance.name,
+        instance.measurement_unit,
+    ):
+        instance._renamed_from = stored
+
+
+@receiver(post_save, sender=Ingredient)
+def handle_ingredient_rename(instance, **kwargs):
+    renamed_from = instance.__dict__.pop("_renamed_from", None)
+    if renamed_from is None:
+        return
+
+    search.update_on_commit(
+        set(
+            IngredientInRecipe.objects.filter(
+                ingredient=instance
+            ).values_list("recipe_id", flat=True)
+        )
+    )
+    cart_totals.rename_ingredients(
+        {
+            instance.pk: (
+                renamed_from,
+                (instance.name, instance.measurement_unit),
+            )
+        }
+    )
+
+
+@receiver(pre_delete, sender=Ingredient)
+def handle_ingredient_pre_delete(instance, **kwargs):
+    # Its rows in recipes are deleted without signals.
+    rows = list(
+        IngredientInRecipe.objects.filter(ingredient=instance).values_list(
+            "recipe_id", "amount"
+        )
+    )
+    search.update_on_commit({recipe_id for recipe_id, _ in rows})
+    cart_totals.change_ingredients(
+        (recipe_id, instance.pk, -amount) for recipe_id, amount in rows
+    )
+
+
+@receiver((post_save, post_delete), sender=Tag)
+def handle_tag_change(**kwargs):
+    bump_versions_on_commit(GLOBAL_VERSION_KEY)
+
+
+@receiver(pre_save, sender=IngredientInRecipe)
+def handle_ingredient_in_recipe_pre_save(instance, raw, **kwargs):
+    if raw or instance.pk is None:
+        return
+
+    instance._stored = (
+        IngredientInRecipe.objects.filter(pk=instance.pk)
+        .values_list("ingredient_id", "amount")
+        .first()
+    )
+
+
+@receiver(post_save, sender=IngredientInRecipe)
+def handle_ingredient_in_recipe_change(instance, **kwargs):
+    changes = [(instance.recipe_id, instance.ingredient_id, instance.amount)]
+    stored = instance.__dict__.pop("_stored", None)
+    if stored is not None:
+        ingredient_id, amount = stored
+        changes.append((instance.recipe_id, ingredient_id, -amount))
+
+    _ingredients_changed({instance.recipe_id})
+    cart_totals.change_ingredients(changes)
+
+
+@receiver(rows_deleted, sender=IngredientInRecipe)
+def handle_ingredients_in_recipes_deleted(rows, **kwargs):
+    _ingredients_changed({row.recipe_id for row in rows})
+    cart_totals.change_ingredients(
+        (row.recipe_id, row.ingredient_id, -row.amount) for row in rows
+    )
+
+
+def _ingredients_changed(recipe_ids):
+    """Invalidate the recipes whose rows of ingredients changed."""
+    bump_versions_on_commit(
+        *map(recipe_version_key, recipe_ids), RECIPES_VERSION_KEY
+    )
+    search.update_on_commit(recipe_ids)
+
+
+class RecipeQuerySet(models.QuerySet):
+    @staticmethod
+    def related_lookups():
+        return (
+            "tags",
+            Prefetch(
+                "ingredientinrecipe_set",
+                queryset=IngredientInRecipe.objects.select_related(
+                    "ingredient"
+                ),
+            ),
+        )
+
+    def with_related(self):
+        return self.select_related("author").prefetch_related(
+            *self.related_lookups()
+        )
+
+    def with_author_count(self):
+        return self.annotate(
+            author_recipes_count=F("author__profile__recipes_count")
+        )
+
+    def with_user_flags(self, user):
+        queryset = self.with_author_count()
+
+        if user.is_anonymous:
+            return queryset
+
+        return queryset.annotate(
+            is_favorited=Exists(
+                RecipeInFavorite.objects.filter(
+                    user=user, recipe=OuterRef("pk")
+                )
+            ),
+            is_in_shopping_cart=Exists(
+                RecipeInCart.objects.filter(user=user, recipe=OuterRef("pk"))
+            ),
+            author_is_subscribed=Exists(
+                Follow.objects.filter(user=user, author=OuterRef("author"))
+            ),
+        )
+
+    def newest_per_author(self, limit):
+        """Keep at most ``limit`` newest recipes of every author.
+
+        Recipes are ranked with ROW_NUMBER() in a single query instead of
+        slicing each author's recipes separately.
+        """
+        ranked = (
+            self.annotate(
+                row_number=Window(
+                    expression=RowNumber(),
+                    partition_by=F("author"),
+                    order_by=(F("pub_date").desc(), F("id").desc()),
+                )
+            )
+            .order_by()
+            .values("id", "row_number")
+        )
+        sql, params = ranked.query.sql_with_params()
+
+        return self.model.objects.filter(
+            pk__in=RawSQL(
+                f"SELECT ranked.id FROM ({sql}) AS ranked "
+                "WHERE ranked.row_number <= %s",
+                (*params, limit),
+            )
+        )
+
 
 class Recipe(models.Model):
     name = models.CharField(
@@ -90,7 +358,20 @@ class Recipe(models.Model):
         upload_to="recipes/",
         help_text="Загрузите изображение",
     )
+    renditions = models.JSONField(
+        "Уменьшенные копии картинки",
+        default=dict,
+        blank=True,
+        editable=False,
+    )
     text = models.TextField("Описание", help_text="Введите описание рецепта")
+    search_vector = SearchVectorField(null=True, editable=False)
+    favorites_count = models.PositiveIntegerField(
+        "Добавили в избранное", default=0, editable=False
+    )
+    carts_count = models.PositiveIntegerField(
+        "Добавили в список покупок", default=0, editable=False
+    )
     ingredients = models.ManyToManyField(
         Ingredient,
         through=IngredientInRecipe,
@@ -107,10 +388,17 @@ class Recipe(models.Model):
         help_text="В минутах",
     )
 
+    objects = RecipeQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Рецепт"
         verbose_name_plural = "Рецепты"
         ordering = ("-pub_date",)
+        indexes = (
+            models.Index(
+                name="recipe_pub_date_idx", fields=("-pub_date", "-id")
+            ),
+        )
 
         constraints = (
             models.CheckConstraint(
@@ -125,13 +413,118 @@ class Recipe(models.Model):
 
 @receiver(post_delete, sender=Recipe)
 def handle_recipe_post_delete(instance, **kwargs):
-    try:
-        os.remove(instance.image.path)
-    except FileNotFoundError:
-        pass
+    cleanup.delete_on_commit(instance.image.name, instance.renditions)
+
+
+@receiver(pre_save, sender=Recipe)
+def handle_recipe_pre_save(instance, raw, update_fields, **kwargs):
+    if raw or instance.pk is None:
+        return
+    if update_fields is not None and "image" not in update_fields:
+        return
+
+    stored = (
+        Recipe.objects.filter(pk=instance.pk)
+        .values("image", "renditions")
+        .first()
+    )
+    if stored is not None and stored["image"] != instance.image.name:
+        instance._replaced_image = stored
+
+
+@receiver(post_save, sender=Recipe)
+def handle_recipe_image_change(instance, **kwargs):
+    replaced = instance.__dict__.pop("_replaced_image", None)
+    if replaced is not None:
+        cleanup.delete_on_commit(replaced["image"], replaced["renditions"])
+
+    if instance.image and not renditions.is_current(instance):
+        pk, source = instance.pk, instance.image.name
+        transaction.on_commit(lambda: renditions.schedule(pk, source))
+
+
+@receiver(post_save, sender=Recipe)
+def handle_recipe_text_change(instance, raw, update_fields, **kwargs):
+    if raw:
+        return
+    if update_fields is not None and not {"name", "text"} & set(update_fields):
+        return
+
+    # Runs after commit, when the ingredients saved next to it exist too.
+    search.update_on_commit({instance.pk})
+
 
+@receiver(post_save, sender=Recipe)
+def handle_recipe_created(instance, created, raw, **kwargs):
+    if created and not raw:
+        counters.add_recipes(instance.author_id, 1)
+
+
+@receiver(post_delete, sender=Recipe)
+def handle_recipe_deleted(instance, **kwargs):
+    counters.add_recipes(instance.author_id, -1)
+
+
+@receiver((post_save, post_delete), sender=Recipe)
+def handle_recipe_change(instance, **kwargs):
+    # The author's recipe count is part of the cached fragments too.
+    bump_versions_on_commit(
+        recipe_version_key(instance.pk),
+        author_version_key(instance.author_id),
+        RECIPES_VERSION_KEY,
+    )
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def handle_recipe_tags_change(instance, action, reverse, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if reverse:
+        bump_versions_on_commit(GLOBAL_VERSION_KEY)
+    else:
+        bump_versions_on_commit(
+            recipe_version_key(instance.pk), RECIPES_VERSION_KEY
+        )
+
+
+# Fields of the author rendered in the cached recipe fragments.
+AUTHOR_FIELDS = ("username", "first_name", "last_name", "email")
+
+
+@receiver(pre_save, sender=settings.AUTH_USER_MODEL)
+def handle_author_pre_save(instance, raw, update_fields, **kwargs):
+    # A new user has no recipes, logins and password changes touch no
+    # field the recipes show.
+    if raw or instance.pk is None:
+        return
+    if update_fields is not None and not set(AUTHOR_FIELDS) & set(
+        update_fields
+    ):
+        return
+
+    stored = (
+        type(instance)
+        .objects.filter(pk=instance.pk)
+        .values_list(*AUTHOR_FIELDS)
+        .first()
+    )
+    current = tuple(getattr(instance, field) for field in AUTHOR_FIELDS)
+    if stored is not None and stored != current:
+        instance._author_changed = True
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def handle_author_change(instance, **kwargs):
+    if instance.__dict__.pop("_author_changed", False):
+        bump_versions_on_commit(
+            author_version_key(instance.pk), RECIPES_VERSION_KEY
+        )
+
+
+class RecipeInCart(BulkDeleteModel):
+    deleted_fields = ("user_id", "recipe_id")
 
-class RecipeInCart(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -155,12 +548,21 @@ class RecipeInCart(models.Model):
                 fields=("user", "recipe"),
             ),
         )
+        # The unique constraint covers lookups by user, this one covers the
+        # joins from the recipe side.
+        indexes = (
+            models.Index(
+                name="cart_recipe_user_idx", fields=("recipe", "user")
+            ),
+        )
 
     def __str__(self):
         return f'{self.user} добавил "{self.recipe}"'
 
 
-class RecipeInFavorite(models.Model):
+class RecipeInFavorite(BulkDeleteModel):
+    deleted_fields = ("user_id", "recipe_id")
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -184,12 +586,19 @@ class RecipeInFavorite(models.Model):
                 fields=("user", "recipe"),
             ),
         )
+        indexes = (
+            models.Index(
+                name="favorite_recipe_user_idx", fields=("recipe", "user")
+            ),
+        )
 
     def __str__(self):
         return f'{self.user} добавил "{self.recipe}"'
 
 
-class Follow(models.Model):
+class Follow(BulkDeleteModel):
+    deleted_fields = ("user_id",)
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -219,3 +628,134 @@ class Follow(models.Model):
 
     def __str__(self):
         return f"{self.user} подписан на {self.author}"
+
+
+@receiver(post_save, sender=RecipeInCart)
+@receiver(post_save, sender=RecipeInFavorite)
+@receiver(post_save, sender=Follow)
+def handle_user_flags_change(instance, **kwargs):
+    bump_versions_on_commit(user_version_key(instance.user_id))
+
+
+@receiver(rows_deleted, sender=RecipeInCart)
+@receiver(rows_deleted, sender=RecipeInFavorite)
+@receiver(rows_deleted, sender=Follow)
+def handle_user_flags_deleted(rows, **kwargs):
+    bump_versions_on_commit(*{user_version_key(row.user_id) for row in rows})
+
+
+class Profile(models.Model):
+    """Counters of a user that are too expensive to count on every read."""
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="profile",
+        verbose_name="Пользователь",
+    )
+    recipes_count = models.PositiveIntegerField(
+        "Количество рецептов", default=0, editable=False
+    )
+
+    class Meta:
+        verbose_name = "Профиль"
+        verbose_name_plural = "Профили"
+
+    def __str__(self):
+        return str(self.user)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def handle_user_created(instance, created, raw, **kwargs):
+    if created and not raw:
+        Profile.objects.get_or_create(user=instance)
+
+
+# Recipe counter of every row that marks a recipe.
+RECIPE_COUNTERS = {
+    RecipeInFavorite: counters.RECIPE_FAVORITES,
+    RecipeInCart: counters.RECIPE_CARTS,
+}
+
+
+@receiver(post_save, sender=RecipeInCart)
+@receiver(post_save, sender=RecipeInFavorite)
+def handle_recipe_mark_added(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        counters.add(
+            Recipe.objects.filter(pk=instance.recipe_id),
+            RECIPE_COUNTERS[sender].field,
+            1,
+        )
+
+
+@receiver(rows_deleted, sender=RecipeInCart)
+@receiver(rows_deleted, sender=RecipeInFavorite)
+def handle_recipe_marks_removed(sender, rows, **kwargs):
+    counters.recount(RECIPE_COUNTERS[sender], {row.recipe_id for row in rows})
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def handle_user_pre_delete(instance, **kwargs):
+    # The user's marks are deleted with them without signals, a user marks
+    # a recipe once at most.
+    for model, counter in RECIPE_COUNTERS.items():
+        marked = model.objects.filter(user=instance).values("recipe_id")
+        counters.add(Recipe.objects.filter(pk__in=marked), counter.field, -1)
+
+
+class CartTotal(models.Model):
+    """Amount of an ingredient over all recipes in a user's cart.
+
+    Maintained by recipes.cart_totals, in the canonical unit of the
+    ingredient's measurement unit.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="cart_totals",
+        verbose_name="Пользователь",
+    )
+    name = models.CharField("Название", max_length=200)
+    measurement_unit = models.CharField("Единица измерения", max_length=200)
+    amount = models.PositiveBigIntegerField("Количество")
+
+    class Meta:
+        verbose_name = "Итог списка покупок"
+        verbose_name_plural = "Итоги списков покупок"
+        # Also serves the shopping list, which is ordered the same way.
+        constraints = (
+            models.UniqueConstraint(
+                name="unique_cart_total",
+                fields=("user", "name", "measurement_unit"),
+            ),
+        )
+
+    def __str__(self):
+        return f"{self.name} - {self.amount} {self.measurement_unit}"
+
+
+@receiver(post_save, sender=RecipeInCart)
+def handle_cart_recipe_added(instance, created, raw, **kwargs):
+    if created and not raw:
+        cart_totals.change_carts([(instance.user_id, instance.recipe_id)], 1)
+
+
+@receiver(rows_deleted, sender=RecipeInCart)
+def handle_cart_recipes_removed(rows, **kwargs):
+    cart_totals.change_carts(
+        ((row.user_id, row.recipe_id) for row in rows), -1
+    )
+
+
+@receiver(pre_delete, sender=Recipe)
+def handle_recipe_pre_delete(instance, **kwargs):
+    # Its cart rows are deleted with it without signals.
+    cart_totals.change_carts(
+        RecipeInCart.objects.filter(recipe=instance).values_list(
+            "user_id", "recipe_id"
+        ),
+        -1,
+    )
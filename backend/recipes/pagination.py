@@ -0,0 +1,227 @@
+import base64
+import hashlib
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class CachedCountPaginator(Paginator):
+    """Paginator that caches the total count of the filtered queryset.
+
+    The count is shared by all requests running the same query, so it may
+    be up to PAGINATION_COUNT_TIMEOUT seconds old.
+    """
+
+    @cached_property
+    def count(self):
+        sql, params = self.object_list.query.sql_with_params()
+        digest = hashlib.md5(f"{sql}:{params}".encode()).hexdigest()
+        key = f"pagination:count:{digest}"
+
+        count = cache.get(key)
+        if count is None:
+            count = self.object_list.count()
+            cache.set(key, count, settings.PAGINATION_COUNT_TIMEOUT)
+
+        return count
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that estimates the row count of big unfiltered tables.
+
+    COUNT(*) reads the whole table, so on PostgreSQL an unfiltered
+    queryset is counted from the planner statistics instead. Filtered
+    querysets and tables below ``threshold`` rows are counted exactly.
+    """
+
+    threshold = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if not queryset.query.where and connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class "
+                    "WHERE oid = %s::regclass",
+                    (queryset.model._meta.db_table,),
+                )
+                (estimate,) = cursor.fetchone()
+            # reltuples is -1 (0 before PostgreSQL 14) until the first
+            # ANALYZE.
+            if estimate >= self.threshold:
+                return estimate
+
+        return super().count
+
+
+class MyPageNumberPagination(PageNumberPagination):
+    """Page number pagination with an optional keyset mode.
+
+    Requests with a ``cursor`` parameter (empty for the first page) are
+    paginated by the values of ``ordering`` instead of OFFSET, so deep
+    pages cost the same as the first one. ``next`` and ``previous`` then
+    hold cursor links. In both modes the total count is cached when it is
+    the same for every user, see count_is_shared().
+
+    A queryset that is explicitly ordered already, like ranked search
+    results, keeps its ordering.
+    """
+
+    page_size = 6
+    page_size_query_param = "limit"
+    max_page_size = settings.MAX_PAGE_SIZE
+    django_paginator_class = CachedCountPaginator
+    cursor_query_param = "cursor"
+    ordering = ("-pub_date", "-id")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if queryset.query.order_by:
+            self.ordering = tuple(queryset.query.order_by)
+        queryset = queryset.order_by(*self.ordering)
+        if not self.count_is_shared(request, view):
+            self.django_paginator_class = Paginator
+        self.cursor_mode = self.cursor_query_param in request.query_params
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.count = self.django_paginator_class(queryset, 1).count
+        page_size = self.get_page_size(request)
+        position, reverse = self._decode_cursor(request)
+
+        if reverse:
+            queryset = queryset.reverse()
+        try:
+            if position is not None:
+                queryset = queryset.filter(self._after(position, reverse))
+            # One extra row tells whether there is a page after this one.
+            page = list(queryset[: page_size + 1])
+        except (ValidationError, ValueError, TypeError):
+            raise NotFound("Invalid cursor")
+
+        has_more = len(page) > page_size
+        page = page[:page_size]
+        if reverse:
+            page.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, position is not None
+        self.next_position = self.previous_position = None
+        if page and has_next:
+            self.next_position = self._position(page[-1])
+        if page and has_previous:
+            self.previous_position = self._position(page[0])
+
+        return page
+
+    def count_is_shared(self, request, view):
+        """Tell whether the count may be cached for all users.
+
+        A count filtered by the marks of the user changes with every mark
+        they set, a cached one would hide the rows marked meanwhile.
+        """
+        filterset_class = getattr(view, "filterset_class", None)
+        personal = getattr(filterset_class, "personal_filters", ())
+
+        return not any(request.query_params.get(name) for name in personal)
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+
+        return Response(
+            OrderedDict(
+                (
+                    ("count", self.count),
+                    ("next", self._cursor_link(self.next_position, False)),
+                    (
+                        "previous",
+                        self._cursor_link(self.previous_position, True),
+                    ),
+                    ("results", data),
+                )
+            )
+        )
+
+    def _after(self, position, reverse):
+        """Q of the rows after ``position`` in the (reversed) ordering."""
+        condition = Q()
+        for index, field in enumerate(self.ordering):
+            name = field.lstrip("-")
+            descending = field.startswith("-") != reverse
+            lookup = "lt" if descending else "gt"
+            step = Q(**{f"{name}__{lookup}": position[index]})
+            for previous, value in zip(self.ordering[:index], position):
+                step &= Q(**{previous.lstrip("-"): value})
+            condition |= step
+
+        return condition
+
+    def _position(self, obj):
+        return [
+            _serialize(getattr(obj, field.lstrip("-")))
+            for field in self.ordering
+        ]
+
+    def _decode_cursor(self, request):
+        encoded = request.query_params[self.cursor_query_param]
+        if not encoded:
+            return None, False
+
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            position, reverse = cursor["p"], bool(cursor.get("r"))
+        except (ValueError, TypeError, KeyError):
+            raise NotFound("Invalid cursor")
+        if not isinstance(position, list) or len(position) != len(
+            self.ordering
+        ):
+            raise NotFound("Invalid cursor")
+
+        return position, reverse
+
+    def _cursor_link(self, position, reverse):
+        if position is None:
+            return None
+
+        cursor = {"p": position}
+        if reverse:
+            cursor["r"] = 1
+        encoded = base64.urlsafe_b64encode(
+            json.dumps(cursor, separators=(",", ":")).encode()
+        ).decode()
+        url = remove_query_param(
+            self.request.build_absolute_uri(), self.page_query_param
+        )
+
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+
+class SubscriptionPagination(MyPageNumberPagination):
+    page_size = 10
+    # Authors are listed in the order the user subscribed to them.
+    ordering = ("subscription_id",)
+
+    def count_is_shared(self, request, view):
+        # The subscriptions of the user.
+        return False
+
+
+def _serialize(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+
+    return value
@@ -0,0 +1,93 @@
+import json
+
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from rest_framework import parsers, status
+from rest_framework.exceptions import APIException, ParseError
+
+
+class RequestEntityTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "Файл слишком большой."
+    default_code = "too_large"
+
+
+class LimitedTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """Streams every uploaded file to a temporary file on disk.
+
+    A file bigger than UPLOAD_MAX_SIZE is rejected as soon as that many
+    bytes have been read, and a request that declares a bigger body
+    before the first byte is read.
+    """
+
+    def handle_raw_input(
+        self, input_data, meta, content_length, boundary, encoding=None
+    ):
+        # The non-file fields are limited by DATA_UPLOAD_MAX_MEMORY_SIZE.
+        max_length = (
+            settings.UPLOAD_MAX_SIZE + settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+        )
+        if content_length > max_length:
+            raise RequestEntityTooLarge()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > settings.UPLOAD_MAX_SIZE:
+            raise RequestEntityTooLarge()
+
+        return super().receive_data_chunk(raw_data, start)
+
+
+class MultiPartJSONParser(parsers.MultiPartParser):
+    """multipart/form-data with nested data in JSON encoded fields.
+
+    Files are streamed to disk instead of memory. The values of the
+    ``json_fields`` are decoded as JSON, so a form can carry the same
+    ingredients and tags as a JSON body next to the image file.
+    """
+
+    json_fields = ("ingredients", "tags")
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = parser_context["request"]
+        request.upload_handlers = [LimitedTemporaryFileUploadHandler(request)]
+        parsed = super().parse(stream, media_type, parser_context)
+
+        data = {key: parsed.data[key] for key in parsed.data}
+        for field in self.json_fields:
+            if field not in data:
+                continue
+            try:
+                data[field] = json.loads(data[field])
+            except ValueError as e:
+                raise ParseError(f'Field "{field}" is not valid JSON: {e}')
+
+        files = _Files((key, parsed.files[key]) for key in parsed.files)
+
+        return parsers.DataAndFiles(data, files)
+
+
+class _Files(dict):
+    """One file per field, closed with the request like request.FILES.
+
+    Not a MultiValueDict, DRF merges the files into the data with
+    dict.update(), which would copy its value lists.
+    """
+
+    def lists(self):
+        return ((key, [value]) for key, value in self.items())
+
+
+class NDJSONParser(parsers.BaseParser):
+    """Newline delimited JSON, parsed lazily.
+
+    The data is an iterator over the lines of the request body, which is
+    read as it is consumed instead of being loaded into memory.
+    """
+
+    media_type = "application/x-ndjson"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None:
+            return iter(())
+
+        return iter(stream)
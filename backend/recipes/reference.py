@@ -0,0 +1,78 @@
+"""Process-local copy of the reference data: tags and ingredients.
+
+Every process loads all tags and the whole ingredient catalog once and
+reloads them when GLOBAL_VERSION_KEY, which any tag or ingredient change
+bumps, no longer matches the loaded version. The version is checked at
+most once every CHECK_INTERVAL seconds.
+"""
+import time
+from collections import namedtuple
+
+from recipes.cache import GLOBAL_VERSION_KEY, get_versions
+from recipes.models import Ingredient, Tag
+
+CHECK_INTERVAL = 1.0
+
+Snapshot = namedtuple("Snapshot", ("version", "tags", "ingredients"))
+
+
+class ReferenceData:
+    def __init__(self):
+        self._snapshot = None
+        self._checked_at = None
+
+    def reset(self):
+        """Drop the loaded data, the next lookup loads it again."""
+        self._snapshot = None
+        self._checked_at = None
+
+    def tags(self):
+        return list(self._get().tags.values())
+
+    def get_tag(self, pk):
+        return self._get().tags.get(pk)
+
+    def has_ingredient(self, pk):
+        return pk in self._get().ingredients
+
+    def get_ingredient(self, pk):
+        row = self._get().ingredients.get(pk)
+        if row is None:
+            return None
+
+        name, measurement_unit = row
+        return Ingredient(id=pk, name=name, measurement_unit=measurement_unit)
+
+    def _get(self):
+        now = time.monotonic()
+        if (
+            self._snapshot is not None
+            and now - self._checked_at < CHECK_INTERVAL
+        ):
+            return self._snapshot
+
+        version = get_versions((GLOBAL_VERSION_KEY,))[GLOBAL_VERSION_KEY]
+        if self._snapshot is None or self._snapshot.version != version:
+            # The version is read before the rows, so a change committed in
+            # between is picked up by the next check.
+            self._snapshot = self._load(version)
+        self._checked_at = now
+
+        return self._snapshot
+
+    @staticmethod
+    def _load(version):
+        ingredients = Ingredient.objects.values_list(
+            "id", "name", "measurement_unit"
+        )
+        return Snapshot(
+            version=version,
+            tags={tag.id: tag for tag in Tag.objects.order_by("id")},
+            ingredients={
+                id_: (name, measurement_unit)
+                for id_, name, measurement_unit in ingredients.iterator()
+            },
+        )
+
+
+reference_data = ReferenceData()
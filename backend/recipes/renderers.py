@@ -0,0 +1,135 @@
+import csv
+import json
+import tempfile
+from datetime import datetime
+
+from django.conf import settings
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+from rest_framework.renderers import BaseRenderer
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ShoppingListRenderer(BaseRenderer):
+    """Base for the shopping list formats, itself the JSON one.
+
+    The list itself is written by ``stream``, which consumes the aggregated
+    ingredient rows lazily and yields the file chunk by chunk. ``render``
+    is only used by DRF for error responses of the download action, those
+    are sent as JSON whatever format was requested.
+    """
+
+    media_type = "application/json"
+    format = "json"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get("response")
+        if response is not None:
+            response["Content-Type"] = "application/json"
+
+        return json.dumps(data, ensure_ascii=False).encode()
+
+    def stream(self, ingredients):
+        separator = "["
+        for ingredient in ingredients:
+            yield separator + json.dumps(ingredient, ensure_ascii=False)
+            separator = ","
+        yield "[]" if separator == "[" else "]"
+
+    @staticmethod
+    def footer():
+        return f"foodgram, {datetime.now().year}"
+
+
+class TextShoppingListRenderer(ShoppingListRenderer):
+    media_type = "text/plain"
+    format = "txt"
+
+    def stream(self, ingredients):
+        for i, ingredient in enumerate(ingredients):
+            yield (
+                f"{i + 1}. {ingredient['name']} - {ingredient['amount']} "
+                f"{ingredient['measurement_unit']}\n"
+            )
+        yield f"\n{self.footer()}"
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+class CSVShoppingListRenderer(ShoppingListRenderer):
+    media_type = "text/csv"
+    format = "csv"
+
+    def stream(self, ingredients):
+        writer = csv.writer(_Echo())
+        yield writer.writerow(
+            ("Ингредиент", "Количество", "Единица измерения")
+        )
+        for ingredient in ingredients:
+            yield writer.writerow(
+                (
+                    ingredient["name"],
+                    ingredient["amount"],
+                    ingredient["measurement_unit"],
+                )
+            )
+
+
+class PDFShoppingListRenderer(ShoppingListRenderer):
+    media_type = "application/pdf"
+    format = "pdf"
+    charset = None
+
+    font_name = "ShoppingListFont"
+    font_size = 12
+    margin = 50
+    line_height = 18
+
+    def stream(self, ingredients):
+        # reportlab can only write the document as a whole, so pages are
+        # drawn as the rows arrive into a spooled file which is then sent
+        # in chunks instead of being held in memory as a single string.
+        with tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE) as output:
+            self._draw(output, ingredients)
+            output.seek(0)
+            while True:
+                chunk = output.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def _draw(self, output, ingredients):
+        self._register_font()
+        width, height = A4
+        pdf = canvas.Canvas(output, pagesize=A4)
+        pdf.setFont(self.font_name, self.font_size)
+        y = height - self.margin
+
+        for i, ingredient in enumerate(ingredients):
+            if y < self.margin:
+                pdf.showPage()
+                pdf.setFont(self.font_name, self.font_size)
+                y = height - self.margin
+            pdf.drawString(
+                self.margin,
+                y,
+                f"{i + 1}. {ingredient['name']} - {ingredient['amount']} "
+                f"{ingredient['measurement_unit']}",
+            )
+            y -= self.line_height
+
+        pdf.drawString(self.margin, self.margin / 2, self.footer())
+        pdf.save()
+
+    def _register_font(self):
+        if self.font_name not in pdfmetrics.getRegisteredFontNames():
+            pdfmetrics.registerFont(
+                TTFont(self.font_name, settings.SHOPPING_LIST_PDF_FONT)
+            )
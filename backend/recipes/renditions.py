@@ -0,0 +1,157 @@
+"""Resized copies of the recipe images.
+
+Every uploaded image gets a WebP and a JPEG copy in each of the SIZES, so
+lists can send a small file instead of the original upload. The copies are
+generated by a thread pool after the transaction that saved the image
+commits, and their names are recorded in ``Recipe.renditions``::
+
+    {
+        "source": "recipes/<image>",
+        "thumbnail": {"webp": "recipes/renditions/...", "jpeg": "..."},
+        ...
+    }
+
+``source`` is the image the copies were made from, a recipe whose image
+has been replaced since is treated as having no renditions.
+"""
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from PIL import Image, ImageOps
+
+from recipes.cache import (GLOBAL_VERSION_KEY, RECIPES_VERSION_KEY,
+                           bump_version, recipe_version_key)
+
+logger = logging.getLogger(__name__)
+
+# Name and bounding box of every size, images are never enlarged.
+SIZES = {
+    "thumbnail": (160, 160),
+    "card": (480, 480),
+    "full": (1200, 1200),
+}
+FORMATS = {
+    "webp": {"format": "WEBP", "quality": 80, "method": 4},
+    "jpeg": {"format": "JPEG", "quality": 82, "optimize": True},
+}
+DIRECTORY = "recipes/renditions"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def is_current(recipe):
+    return bool(
+        recipe.image
+        and recipe.renditions
+        and recipe.renditions.get("source") == recipe.image.name
+    )
+
+
+def urls(recipe, build_uri=None):
+    """Return the rendition URLs of ``recipe``, or None if there are none.
+
+    ``build_uri`` turns the storage URLs into absolute ones.
+    """
+    if not is_current(recipe):
+        return None
+
+    build_uri = build_uri or (lambda url: url)
+    return {
+        size: {
+            file_format: build_uri(default_storage.url(name))
+            for file_format, name in recipe.renditions[size].items()
+        }
+        for size in SIZES
+    }
+
+
+def schedule(recipe_id, source):
+    """Generate the renditions of ``source`` in the background."""
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.RENDITION_WORKERS,
+                thread_name_prefix="renditions",
+            )
+    _executor.submit(_generate_in_background, source, recipe_id)
+
+
+def generate(source, recipe_id=None, force=False):
+    """Write the renditions of ``source`` and record them on the recipes.
+
+    All recipes still using ``source`` are updated, or just ``recipe_id``
+    when it is given. Files that already exist are reused unless ``force``
+    is set. Returns the number of updated recipes.
+    """
+    renditions = {"source": source}
+
+    image = None
+    for size, box in SIZES.items():
+        renditions[size] = {}
+        for file_format, options in FORMATS.items():
+            name = rendition_name(source, size, file_format)
+            if force:
+                default_storage.delete(name)
+            if not default_storage.exists(name):
+                if image is None:
+                    with default_storage.open(source) as f:
+                        image = ImageOps.exif_transpose(Image.open(f))
+                        image.load()
+                name = _save(image, box, options, name)
+            renditions[size][file_format] = name
+
+    recipes = apps.get_model("recipes", "Recipe").objects.filter(image=source)
+    if recipe_id is not None:
+        recipes = recipes.filter(pk=recipe_id)
+    updated = recipes.update(renditions=renditions)
+
+    # update() sends no signals, the cached fragments are bumped here.
+    if updated and recipe_id is not None:
+        bump_version(recipe_version_key(recipe_id))
+        bump_version(RECIPES_VERSION_KEY)
+    elif updated:
+        bump_version(GLOBAL_VERSION_KEY)
+        bump_version(RECIPES_VERSION_KEY)
+
+    return updated
+
+
+def rendition_name(source, size, file_format):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return f"{DIRECTORY}/{stem}_{size}.{file_format}"
+
+
+def _save(image, box, options, name):
+    resized = image.copy()
+    resized.thumbnail(box, Image.Resampling.LANCZOS)
+    if options["format"] == "JPEG" and resized.mode != "RGB":
+        # JPEG has no transparency, it is flattened onto white.
+        background = Image.new("RGB", resized.size, "white")
+        rgba = resized.convert("RGBA")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        resized = background
+
+    buffer = io.BytesIO()
+    resized.save(buffer, **options)
+    return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def _generate_in_background(source, recipe_id):
+    try:
+        generate(source, recipe_id)
+    except Exception:
+        logger.exception("Could not generate renditions of %s", source)
+    finally:
+        # Pool threads outlive the task, their connection must not.
+        connection.close()
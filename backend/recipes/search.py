@@ -0,0 +1,110 @@
+"""Full-text search over recipe names, descriptions and ingredients.
+
+On PostgreSQL every recipe stores a weighted ``search_vector`` (name A,
+ingredient names B, description C) built with the Russian configuration,
+served by a GIN index and refreshed when the transaction that changed the
+recipe or its ingredients commits. Results are ordered by relevance.
+
+Other databases have no tsvector, they fall back to a case-insensitive
+substring match on the same columns ordered by publication date. SQLite
+ignores the case of ASCII letters only, Cyrillic matches its exact case.
+"""
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connections, transaction
+from django.db.models import F, FloatField, OuterRef, Q, Subquery
+from django.db.models.functions import Cast
+
+from recipes import models
+
+CONFIG = "russian"
+
+
+def search(queryset, query):
+    """Filter ``queryset`` by ``query`` and order it by relevance."""
+    if connections[queryset.db].vendor != "postgresql":
+        return _search_like(queryset, query)
+
+    query = SearchQuery(query, config=CONFIG, search_type="websearch")
+    # ts_rank() returns a real, as a double it survives the round trip
+    # through the pagination cursor unchanged.
+    rank = Cast(SearchRank(F("search_vector"), query), FloatField())
+
+    return (
+        queryset.filter(search_vector=query)
+        .annotate(rank=rank)
+        .order_by("-rank", "-pub_date", "-id")
+    )
+
+
+def update_search_vectors(recipe_ids, using="default"):
+    """Rebuild the search vectors of the recipes with ``recipe_ids``.
+
+    ``recipe_ids`` may be a queryset of ids, which is run as a subquery.
+    """
+    if connections[using].vendor != "postgresql":
+        return
+
+    models.Recipe.objects.using(using).filter(pk__in=recipe_ids).update(
+        search_vector=_vector()
+    )
+
+
+def update_on_commit(recipe_ids, using="default"):
+    """Rebuild the search vectors once the current transaction commits.
+
+    The recipes of a transaction are collected and updated by a single
+    query, however many of their rows were saved.
+    """
+    connection = transaction.get_connection(using)
+    if connection.vendor != "postgresql":
+        return
+    if not connection.in_atomic_block:
+        update_search_vectors(recipe_ids, using)
+        return
+
+    # A batch of a rolled back transaction is dropped with its callbacks.
+    batch = getattr(connection, "search_vector_batch", None)
+    if batch is None or not any(
+        func is batch for _, func in connection.run_on_commit
+    ):
+        batch = connection.search_vector_batch = _Batch(using)
+        transaction.on_commit(batch, using)
+    batch.update(recipe_ids)
+
+
+class _Batch(set):
+    def __init__(self, using):
+        super().__init__()
+        self.using = using
+
+    def __call__(self):
+        update_search_vectors(self, self.using)
+
+
+def _vector():
+    ingredient_names = Subquery(
+        models.IngredientInRecipe.objects.filter(recipe=OuterRef("pk"))
+        .values("recipe")
+        .annotate(names=StringAgg("ingredient__name", " "))
+        .values("names")
+    )
+
+    return (
+        SearchVector("name", weight="A", config=CONFIG)
+        + SearchVector(ingredient_names, weight="B", config=CONFIG)
+        + SearchVector("text", weight="C", config=CONFIG)
+    )
+
+
+def _search_like(queryset, query):
+    with_ingredient = models.IngredientInRecipe.objects.filter(
+        ingredient__name__icontains=query
+    ).values("recipe_id")
+
+    return queryset.filter(
+        Q(name__icontains=query)
+        | Q(text__icontains=query)
+        | Q(pk__in=with_ingredient)
+    )
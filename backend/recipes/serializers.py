@@ -1,14 +1,25 @@
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
 from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import UploadedFile
 from django.core.validators import MinValueValidator
-from django.db import transaction
+from django.db import IntegrityError, models, transaction
+from django.db.models import prefetch_related_objects
 from djoser.serializers import UserCreateSerializer
 from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 from rest_framework.validators import UniqueTogetherValidator
 
-from foodgram.settings import MIN_AMOUNT
-from recipes.models import (Follow, Ingredient, IngredientInRecipe, Recipe,
-                            RecipeInCart, RecipeInFavorite, Tag)
+from foodgram.settings import MAX_BATCH_SIZE, MIN_AMOUNT
+from recipes import cart_totals, renditions
+from recipes.cache import get_fragments, set_fragments
+from recipes.models import (CartTotal, Follow, Ingredient, IngredientInRecipe,
+                            Profile, Recipe, RecipeInCart, RecipeInFavorite,
+                            RecipeQuerySet, Tag)
+from recipes.reference import reference_data
 
 User = get_user_model()
 
@@ -30,12 +41,38 @@ class IngredientSerializer(serializers.ModelSerializer):
         fields = ("id", "name", "measurement_unit", "amount")
         read_only_fields = ("name", "measurement_unit")
 
-    def validate_id(self, id_):
-        if not Ingredient.objects.filter(id=id_).exists():
-            raise serializers.ValidationError(
-                f'Ingredient with id "{id_}" does not exist.'
-            )
-        return id_
+
+class TagField(serializers.PrimaryKeyRelatedField):
+    """Resolves tag ids from the reference data instead of the database."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        try:
+            tag = reference_data.get_tag(int(data))
+        except (TypeError, ValueError):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        if tag is None:
+            self.fail("does_not_exist", pk_value=data)
+
+        return tag
+
+
+class RecipeImageField(Base64ImageField):
+    """Image sent as a base64 string or as a multipart file."""
+
+    def to_internal_value(self, data):
+        if not isinstance(data, UploadedFile):
+            return super().to_internal_value(data)
+
+        image = serializers.ImageField.to_internal_value(self, data)
+        file_format = image.image.format.lower()
+        if file_format not in self.ALLOWED_TYPES:
+            raise serializers.ValidationError(self.INVALID_TYPE_MESSAGE)
+        # Named like the decoded base64 images, not after the client file.
+        image.name = f"{uuid.uuid4()}.{file_format}"
+
+        return image
 
 
 class IngredientInRecipeSerializer(serializers.ModelSerializer):
@@ -56,12 +93,20 @@ class IngredientInRecipeSerializer(serializers.ModelSerializer):
         read_only_fields = ("name", "measurement_unit")
 
 
+class RecipeListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        recipes = data.all() if isinstance(data, models.Manager) else data
+        return self.child.to_representation_many(list(recipes))
+
+
 class RecipeSerializer(serializers.ModelSerializer):
     author = serializers.SerializerMethodField()
-    ingredients = IngredientSerializer(many=True)
+    tags = TagField(many=True, queryset=Tag.objects.all(), write_only=True)
+    ingredients = IngredientSerializer(many=True, write_only=True)
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
-    image = Base64ImageField()
+    image = RecipeImageField()
+    renditions = serializers.SerializerMethodField()
 
     class Meta:
         model = Recipe
@@ -74,12 +119,27 @@ class RecipeSerializer(serializers.ModelSerializer):
             "is_in_shopping_cart",
             "name",
             "image",
+            "renditions",
             "text",
             "cooking_time",
         )
+        # Tags and ingredients are write only, to_representation renders
+        # them from the prefetched rows.
+        list_serializer_class = RecipeListSerializer
 
     def get_author(self, recipe):
-        return UserSerializer(recipe.author, omit=("recipes",)).data
+        author = recipe.author
+        # The count annotated by RecipeQuerySet.with_user_flags is handed
+        # over to the nested serializer so it doesn't query for it again.
+        if getattr(recipe, "author_recipes_count", None) is not None:
+            author.recipes_count = recipe.author_recipes_count
+
+        # is_subscribed is filled in by _personalize, the author is part of
+        # the cached fragment shared by all users.
+        return UserSerializer(author, omit=("recipes",)).data
+
+    def get_renditions(self, recipe):
+        return renditions.urls(recipe)
 
     def get_is_favorited(self, recipe):
         request = self.context.get("request")
@@ -87,6 +147,9 @@ class RecipeSerializer(serializers.ModelSerializer):
         if request is None or request.user.is_anonymous:
             return None
 
+        if hasattr(recipe, "is_favorited"):
+            return recipe.is_favorited
+
         return RecipeInFavorite.objects.filter(
             user=request.user, recipe=recipe
         ).exists()
@@ -97,20 +160,118 @@ class RecipeSerializer(serializers.ModelSerializer):
         if request is None or request.user.is_anonymous:
             return None
 
+        if hasattr(recipe, "is_in_shopping_cart"):
+            return recipe.is_in_shopping_cart
+
         return RecipeInCart.objects.filter(
             user=request.user, recipe=recipe
         ).exists()
 
+    def get_author_is_subscribed(self, recipe):
+        request = self.context.get("request")
+
+        if request is None or request.user.is_anonymous:
+            return None
+
+        if hasattr(recipe, "author_is_subscribed"):
+            return recipe.author_is_subscribed
+
+        return Follow.objects.filter(
+            user=request.user, author_id=recipe.author_id
+        ).exists()
+
     def to_representation(self, instance):
-        representation = super().to_representation(instance)
+        return self.to_representation_many([instance])[0]
+
+    def to_representation_many(self, recipes):
+        """Serialize ``recipes`` through the fragment cache.
 
-        tags = TagSerializer(instance.tags.all(), many=True).data
+        Related rows are only fetched for the recipes that are not cached,
+        the per-user flags are merged into every fragment afterwards.
+        """
+        keys, fragments = get_fragments(recipes)
+
+        missing = [recipe for recipe in recipes if recipe.pk not in fragments]
+        if missing:
+            fresh = self._reload(missing)
+            prefetch_related_objects(
+                missing, "author", *RecipeQuerySet.related_lookups()
+            )
+            rendered = {
+                recipe.pk: self._render_fragment(recipe) for recipe in missing
+            }
+            # A recipe deleted meanwhile is shown as it was read.
+            set_fragments(
+                {
+                    keys[pk]: fragment
+                    for pk, fragment in rendered.items()
+                    if pk in fresh
+                }
+            )
+            fragments.update(rendered)
+
+        return [
+            self._personalize(recipe, fragments[recipe.pk])
+            for recipe in recipes
+        ]
+
+    def _reload(self, recipes):
+        """Read the shown fields of ``recipes`` again, return the ids found.
+
+        The recipes were read before get_fragments() read the versions, a
+        write committed in between would be cached under its new version.
+        Fields read after the versions are at least as new as them.
+        """
+        fields = [
+            field.attname
+            for field in Recipe._meta.concrete_fields
+            if field.name in self.Meta.fields
+        ]
+        rows = {
+            row["id"]: row
+            for row in Recipe.objects.filter(
+                pk__in=[recipe.pk for recipe in recipes]
+            )
+            .with_author_count()
+            .values(*fields, "author_recipes_count")
+        }
+        for recipe in recipes:
+            for name, value in rows.get(recipe.pk, {}).items():
+                setattr(recipe, name, value)
+
+        return rows.keys()
+
+    def _render_fragment(self, recipe):
+        representation = super().to_representation(recipe)
+
+        tags = TagSerializer(recipe.tags.all(), many=True).data
         ingredients = IngredientInRecipeSerializer(
-            instance.ingredientinrecipe_set.prefetch_related("ingredient"),
-            many=True,
+            recipe.ingredientinrecipe_set.all(), many=True
         ).data
         representation["tags"] = tags
         representation["ingredients"] = ingredients
+        representation["image"] = recipe.image.url if recipe.image else None
+
+        return representation
+
+    def _personalize(self, recipe, representation):
+        request = self.context.get("request")
+
+        if request is not None and representation["image"] is not None:
+            representation["image"] = request.build_absolute_uri(
+                representation["image"]
+            )
+        if request is not None and representation["renditions"] is not None:
+            representation["renditions"] = renditions.urls(
+                recipe, request.build_absolute_uri
+            )
+        representation["is_favorited"] = self.get_is_favorited(recipe)
+        representation["is_in_shopping_cart"] = self.get_is_in_shopping_cart(
+            recipe
+        )
+        representation["author"][
+            "is_subscribed"
+        ] = self.get_author_is_subscribed(recipe)
 
         return representation
 
@@ -120,23 +281,42 @@ class RecipeSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(msg)
         return tags
 
+    def validate_ingredients(self, ingredients):
+        counts = Counter(ingredient["id"] for ingredient in ingredients)
+        duplicates = sorted(id_ for id_, count in counts.items() if count > 1)
+        if duplicates:
+            msg = "Ингредиенты не должны повторяться: " + ", ".join(
+                map(str, duplicates)
+            )
+            raise serializers.ValidationError(msg)
+
+        # The process-local reference data may miss a deletion by another
+        # worker, the ids are checked against the database.
+        existing = Ingredient.objects.in_bulk(counts)
+        if existing.keys() != counts.keys():
+            raise serializers.ValidationError(
+                [
+                    {}
+                    if ingredient["id"] in existing
+                    else {
+                        "id": [
+                            f'Ingredient with id "{ingredient["id"]}" '
+                            "does not exist."
+                        ]
+                    }
+                    for ingredient in ingredients
+                ]
+            )
+        return ingredients
+
     def create(self, validated_data):
         tags = validated_data.pop("tags")
         ingredients_data = validated_data.pop("ingredients")
 
-        with transaction.atomic():
+        with _ingredients_saved():
             recipe = super().create(validated_data)
             recipe.tags.set(tags)
-
-            ingredients = []
-            for ingredient in ingredients_data:
-                ing = Ingredient.objects.get(id=ingredient["id"])
-                ing_in_recipe = IngredientInRecipe(
-                    recipe=recipe, ingredient=ing, amount=ingredient["amount"]
-                )
-                ingredients.append(ing_in_recipe)
-
-            IngredientInRecipe.objects.bulk_create(ingredients)
+            self._create_ingredients(recipe, _amounts(ingredients_data))
 
         return recipe
 
@@ -144,25 +324,121 @@ class RecipeSerializer(serializers.ModelSerializer):
         tags = validated_data.pop("tags")
         ingredients_data = validated_data.pop("ingredients")
 
-        with transaction.atomic():
+        with _ingredients_saved():
             instance = super().update(instance, validated_data)
             instance.tags.set(tags)
+            self._update_ingredients(instance, _amounts(ingredients_data))
+
+        return instance
 
-            IngredientInRecipe.objects.filter(recipe=instance).delete()
-            ingredients = []
-            for ingredient in ingredients_data:
-                ing = Ingredient.objects.get(id=ingredient["id"])
-                ingredients.append(
-                    IngredientInRecipe(
-                        recipe=instance,
-                        ingredient=ing,
-                        amount=ingredient["amount"],
+    @staticmethod
+    def _create_ingredients(recipe, amounts):
+        # The ids were validated, there is no need to load the ingredients.
+        IngredientInRecipe.objects.bulk_create(
+            IngredientInRecipe(
+                recipe=recipe, ingredient_id=ingredient_id, amount=amount
+            )
+            for ingredient_id, amount in amounts.items()
+        )
+
+    def _update_ingredients(self, recipe, amounts):
+        """Write only the rows that differ from ``amounts``.
+
+        The number of queries doesn't depend on the number of ingredients:
+        the stored rows are read once, and the removed, changed and added
+        rows are written by one DELETE, UPDATE and INSERT each. Deleting
+        reads the keys of the rows for rows_deleted first. The saved
+        recipe has already invalidated its caches and search vector, which
+        the bulk operations wouldn't do, the changed and added amounts are
+        added to the cart totals explicitly.
+        """
+        removed, changed, deltas = [], [], []
+        stored = set()
+        for row in IngredientInRecipe.objects.filter(recipe=recipe):
+            if row.ingredient_id not in amounts or row.ingredient_id in stored:
+                removed.append(row.pk)
+            elif row.amount != amounts[row.ingredient_id]:
+                deltas.append(
+                    (
+                        recipe.pk,
+                        row.ingredient_id,
+                        amounts[row.ingredient_id] - row.amount,
                     )
                 )
+                row.amount = amounts[row.ingredient_id]
+                changed.append(row)
+            stored.add(row.ingredient_id)
+
+        if removed:
+            IngredientInRecipe.objects.filter(pk__in=removed).delete()
+        if changed:
+            IngredientInRecipe.objects.bulk_update(changed, ("amount",))
+        added = {
+            ingredient_id: amount
+            for ingredient_id, amount in amounts.items()
+            if ingredient_id not in stored
+        }
+        self._create_ingredients(recipe, added)
+        deltas.extend(
+            (recipe.pk, ingredient_id, amount)
+            for ingredient_id, amount in added.items()
+        )
+        cart_totals.change_ingredients(deltas)
 
-            IngredientInRecipe.objects.bulk_create(ingredients)
 
-        return instance
+class ShortRecipeSerializer(serializers.ModelSerializer):
+    renditions = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Recipe
+        fields = ("id", "name", "image", "renditions", "cooking_time")
+        read_only_fields = fields
+
+    def get_renditions(self, recipe):
+        request = self.context.get("request")
+        if request is None:
+            return renditions.urls(recipe)
+
+        return renditions.urls(recipe, request.build_absolute_uri)
+
+
+class CartTotalSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CartTotal
+        fields = ("name", "measurement_unit", "amount")
+        read_only_fields = fields
+
+
+class RecipeBatchSerializer(serializers.Serializer):
+    """Ids of the recipes to add to and to remove from a user's list."""
+
+    add = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        max_length=MAX_BATCH_SIZE,
+        default=list,
+    )
+    remove = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        max_length=MAX_BATCH_SIZE,
+        default=list,
+    )
+
+    def validate(self, data):
+        if not data["add"] and not data["remove"]:
+            raise serializers.ValidationError(
+                "Укажите рецепты в add или remove."
+            )
+
+        both = sorted(set(data["add"]) & set(data["remove"]))
+        if both:
+            msg = (
+                "Рецепт нельзя одновременно добавить и удалить: "
+                + ", ".join(map(str, both))
+            )
+            raise serializers.ValidationError(msg)
+
+        # A repeated id gets a single result.
+        return {key: list(dict.fromkeys(ids)) for key, ids in data.items()}
 
 
 class FollowSerializer(serializers.ModelSerializer):
@@ -235,19 +511,22 @@ class UserSerializer(serializers.ModelSerializer):
         queryset = user.recipes.all()
 
         if request is not None:
-            recipes_limit = request.query_params.get("recipes_limit")
+            recipes_limit = get_recipes_limit(request.query_params)
             if recipes_limit is not None:
-                try:
-                    recipes_limit_int = int(recipes_limit)
-                except ValueError:
-                    pass
-                else:
-                    queryset = queryset[:recipes_limit_int]
+                queryset = queryset[:recipes_limit]
 
         return RecipeSerializer(queryset, many=True, context=self.context).data
 
     def get_recipes_count(self, user):
-        return user.recipes.count()
+        # Annotated from the profile, which users created without signals
+        # don't have until reconcile_counters runs.
+        if getattr(user, "recipes_count", None) is not None:
+            return user.recipes_count
+
+        try:
+            return user.profile.recipes_count
+        except Profile.DoesNotExist:
+            return user.recipes.count()
 
     def get_is_subscribed(self, user):
         request = self.context.get("request")
@@ -255,4 +534,62 @@ class UserSerializer(serializers.ModelSerializer):
         if request is None or request.user.is_anonymous:
             return None
 
+        if hasattr(user, "is_subscribed"):
+            return user.is_subscribed
+
         return Follow.objects.filter(user=request.user, author=user).exists()
+
+
+class SubscriptionSerializer(UserSerializer):
+    """Followed author with compact recipes prefetched by the view."""
+
+    def get_recipes(self, user):
+        return ShortRecipeSerializer(
+            user.newest_recipes, many=True, context=self.context
+        ).data
+
+
+def get_recipes_limit(query_params):
+    """Return the ``recipes_limit`` of a request, None if there is none."""
+    recipes_limit = query_params.get("recipes_limit")
+
+    if recipes_limit is None:
+        return None
+
+    try:
+        recipes_limit = int(recipes_limit)
+    except ValueError:
+        recipes_limit = -1
+    if recipes_limit < 0:
+        raise serializers.ValidationError(
+            {"recipes_limit": "Укажите неотрицательное целое число."}
+        )
+
+    return recipes_limit
+
+
+def _amounts(ingredients_data):
+    return {
+        ingredient["id"]: ingredient["amount"]
+        for ingredient in ingredients_data
+    }
+
+
+@contextmanager
+def _ingredients_saved():
+    """Atomic block that turns a vanished ingredient or tag into a 400.
+
+    The foreign keys are checked when the transaction commits, a row
+    deleted by another request since the validation fails it.
+    """
+    try:
+        with transaction.atomic():
+            yield
+    except IntegrityError:
+        raise serializers.ValidationError(
+            {
+                api_settings.NON_FIELD_ERRORS_KEY: [
+                    "Ингредиент или тег рецепта удалён, повторите запрос."
+                ]
+            }
+        )
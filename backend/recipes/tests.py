@@ -0,0 +1,2216 @@
+import asyncio
+import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock
+
+import psycopg2
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils import timezone
+from PIL import Image
+from psycopg2 import extensions
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+
+from foodgram.async_views import ASGIHandler, async_view
+from foodgram.db.postgresql.pool import ConnectionPool, PoolTimeout
+from foodgram.middleware import QueryInstrumentationMiddleware
+from recipes import (bulk, cart_totals, cleanup, counters, renditions, search,
+                     serializers, views)
+from recipes.cache import (RECIPES_VERSION_KEY, author_version_key,
+                           get_fragments, get_versions)
+from recipes.ingredient_index import ingredient_index
+from recipes.management.commands import benchmark
+from recipes.models import (Follow, Ingredient, IngredientInRecipe, Recipe,
+                            RecipeInCart, RecipeInFavorite, Tag)
+from recipes.pagination import EstimatedCountPaginator, MyPageNumberPagination
+from recipes.reference import reference_data
+from recipes.renditions import FORMATS, SIZES
+from recipes.serializers import RecipeSerializer
+
+User = get_user_model()
+
+IMAGE = "recipes/test.jpg"
+
+
+@override_settings(
+    CACHES={
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+)
+class FoodgramTestCase(TestCase):
+    """Runs against its own cache and ingredient index, never the project's."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.tmp_settings = override_settings(
+            INGREDIENT_INDEX_PATH=str(Path(cls.tmp_dir, "ingredients.bin")),
+            MEDIA_ROOT=cls.tmp_dir,
+        )
+        cls.tmp_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_settings.disable()
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        ingredient_index.rebuild()
+        reference_data.reset()
+        self.client = APIClient()
+
+    @staticmethod
+    def create_user(username):
+        return User.objects.create_user(
+            username=username,
+            email=f"{username}@example.com",
+            password="password",
+            first_name=username,
+            last_name=username,
+        )
+
+    @staticmethod
+    def create_recipe(author, name="Рецепт", ingredients=(), tags=()):
+        """Create a recipe whose renditions need not be generated."""
+        recipe = Recipe.objects.create(
+            author=author,
+            name=name,
+            text="Описание",
+            cooking_time=10,
+            image=IMAGE,
+            renditions={
+                "source": IMAGE,
+                **{size: dict.fromkeys(FORMATS, IMAGE) for size in SIZES},
+            },
+        )
+        IngredientInRecipe.objects.bulk_create(
+            IngredientInRecipe(
+                recipe=recipe, ingredient=ingredient, amount=amount
+            )
+            for ingredient, amount in ingredients
+        )
+        recipe.tags.set(tags)
+
+        return recipe
+
+
+class RecipeQueryCountTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+        cls.reader = cls.create_user("reader")
+        tags = [
+            Tag.objects.create(name=f"Тэг {i}", color="#E26C2D", slug=f"t{i}")
+            for i in range(3)
+        ]
+        ingredients = [
+            Ingredient.objects.create(
+                name=f"Ингредиент {i}", measurement_unit="г"
+            )
+            for i in range(10)
+        ]
+        cls.recipes = [
+            cls.create_recipe(
+                cls.author,
+                f"Рецепт {i}",
+                [(ingredient, 5) for ingredient in ingredients[: i % 10 + 1]],
+                tags[: i % 3 + 1],
+            )
+            for i in range(23)
+        ]
+
+    def test_cold_list_queries_do_not_depend_on_page_size(self):
+        for user in (None, self.reader):
+            self.client.force_authenticate(user)
+            for limit in (3, 23):
+                cache.clear()
+                with self.subTest(user=user, limit=limit):
+                    with self.assertNumQueries(7):
+                        response = self.client.get(
+                            "/api/recipes/", {"limit": limit}
+                        )
+                    self.assertEqual(len(response.json()["results"]), limit)
+
+    def test_cold_detail_queries_do_not_depend_on_related_rows(self):
+        self.client.force_authenticate(self.reader)
+        # One ingredient and tag, then nine ingredients and three tags.
+        for recipe in (self.recipes[0], self.recipes[8]):
+            cache.clear()
+            with self.subTest(recipe=recipe.name):
+                with self.assertNumQueries(7):
+                    response = self.client.get(f"/api/recipes/{recipe.pk}/")
+                self.assertEqual(
+                    len(response.json()["ingredients"]),
+                    recipe.ingredientinrecipe_set.count(),
+                )
+
+    def test_warm_list_reads_no_related_rows(self):
+        self.client.get("/api/recipes/", {"limit": 23})
+
+        with self.assertNumQueries(2):
+            self.client.get(
+                "/api/recipes/", {"limit": 23}, HTTP_IF_NONE_MATCH="stale"
+            )
+
+
+class SubscriptionTests(FoodgramTestCase):
+    url = "/api/users/subscriptions/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = cls.create_user("reader")
+        cls.authors = [cls.create_user(f"author{i}") for i in range(3)]
+        cls.newest = {}
+        for author in cls.authors:
+            recipes = [
+                cls.create_recipe(author, f"Рецепт {i}") for i in range(3)
+            ]
+            cls.newest[author.pk] = [recipe.pk for recipe in recipes[::-1]]
+        for author in cls.authors[:2]:
+            Follow.objects.create(user=cls.reader, author=author)
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.reader)
+
+    def get(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()["results"]
+
+    def test_newest_recipes_are_limited_per_author(self):
+        authors = self.get(recipes_limit=2)
+
+        self.assertEqual(
+            [author["id"] for author in authors],
+            [author.pk for author in self.authors[:2]],
+        )
+        for author in authors:
+            self.assertEqual(author["recipes_count"], 3)
+            self.assertTrue(author["is_subscribed"])
+            self.assertEqual(
+                [recipe["id"] for recipe in author["recipes"]],
+                self.newest[author["id"]][:2],
+            )
+
+    def test_recipes_are_not_limited_by_default(self):
+        for author in self.get():
+            self.assertEqual(len(author["recipes"]), 3)
+
+        for author in self.get(recipes_limit=0):
+            self.assertEqual(author["recipes"], [])
+
+    def test_invalid_limit_is_rejected(self):
+        for recipes_limit in ("-1", "abc", ""):
+            with self.subTest(recipes_limit=recipes_limit):
+                response = self.client.get(
+                    self.url, {"recipes_limit": recipes_limit}
+                )
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("recipes_limit", response.json())
+
+    def test_queries_do_not_depend_on_authors(self):
+        queries = []
+        for author in self.authors[1:]:
+            Follow.objects.get_or_create(user=self.reader, author=author)
+            cache.clear()
+            with CaptureQueriesContext(connection) as context:
+                self.get(recipes_limit=2)
+            queries.append(len(context))
+
+        self.assertEqual(queries[0], queries[1])
+
+
+class ShoppingListTests(FoodgramTestCase):
+    url = "/api/recipes/download_shopping_cart/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.buyer = cls.create_user("buyer")
+        salt = Ingredient.objects.create(name="Соль", measurement_unit="г")
+        flour = Ingredient.objects.create(name="Мука", measurement_unit="кг")
+        cls.recipe = cls.create_recipe(
+            cls.buyer, ingredients=((salt, 5), (flour, 1))
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.buyer)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/api/recipes/{self.recipe.pk}/shopping_cart/")
+
+    def download(self, file_format, content_type):
+        response = self.client.get(self.url, {"format": file_format})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], content_type)
+        self.assertEqual(
+            response["Content-Disposition"],
+            f'attachment; filename="shopping_list.{file_format}"',
+        )
+        return b"".join(response.streaming_content)
+
+    def test_text_list(self):
+        content = self.download("txt", "text/plain; charset=utf-8").decode()
+
+        self.assertTrue(
+            content.startswith("1. Мука - 1000 г\n2. Соль - 5 г\n")
+        )
+
+    def test_csv_list(self):
+        content = self.download("csv", "text/csv; charset=utf-8").decode()
+
+        self.assertEqual(
+            content.splitlines(),
+            [
+                "Ингредиент,Количество,Единица измерения",
+                "Мука,1000,г",
+                "Соль,5,г",
+            ],
+        )
+
+    def test_pdf_list(self):
+        content = self.download("pdf", "application/pdf")
+
+        self.assertTrue(content.startswith(b"%PDF-"))
+        self.assertTrue(content.rstrip().endswith(b"%%EOF"))
+
+    def test_json_list(self):
+        content = self.download("json", "application/json; charset=utf-8")
+
+        self.assertEqual(
+            json.loads(content),
+            [
+                {"name": "Мука", "measurement_unit": "г", "amount": 1000},
+                {"name": "Соль", "measurement_unit": "г", "amount": 5},
+            ],
+        )
+
+    def test_empty_json_list(self):
+        self.client.delete(f"/api/recipes/{self.recipe.pk}/shopping_cart/")
+
+        self.assertEqual(
+            json.loads(
+                self.download("json", "application/json; charset=utf-8")
+            ),
+            [],
+        )
+
+    def test_unknown_format_is_not_found(self):
+        response = self.client.get(self.url, {"format": "xlsx"})
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_anonymous_user_has_no_list(self):
+        self.client.force_authenticate(None)
+
+        response = self.client.get(self.url, {"format": "txt"})
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response["Content-Type"], "application/json")
+
+
+class IngredientSearchTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Ingredient.objects.bulk_create(
+            Ingredient(name=name, measurement_unit="г")
+            for name in ("Сахар", "сахарная пудра", "Соль", "Сыр")
+        )
+
+    def search(self, **params):
+        response = self.client.get("/api/ingredients/", params)
+        self.assertEqual(response.status_code, 200)
+        return [ingredient["name"] for ingredient in response.json()]
+
+    def test_prefix_is_case_insensitive(self):
+        self.assertEqual(self.search(name="сАх"), ["Сахар", "сахарная пудра"])
+
+    def test_empty_query_lists_nothing(self):
+        self.assertEqual(self.search(), [])
+        self.assertEqual(self.search(name=" "), [])
+
+    @override_settings(INGREDIENT_SEARCH_LIMIT=2)
+    def test_results_are_limited(self):
+        self.assertEqual(self.search(name="с"), ["Сахар", "сахарная пудра"])
+
+    def test_catalog_change_replaces_snapshot(self):
+        self.search(name="с")
+        with self.captureOnCommitCallbacks() as callbacks:
+            for name in ("Сода", "Сок"):
+                Ingredient.objects.create(name=name, measurement_unit="г")
+        # The lookups of other workers keep reading the old snapshot.
+        self.assertTrue(Path(ingredient_index.path).exists())
+
+        rebuilds = [
+            func for func in callbacks if func == ingredient_index.rebuild
+        ]
+        self.assertEqual(len(rebuilds), 1)
+        rebuilds[0]()
+        self.assertEqual(self.search(name="со"), ["Сода", "Сок", "Соль"])
+
+    def test_missing_snapshot_is_rebuilt(self):
+        Path(ingredient_index.path).unlink()
+
+        self.assertEqual(self.search(name="сы"), ["Сыр"])
+
+
+class FragmentCacheTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+        cls.reader = cls.create_user("reader")
+        cls.tag = Tag.objects.create(
+            name="Завтрак", color="#E26C2D", slug="breakfast"
+        )
+        cls.salt = Ingredient.objects.create(name="Соль", measurement_unit="г")
+        cls.recipe = cls.create_recipe(
+            cls.author, ingredients=((cls.salt, 5),), tags=(cls.tag,)
+        )
+
+    def get_recipe(self, user=None):
+        self.client.force_authenticate(user)
+        response = self.client.get(f"/api/recipes/{self.recipe.pk}/")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_fragment_is_cached(self):
+        self.get_recipe()
+        _, fragments = get_fragments([self.recipe])
+        self.assertIn(self.recipe.pk, fragments)
+
+    def test_recipe_change_invalidates_fragment(self):
+        self.get_recipe()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipe.name = "Новое название"
+            self.recipe.save()
+
+        self.assertEqual(self.get_recipe()["name"], "Новое название")
+
+    def test_ingredient_change_invalidates_fragment(self):
+        self.get_recipe()
+        with self.captureOnCommitCallbacks(execute=True):
+            row = self.recipe.ingredientinrecipe_set.get()
+            row.amount = 7
+            row.save()
+
+        self.assertEqual(self.get_recipe()["ingredients"][0]["amount"], 7)
+
+    def test_tag_change_invalidates_fragment(self):
+        self.get_recipe()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipe.tags.clear()
+
+        self.assertEqual(self.get_recipe()["tags"], [])
+
+    def test_tag_rename_invalidates_fragment(self):
+        self.get_recipe()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tag.name = "Обед"
+            self.tag.save()
+
+        self.assertEqual(self.get_recipe()["tags"][0]["name"], "Обед")
+
+    def test_author_change_invalidates_fragment(self):
+        self.get_recipe()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author.first_name = "Иван"
+            self.author.save()
+
+        self.assertEqual(self.get_recipe()["author"]["first_name"], "Иван")
+
+    def test_other_user_changes_keep_fragments(self):
+        self.get_recipe()
+        keys = (RECIPES_VERSION_KEY, author_version_key(self.author.pk))
+        versions = get_versions(keys)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_user("newcomer")
+            self.author.set_password("new password")
+            self.author.save()
+            self.author.last_login = timezone.now()
+            self.author.save(update_fields=("last_login",))
+
+        self.assertEqual(get_versions(keys), versions)
+        _, fragments = get_fragments([self.recipe])
+        self.assertIn(self.recipe.pk, fragments)
+
+    def test_write_committed_while_rendering_is_not_cached_stale(self):
+        def write_then_get_fragments(recipes):
+            # Commits after the recipe was read, before the versions are.
+            with self.captureOnCommitCallbacks(execute=True):
+                self.recipe.name = "Новое название"
+                self.recipe.save()
+            return get_fragments(recipes)
+
+        with mock.patch.object(
+            serializers, "get_fragments", side_effect=write_then_get_fragments
+        ):
+            self.get_recipe()
+
+        self.assertEqual(self.get_recipe()["name"], "Новое название")
+
+    def test_user_flags_are_not_shared(self):
+        RecipeInFavorite.objects.create(user=self.reader, recipe=self.recipe)
+
+        self.assertTrue(self.get_recipe(self.reader)["is_favorited"])
+        self.assertFalse(self.get_recipe(self.author)["is_favorited"])
+        self.assertIsNone(self.get_recipe()["is_favorited"])
+
+
+class SeedTests(FoodgramTestCase):
+    def seed(self, **options):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("seed", stdout=StringIO(), **options)
+
+    def test_generated_dataset_is_reconciled(self):
+        self.seed(users=4, recipes=6, favorites_per_user=2, carts_per_user=1)
+
+        self.assertEqual(User.objects.count(), 4)
+        self.assertEqual(Recipe.objects.count(), 6)
+        self.assertFalse(counters.find_drift(counters.RECIPE_FAVORITES))
+        self.assertFalse(counters.find_drift(counters.AUTHOR_RECIPES))
+        self.assertEqual(RecipeInCart.objects.count(), 4)
+        self.assertTrue(
+            User.objects.filter(cart_totals__isnull=False).exists()
+        )
+        if connection.vendor == "postgresql":
+            self.assertFalse(
+                Recipe.objects.filter(search_vector=None).exists()
+            )
+
+    def test_generated_dataset_invalidates_cached_lists(self):
+        self.seed(users=2, recipes=1)
+        etag = self.client.get("/api/recipes/")["ETag"]
+        versions = get_versions((RECIPES_VERSION_KEY,))
+
+        self.seed(users=2, recipes=1)
+        response = self.client.get("/api/recipes/", HTTP_IF_NONE_MATCH=etag)
+
+        self.assertNotEqual(get_versions((RECIPES_VERSION_KEY,)), versions)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["results"][0]["id"], Recipe.objects.latest("pk").pk
+        )
+
+
+class ImportIngredientsTests(FoodgramTestCase):
+    def import_file(self, suffix, content):
+        path = Path(self.tmp_dir, f"ingredients{suffix}")
+        path.write_text(content, encoding="utf-8")
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("import_ingredients", path, stdout=out)
+        return out.getvalue().strip()
+
+    def catalog(self):
+        return set(Ingredient.objects.values_list("name", "measurement_unit"))
+
+    def test_csv_is_deduplicated_case_insensitively(self):
+        result = self.import_file(
+            ".csv",
+            "name,measurement_unit\nСоль,г\nсоль,г\nСахар,г\n,г\n",
+        )
+
+        self.assertEqual(result, "Inserted 2, updated 0, skipped 2")
+        self.assertEqual(self.catalog(), {("Соль", "г"), ("Сахар", "г")})
+
+    def test_import_is_idempotent(self):
+        self.import_file(".csv", "Соль,г\nСахар,г\n")
+        result = self.import_file(".csv", "Соль,г\nСахар,г\n")
+
+        self.assertEqual(result, "Inserted 0, updated 0, skipped 2")
+
+    def test_case_change_renames_ingredient(self):
+        salt = Ingredient.objects.create(name="соль", measurement_unit="г")
+        user = self.create_user("buyer")
+        recipe = self.create_recipe(user, ingredients=((salt, 5),))
+        RecipeInCart.objects.bulk_create(
+            (RecipeInCart(user=user, recipe=recipe),)
+        )
+        cart_totals.rebuild([user.pk])
+
+        result = self.import_file(".csv", "Соль,г\nСОЛЬ,г\n")
+
+        self.assertEqual(result, "Inserted 0, updated 1, skipped 1")
+        self.assertEqual(self.catalog(), {("Соль", "г")})
+        self.assertEqual(
+            list(user.cart_totals.values_list("name", "amount")),
+            [("Соль", 5)],
+        )
+
+    def test_json_items_that_are_not_objects_are_skipped(self):
+        items = [
+            {"name": "Соль", "measurement_unit": "г"},
+            "Сахар",
+            None,
+            {"name": "Мука", "measurement_unit": "г"},
+        ]
+        result = self.import_file(".json", json.dumps(items))
+
+        self.assertEqual(result, "Inserted 2, updated 0, skipped 2")
+        self.assertEqual(self.catalog(), {("Соль", "г"), ("Мука", "г")})
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+class IngredientCaseMigrationTests(TransactionTestCase):
+    migrate_from = [("recipes", "0013_carttotal")]
+    migrate_to = [("recipes", "0014_ingredient_unique_ingredient_lower")]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        self.apps = executor.loader.project_state(self.migrate_from).apps
+
+    def tearDown(self):
+        # Duplicates left over would stop the migration.
+        self.apps.get_model("recipes", "Ingredient").objects.all().delete()
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def migrate(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(self.migrate_to)
+
+        return executor.loader.project_state(self.migrate_to).apps
+
+    def create_duplicates(self, amount):
+        ingredient_model = self.apps.get_model("recipes", "Ingredient")
+        ingredient_in_recipe_model = self.apps.get_model(
+            "recipes", "IngredientInRecipe"
+        )
+        recipe_model = self.apps.get_model("recipes", "Recipe")
+        recipe_in_cart_model = self.apps.get_model("recipes", "RecipeInCart")
+        user_model = self.apps.get_model("auth", "User")
+
+        user = user_model.objects.create(username="buyer", email="buyer@a.ru")
+        salt, lower_salt, upper_salt = (
+            ingredient_model.objects.create(name=name, measurement_unit="г")
+            for name in ("Соль", "соль", "СОЛЬ")
+        )
+        both, one = (
+            recipe_model.objects.create(
+                author=user, name=name, image=IMAGE, text="", cooking_time=1
+            )
+            for name in ("Оба", "Один")
+        )
+        ingredient_in_recipe_model.objects.bulk_create(
+            (
+                ingredient_in_recipe_model(
+                    recipe=both, ingredient=salt, amount=300
+                ),
+                ingredient_in_recipe_model(
+                    recipe=both, ingredient=lower_salt, amount=amount
+                ),
+                ingredient_in_recipe_model(
+                    recipe=one, ingredient=upper_salt, amount=7
+                ),
+            )
+        )
+        recipe_in_cart_model.objects.create(user=user, recipe=one)
+
+        return salt, both, one
+
+    def test_case_duplicates_stop_the_migration(self):
+        self.create_duplicates(5)
+
+        with self.assertRaisesMessage(
+            RuntimeError, "merge_ingredient_duplicates"
+        ):
+            self.migrate()
+
+    def test_case_duplicates_are_merged(self):
+        salt, both, one = self.create_duplicates(5)
+
+        call_command("merge_ingredient_duplicates", stdout=StringIO())
+        apps = self.migrate()
+
+        ingredient_model = apps.get_model("recipes", "Ingredient")
+        ingredient_in_recipe_model = apps.get_model(
+            "recipes", "IngredientInRecipe"
+        )
+        cart_total_model = apps.get_model("recipes", "CartTotal")
+        self.assertEqual(
+            list(ingredient_model.objects.values_list("pk", flat=True)),
+            [salt.pk],
+        )
+        self.assertEqual(
+            set(
+                ingredient_in_recipe_model.objects.values_list(
+                    "recipe", "ingredient", "amount"
+                )
+            ),
+            {(both.pk, salt.pk, 305), (one.pk, salt.pk, 7)},
+        )
+        self.assertEqual(
+            list(cart_total_model.objects.values_list("name", "amount")),
+            [("Соль", 7)],
+        )
+
+    def test_overflowing_amounts_are_not_merged(self):
+        _, both, _ = self.create_duplicates(32500)
+
+        with self.assertRaisesMessage(
+            CommandError, f"recipe {both.pk}, ingredient"
+        ):
+            call_command("merge_ingredient_duplicates", stdout=StringIO())
+
+        ingredient_model = self.apps.get_model("recipes", "Ingredient")
+        self.assertEqual(ingredient_model.objects.count(), 3)
+
+
+class BenchmarkCompareTests(SimpleTestCase):
+    baseline = {"recipe list": {"p95_ms": 10.0, "queries": 2}}
+
+    def compare(self, result, **kwargs):
+        command = benchmark.Command(stdout=StringIO())
+        command._compare({"recipe list": result}, self.baseline, **kwargs)
+
+    def test_more_queries_fail(self):
+        with self.assertRaisesMessage(CommandError, "3 queries"):
+            self.compare({"p95_ms": 10.0, "queries": 3})
+
+    def test_latency_is_compared_on_request_only(self):
+        slow = {"p95_ms": 100.0, "queries": 2}
+        self.compare(slow)
+
+        with self.assertRaisesMessage(CommandError, "p95 100.0 ms"):
+            self.compare(slow, tolerance=0.25)
+
+
+class ConditionalGetTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+        cls.recipe = cls.create_recipe(cls.author)
+        cls.url = f"/api/recipes/{cls.recipe.pk}/"
+
+    def test_unchanged_recipe_is_not_modified(self):
+        etag = self.client.get(self.url)["ETag"]
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_changed_recipe_gets_new_etag(self):
+        etag = self.client.get(self.url)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipe.name = "Новое название"
+            self.recipe.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_etag_depends_on_user(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.client.force_authenticate(self.author)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_missing_recipe_is_not_found(self):
+        for pk in (self.recipe.pk + 1, "abc"):
+            with self.subTest(pk=pk):
+                response = self.client.get(f"/api/recipes/{pk}/")
+                self.assertEqual(response.status_code, 404)
+                self.assertNotIn("ETag", response)
+
+
+class RenditionTests(FoodgramTestCase):
+    SOURCE = "recipes/source.png"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+
+    def setUp(self):
+        super().setUp()
+        path = Path(self.tmp_dir, self.SOURCE)
+        path.parent.mkdir(exist_ok=True)
+        Image.new("RGBA", (800, 400), (255, 0, 0, 128)).save(path)
+        self.recipe = self.create_recipe(self.author)
+        Recipe.objects.filter(pk=self.recipe.pk).update(
+            image=self.SOURCE, renditions={}
+        )
+        self.recipe.refresh_from_db()
+
+    def test_every_size_and_format_is_written(self):
+        self.assertIsNone(renditions.urls(self.recipe))
+
+        self.assertEqual(renditions.generate(self.SOURCE), 1)
+
+        self.recipe.refresh_from_db()
+        urls = renditions.urls(self.recipe)
+        # Images are scaled into the box and never enlarged.
+        expected = {"thumbnail": (160, 80), "card": (480, 240)}
+        for size in SIZES:
+            for file_format, options in FORMATS.items():
+                with self.subTest(size=size, format=file_format):
+                    name = self.recipe.renditions[size][file_format]
+                    with default_storage.open(name) as f:
+                        image = Image.open(f)
+                        image.load()
+                    self.assertEqual(image.format, options["format"])
+                    self.assertEqual(
+                        image.size, expected.get(size, (800, 400))
+                    )
+                    self.assertEqual(
+                        urls[size][file_format], default_storage.url(name)
+                    )
+
+    def test_jpeg_is_flattened_onto_white(self):
+        renditions.generate(self.SOURCE)
+
+        self.recipe.refresh_from_db()
+        name = self.recipe.renditions["card"]["jpeg"]
+        with default_storage.open(name) as f:
+            image = Image.open(f)
+            image.load()
+        self.assertEqual(image.mode, "RGB")
+        red, green, blue = image.getpixel((0, 0))
+        self.assertGreater(min(green, blue), 100)
+
+    def test_existing_files_are_reused(self):
+        renditions.generate(self.SOURCE)
+        name = renditions.rendition_name(self.SOURCE, "card", "webp")
+        default_storage.delete(self.SOURCE)
+
+        self.assertEqual(renditions.generate(self.SOURCE), 1)
+        self.assertTrue(default_storage.exists(name))
+
+    def test_replaced_image_has_no_renditions(self):
+        renditions.generate(self.SOURCE)
+        self.recipe.refresh_from_db()
+
+        with mock.patch.object(
+            renditions, "schedule"
+        ) as schedule, mock.patch.object(cleanup, "_enqueue"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.recipe.image = "recipes/other.png"
+                self.recipe.save()
+
+        self.assertIsNone(renditions.urls(self.recipe))
+        schedule.assert_called_once_with(self.recipe.pk, "recipes/other.png")
+
+    def test_generation_invalidates_recipe(self):
+        url = f"/api/recipes/{self.recipe.pk}/"
+        self.assertIsNone(self.client.get(url).json()["renditions"])
+
+        renditions.generate(self.SOURCE, self.recipe.pk)
+
+        self.assertEqual(
+            set(self.client.get(url).json()["renditions"]), set(SIZES)
+        )
+
+
+class MultipartUploadTests(FoodgramTestCase):
+    url = "/api/recipes/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+        cls.tag = Tag.objects.create(
+            name="Завтрак", color="#E26C2D", slug="breakfast"
+        )
+        cls.salt = Ingredient.objects.create(name="Соль", measurement_unit="г")
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.author)
+
+    @staticmethod
+    def image(file_format="PNG", name="photo.png"):
+        buffer = BytesIO()
+        Image.new("RGB", (40, 20), "red").save(buffer, file_format)
+        return SimpleUploadedFile(name, buffer.getvalue())
+
+    def form(self, **fields):
+        return {
+            "name": "Омлет",
+            "text": "Описание",
+            "cooking_time": 10,
+            "tags": json.dumps([self.tag.pk]),
+            "ingredients": json.dumps([{"id": self.salt.pk, "amount": 5}]),
+            "image": self.image(),
+            **fields,
+        }
+
+    def post(self, **fields):
+        return self.client.post(
+            self.url, self.form(**fields), format="multipart"
+        )
+
+    def test_recipe_is_created_from_form(self):
+        response = self.post()
+
+        self.assertEqual(response.status_code, 201, response.content)
+        recipe = Recipe.objects.get(pk=response.json()["id"])
+        self.assertEqual(list(recipe.tags.all()), [self.tag])
+        self.assertEqual(
+            list(recipe.ingredientinrecipe_set.values_list("amount")), [(5,)]
+        )
+        # Stored under a generated name, not the one sent by the client.
+        self.assertRegex(recipe.image.name, r"^recipes/[0-9a-f-]{36}\.png$")
+        with recipe.image.open() as f:
+            self.assertEqual(Image.open(f).size, (40, 20))
+
+    def test_image_can_be_replaced_with_patch(self):
+        recipe = Recipe.objects.get(pk=self.post().json()["id"])
+
+        response = self.client.patch(
+            f"{self.url}{recipe.pk}/",
+            self.form(image=self.image("JPEG", "photo.jpg")),
+            format="multipart",
+        )
+
+        self.assertEqual(response.status_code, 200, response.content)
+        recipe.refresh_from_db()
+        self.assertTrue(recipe.image.name.endswith(".jpeg"))
+
+    def test_invalid_json_field_is_rejected(self):
+        response = self.post(ingredients="[{")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("ingredients", response.json()["detail"])
+
+    def test_file_that_is_not_an_image_is_rejected(self):
+        response = self.post(
+            image=SimpleUploadedFile("photo.png", b"not an image")
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("image", response.json())
+
+    def test_rejected_upload_is_removed(self):
+        upload_dir = Path(self.tmp_dir, "uploads")
+        upload_dir.mkdir()
+        with override_settings(FILE_UPLOAD_TEMP_DIR=str(upload_dir)):
+            response = self.post(cooking_time=0)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(upload_dir.iterdir()), [])
+
+    def test_image_format_is_checked(self):
+        response = self.post(image=self.image("BMP", "photo.bmp"))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("image", response.json())
+
+    def test_large_file_is_rejected(self):
+        with override_settings(UPLOAD_MAX_SIZE=10):
+            response = self.post()
+
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Recipe.objects.exists())
+
+
+class MediaCleanupTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+
+    def setUp(self):
+        super().setUp()
+        shutil.rmtree(Path(self.tmp_dir, "recipes"), ignore_errors=True)
+
+    def write(self, *names, age=7200):
+        for name in names:
+            path = Path(self.tmp_dir, name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b"image")
+            mtime = time.time() - age
+            os.utime(path, (mtime, mtime))
+
+    def files(self):
+        root = Path(self.tmp_dir, "recipes")
+        return sorted(
+            str(path.relative_to(self.tmp_dir))
+            for path in root.rglob("*")
+            if path.is_file()
+        )
+
+    def test_files_are_deleted_after_commit(self):
+        recipe = self.create_recipe(self.author)
+
+        with mock.patch.object(cleanup, "_enqueue") as enqueue:
+            with self.captureOnCommitCallbacks() as callbacks:
+                recipe.delete()
+            enqueue.assert_not_called()
+            for callback in callbacks:
+                callback()
+
+        enqueue.assert_called_once_with(IMAGE, [IMAGE] * 6)
+
+    def test_replaced_image_is_deleted(self):
+        recipe = self.create_recipe(self.author)
+
+        with mock.patch.object(cleanup, "_enqueue") as enqueue, mock.patch(
+            "recipes.renditions.schedule"
+        ):
+            with self.captureOnCommitCallbacks(execute=True):
+                recipe.image = "recipes/other.jpg"
+                recipe.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                recipe.name = "Новое название"
+                recipe.save()
+
+        enqueue.assert_called_once_with(IMAGE, [IMAGE] * 6)
+
+    def test_shared_image_is_kept(self):
+        self.create_recipe(self.author)
+        unused = ("recipes/unused.jpg", ["recipes/renditions/unused.jpg"])
+        self.write(IMAGE, unused[0], *unused[1])
+
+        deleted = cleanup.delete_unused([(IMAGE, []), unused])
+
+        self.assertEqual(deleted, 1)
+        self.assertEqual(self.files(), [IMAGE])
+
+    def test_orphaned_files_are_collected(self):
+        self.create_recipe(self.author)
+        kept = [
+            IMAGE,
+            "recipes/renditions/test_card.webp",
+            "recipes/recent.jpg",
+        ]
+        self.write(*kept[:2])
+        self.write(kept[2], age=0)
+        self.write("recipes/orphan.jpg", "recipes/renditions/orphan_card.webp")
+
+        out = StringIO()
+        call_command("collect_orphaned_media", "--dry-run", stdout=out)
+        self.assertEqual(len(self.files()), 5)
+        self.assertIn("Would delete 2 of 4 files", out.getvalue())
+
+        call_command(
+            "collect_orphaned_media", "--rate", "0", "--batch-size", "1",
+            stdout=StringIO(),
+        )
+        self.assertEqual(self.files(), sorted(kept))
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+class RecipeSearchTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+        cls.tomato = Ingredient.objects.create(
+            name="Томаты", measurement_unit="г"
+        )
+        cls.cheese = Ingredient.objects.create(
+            name="Сыр", measurement_unit="г"
+        )
+        cls.salad = cls.create_recipe(
+            cls.author, "Салат из томатов", ((cls.tomato, 200),)
+        )
+        cls.pizza = cls.create_recipe(
+            cls.author, "Пицца", ((cls.tomato, 100), (cls.cheese, 50))
+        )
+        cls.soup = cls.create_recipe(cls.author, "Суп")
+        Recipe.objects.filter(pk=cls.soup.pk).update(
+            text="Подавать с томатами и зеленью."
+        )
+        cls.omelette = cls.create_recipe(cls.author, "Омлет")
+        search.update_search_vectors(Recipe.objects.values("pk"))
+
+    def setUp(self):
+        super().setUp()
+        # The on-commit callbacks of setUpTestData are never run nor
+        # dropped, their batch must not swallow the recipes of a test.
+        connection.search_vector_batch = None
+
+    def search(self, query):
+        response = self.client.get("/api/recipes/", {"search": query})
+        self.assertEqual(response.status_code, 200)
+        return [recipe["id"] for recipe in response.json()["results"]]
+
+    def test_results_are_ranked_by_field(self):
+        # Name, then ingredients, then description, the word in any form.
+        self.assertEqual(
+            self.search("томат"),
+            [self.salad.pk, self.pizza.pk, self.soup.pk],
+        )
+
+    def test_web_search_syntax_is_supported(self):
+        self.assertCountEqual(
+            self.search("томат -сыр"), [self.salad.pk, self.soup.pk]
+        )
+        self.assertEqual(self.search('"салат из томатов"'), [self.salad.pk])
+
+    def test_blank_query_lists_every_recipe(self):
+        self.assertEqual(len(self.search("  ")), 4)
+
+    def test_text_change_is_searchable_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.omelette.text = "Добавить тёртый сыр."
+            self.omelette.save()
+
+        self.assertEqual(
+            self.search("сыр"), [self.pizza.pk, self.omelette.pk]
+        )
+
+    def test_ingredient_rename_is_searchable_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cheese.name = "Моцарелла"
+            self.cheese.save()
+
+        self.assertEqual(self.search("моцарелла"), [self.pizza.pk])
+        self.assertEqual(self.search("сыр"), [])
+
+    def test_vectors_of_a_transaction_are_updated_at_once(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            for recipe in (self.soup, self.omelette):
+                recipe.name = f"{recipe.name} с сыром"
+                recipe.save()
+
+        batches = [
+            callback
+            for callback in callbacks
+            if callback is connection.search_vector_batch
+        ]
+        self.assertEqual(len(batches), 1)
+        with self.assertNumQueries(1):
+            batches[0]()
+        self.assertEqual(
+            self.search("сыр"),
+            [self.omelette.pk, self.soup.pk, self.pizza.pk],
+        )
+
+
+class AdminTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(
+            username="admin", email="admin@example.com", password="password"
+        )
+        cls.author = cls.create_user("author")
+        cls.ingredients = [
+            Ingredient.objects.create(
+                name=f"Ингредиент {i}", measurement_unit="г"
+            )
+            for i in range(20)
+        ]
+        cls.few = cls.create_recipe(
+            cls.author, "Борщ", [(cls.ingredients[0], 5)]
+        )
+        cls.many = cls.create_recipe(
+            cls.author,
+            "Солянка",
+            [(ingredient, 5) for ingredient in cls.ingredients[:10]],
+        )
+        search.update_search_vectors(Recipe.objects.values("pk"))
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.admin)
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+    def test_ingredient_differing_in_case_is_rejected(self):
+        response = self.client.post(
+            "/admin/recipes/ingredient/add/",
+            {"name": "ИНГРЕДИЕНТ 0", "measurement_unit": "Г"},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "уже существует")
+        self.assertEqual(Ingredient.objects.count(), 20)
+
+    def test_change_lists_open(self):
+        for model in (
+            Recipe,
+            Ingredient,
+            IngredientInRecipe,
+            RecipeInCart,
+            RecipeInFavorite,
+            Follow,
+            Tag,
+        ):
+            url = f"/admin/recipes/{model._meta.model_name}/"
+            with self.subTest(model=model.__name__):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_recipe_page_does_not_list_ingredients(self):
+        # Caches the content types.
+        self.client.get(f"/admin/recipes/recipe/{self.few.pk}/change/")
+        queries = []
+        for recipe in (self.few, self.many):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(
+                    f"/admin/recipes/recipe/{recipe.pk}/change/"
+                )
+            self.assertEqual(response.status_code, 200)
+            queries.append(len(context))
+
+        self.assertEqual(queries[0], queries[1])
+        # Only the chosen ingredients are rendered, not the catalog.
+        self.assertContains(
+            response, f'value="{self.ingredients[9].pk}" selected'
+        )
+        self.assertNotContains(response, self.ingredients[15].name)
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+    def test_recipes_are_searched_by_text_and_author(self):
+        for term, expected in (
+            ("солянки", [self.many.pk]),
+            ("author", [self.many.pk, self.few.pk]),
+        ):
+            with self.subTest(term=term):
+                response = self.client.get(
+                    "/admin/recipes/recipe/", {"q": term}
+                )
+                self.assertEqual(
+                    [
+                        recipe.pk
+                        for recipe in response.context["cl"].result_list
+                    ],
+                    expected,
+                )
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+    def test_big_unfiltered_table_is_estimated(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE recipes_ingredientinrecipe")
+        queryset = IngredientInRecipe.objects.order_by("pk")
+
+        with mock.patch.object(EstimatedCountPaginator, "threshold", 5):
+            with CaptureQueriesContext(connection) as context:
+                estimated = EstimatedCountPaginator(queryset, 10).count
+            filtered = EstimatedCountPaginator(
+                queryset.filter(recipe=self.few), 10
+            ).count
+
+        self.assertEqual((estimated, filtered), (11, 1))
+        self.assertEqual(len(context), 1)
+        self.assertIn("pg_class", context[0]["sql"])
+
+
+def image_data():
+    buffer = BytesIO()
+    Image.new("RGB", (40, 20), "red").save(buffer, "PNG")
+    return "data:image/png;base64," + base64.b64encode(
+        buffer.getvalue()
+    ).decode()
+
+
+class RecipeWriteTests(FoodgramTestCase):
+    url = "/api/recipes/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+        cls.tag = Tag.objects.create(
+            name="Завтрак", color="#E26C2D", slug="breakfast"
+        )
+        cls.ingredients = [
+            Ingredient.objects.create(
+                name=f"Ингредиент {i}", measurement_unit="г"
+            )
+            for i in range(12)
+        ]
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.author)
+        # Loads the reference data before the queries are counted.
+        reference_data.tags()
+
+    def data(self, amounts):
+        return {
+            "name": "Омлет",
+            "text": "Описание",
+            "cooking_time": 10,
+            "tags": [self.tag.pk],
+            "ingredients": [
+                {"id": ingredient.pk, "amount": amount}
+                for ingredient, amount in amounts
+            ],
+            "image": image_data(),
+        }
+
+    def amounts(self, recipe):
+        return dict(
+            recipe.ingredientinrecipe_set.values_list(
+                "ingredient_id", "amount"
+            )
+        )
+
+    def test_deleted_ingredient_is_rejected(self):
+        salt = self.ingredients[0]
+        # Loaded by this process before another one deletes the ingredient.
+        self.assertTrue(reference_data.has_ingredient(salt.pk))
+        Ingredient.objects.filter(pk=salt.pk).delete()
+
+        response = self.client.post(
+            self.url,
+            self.data([(self.ingredients[1], 5), (salt, 5)]),
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["ingredients"][0], {})
+        self.assertIn("id", response.json()["ingredients"][1])
+
+    def test_create_queries_do_not_depend_on_ingredients(self):
+        queries = []
+        for count in (2, 12):
+            data = self.data((i, 5) for i in self.ingredients[:count])
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(self.url, data, format="json")
+            self.assertEqual(response.status_code, 201, response.content)
+            queries.append(len(context))
+
+        self.assertEqual(queries[0], queries[1])
+
+    def test_update_queries_do_not_depend_on_ingredients(self):
+        queries = []
+        for count in (3, 11):
+            stored = self.ingredients[:count]
+            recipe = self.create_recipe(
+                self.author, ingredients=[(i, 5) for i in stored]
+            )
+            # The first amount changes, the second row is removed and an
+            # ingredient is added, the others stay the same.
+            amounts = [(stored[0], 7), *[(i, 5) for i in stored[2:]]]
+            amounts.append((self.ingredients[count], 3))
+
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.patch(
+                    f"{self.url}{recipe.pk}/",
+                    self.data(amounts),
+                    format="json",
+                )
+            self.assertEqual(response.status_code, 200, response.content)
+            queries.append(len(context))
+            self.assertEqual(
+                self.amounts(recipe),
+                {ingredient.pk: amount for ingredient, amount in amounts},
+            )
+
+        self.assertEqual(queries[0], queries[1])
+
+
+@override_settings(
+    CACHES={
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+)
+class RecipeWriteRaceTests(TransactionTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir, ignore_errors=True)
+        tmp_settings = override_settings(
+            INGREDIENT_INDEX_PATH=str(Path(tmp_dir, "ingredients.bin")),
+            MEDIA_ROOT=tmp_dir,
+        )
+        tmp_settings.enable()
+        self.addCleanup(tmp_settings.disable)
+        schedule = mock.patch.object(renditions, "schedule")
+        schedule.start()
+        self.addCleanup(schedule.stop)
+        reference_data.reset()
+
+    def test_ingredient_deleted_before_commit_is_rejected(self):
+        author = FoodgramTestCase.create_user("author")
+        tag = Tag.objects.create(name="Обед", color="#E26C2D", slug="lunch")
+        salt = Ingredient.objects.create(name="Соль", measurement_unit="г")
+        serializer = RecipeSerializer(
+            data={
+                "name": "Омлет",
+                "text": "Описание",
+                "cooking_time": 10,
+                "tags": [tag.pk],
+                "ingredients": [{"id": salt.pk, "amount": 5}],
+                "image": image_data(),
+            }
+        )
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        # Deleted by another request between the validation and the save.
+        salt.delete()
+
+        with self.assertRaises(ValidationError):
+            serializer.save(author=author)
+        self.assertFalse(Recipe.objects.exists())
+
+
+class DeletionTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+        cls.salt = Ingredient.objects.create(name="Соль", measurement_unit="г")
+        cls.recipes = [
+            cls.create_recipe(
+                cls.author, f"Рецепт {i}", ingredients=((cls.salt, 5),)
+            )
+            for i in range(10)
+        ]
+
+    @staticmethod
+    def mark(user, recipes):
+        """Favorite and cart ``recipes`` without the receivers."""
+        for model in (RecipeInFavorite, RecipeInCart):
+            model.objects.bulk_create(
+                model(user=user, recipe=recipe) for recipe in recipes
+            )
+        counters.reconcile(counters.RECIPE_FAVORITES)
+        counters.reconcile(counters.RECIPE_CARTS)
+        cart_totals.rebuild([user.pk])
+
+    def counts(self):
+        return list(
+            Recipe.objects.filter(pk__in=[r.pk for r in self.recipes])
+            .order_by("pk")
+            .values_list("favorites_count", "carts_count")
+        )
+
+    def totals(self, user):
+        return list(user.cart_totals.values_list("name", "amount"))
+
+    def test_unmarking_recounts_recipe(self):
+        self.mark(self.author, self.recipes[:1])
+        self.client.force_authenticate(self.author)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for action in ("favorite", "shopping_cart"):
+                self.client.delete(
+                    f"/api/recipes/{self.recipes[0].pk}/{action}/"
+                )
+
+        self.assertEqual(self.counts()[0], (0, 0))
+        self.assertEqual(self.totals(self.author), [])
+
+    def test_user_deletion_decrements_counters(self):
+        reader = self.create_user("reader")
+        self.mark(reader, self.recipes[:3])
+        self.assertEqual(self.counts()[:4], [(1, 1)] * 3 + [(0, 0)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reader.delete()
+
+        self.assertEqual(self.counts(), [(0, 0)] * len(self.recipes))
+
+    def test_user_deletion_does_not_load_marks(self):
+        few, many = self.create_user("few"), self.create_user("many")
+        self.mark(few, self.recipes[:1])
+        self.mark(many, self.recipes)
+
+        queries = []
+        for user in (few, many):
+            with CaptureQueriesContext(connection) as context:
+                user.delete()
+            queries.append(len(context))
+
+        self.assertEqual(queries[0], queries[1])
+
+    def test_recipe_deletion_rebuilds_cart_totals(self):
+        buyer = self.create_user("buyer")
+        self.mark(buyer, self.recipes[:2])
+
+        recipe = self.recipes[0]
+        # Keeps the media cleanup thread away from the test database.
+        recipe.image = ""
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.delete()
+
+        self.assertEqual(self.totals(buyer), [("Соль", 5)])
+
+    def test_ingredient_deletion_rebuilds_cart_totals(self):
+        sugar = Ingredient.objects.create(name="Сахар", measurement_unit="г")
+        recipe = self.create_recipe(
+            self.author, ingredients=((self.salt, 5), (sugar, 10))
+        )
+        buyer = self.create_user("buyer")
+        self.mark(buyer, (recipe,))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            sugar.delete()
+
+        self.assertEqual(self.totals(buyer), [("Соль", 5)])
+
+    def test_deleted_ingredient_rows_invalidate_recipe(self):
+        recipe = self.recipes[0]
+        buyer = self.create_user("buyer")
+        self.mark(buyer, (recipe,))
+        url = f"/api/recipes/{recipe.pk}/"
+        self.assertEqual(len(self.client.get(url).json()["ingredients"]), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.ingredientinrecipe_set.all().delete()
+
+        self.assertEqual(self.client.get(url).json()["ingredients"], [])
+        self.assertEqual(self.totals(buyer), [])
+
+
+class HealthTests(FoodgramTestCase):
+    def test_status_is_public(self):
+        response = self.client.get("/api/health/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"databases": {"default": "ok"}})
+
+    def test_pool_metrics_are_for_staff_only(self):
+        user = self.create_user("user")
+        self.client.force_authenticate(user)
+        self.assertNotIn("pools", self.client.get("/api/health/").json())
+
+        user.is_staff = True
+        self.assertIn("pools", self.client.get("/api/health/").json())
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+class ConnectionPoolTests(SimpleTestCase):
+    def connect(self):
+        return psycopg2.connect(**connection.get_connection_params())
+
+    def get_pool(self, **options):
+        pool = ConnectionPool(**options)
+        self.addCleanup(self.close, pool)
+        return pool
+
+    @staticmethod
+    def close(pool):
+        for idle, _, _ in pool._idle:
+            idle.close()
+        for in_use in pool._in_use:
+            in_use.close()
+
+    def test_returned_connection_is_reused(self):
+        pool = self.get_pool(max_size=1)
+        first = pool.getconn(self.connect)
+        pool.putconn(first)
+
+        self.assertIs(pool.getconn(self.connect), first)
+        self.assertEqual(pool.stats()["checkouts"], 2)
+        self.assertEqual(pool.stats()["opened"], 1)
+
+    def test_open_transaction_is_rolled_back(self):
+        pool = self.get_pool(max_size=1)
+        first = pool.getconn(self.connect)
+        first.cursor().execute("SELECT 1")
+        pool.putconn(first)
+
+        reused = pool.getconn(self.connect)
+        self.assertEqual(
+            reused.info.transaction_status,
+            extensions.TRANSACTION_STATUS_IDLE,
+        )
+
+    def test_full_pool_times_out(self):
+        pool = self.get_pool(max_size=1, timeout=0.01)
+        pool.getconn(self.connect)
+
+        with self.assertRaises(PoolTimeout):
+            pool.getconn(self.connect)
+        self.assertEqual(pool.stats()["waits"], 1)
+        self.assertEqual(pool.stats()["timeouts"], 1)
+
+    def test_broken_connection_is_replaced(self):
+        pool = self.get_pool(max_size=1)
+        first = pool.getconn(self.connect)
+        pool.putconn(first)
+
+        second = pool.getconn(self.connect, check=lambda conn: False)
+        self.assertIsNot(second, first)
+        self.assertTrue(first.closed)
+        self.assertEqual(pool.stats()["size"], 1)
+
+    def test_foreign_connection_keeps_the_slots(self):
+        pool = self.get_pool(max_size=1, timeout=0.01)
+        first = pool.getconn(self.connect)
+        pool.putconn(first)
+        # Returned twice, and one the pool never handed out.
+        pool.putconn(first)
+        foreign = self.connect()
+        pool.putconn(foreign)
+
+        self.assertTrue(foreign.closed)
+        self.assertFalse(first.closed)
+        self.assertEqual(pool.stats()["size"], 1)
+        self.assertEqual(pool.stats()["closed"], 0)
+        self.assertIs(pool.getconn(self.connect), first)
+        with self.assertRaises(PoolTimeout):
+            pool.getconn(self.connect)
+
+    def test_unbounded_pool_keeps_no_connections(self):
+        pool = self.get_pool(max_size=0)
+        first = pool.getconn(self.connect)
+        pool.putconn(first)
+
+        self.assertTrue(first.closed)
+        self.assertEqual(pool.stats()["size"], 0)
+        self.assertEqual(pool.stats()["closed"], 1)
+
+
+class AsyncViewTests(SimpleTestCase):
+    databases = {"default"}
+
+    def test_view_runs_in_pool_thread(self):
+        threads = []
+
+        def content():
+            threads.append(threading.get_ident())
+            yield b"content"
+
+        def view(request):
+            threads.append(threading.get_ident())
+            return StreamingHttpResponse(content())
+
+        wrapped = async_view(view)
+        self.assertTrue(asyncio.iscoroutinefunction(wrapped))
+        response = async_to_sync(wrapped)(RequestFactory().get("/"))
+
+        # The streamed content is read only when it is sent.
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(b"".join(response.streaming_content), b"content")
+
+    def test_response_is_streamed_under_asgi(self):
+        events = []
+
+        def content():
+            for part in (b"first", b"second"):
+                # Fails in the event loop.
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                events.append(f"read {part.decode()}")
+                yield part
+
+        def view(request):
+            return StreamingHttpResponse(content())
+
+        class URLConf:
+            urlpatterns = [path("stream/", async_view(view))]
+
+        async def receive():
+            return {"type": "http.request"}
+
+        async def send(message):
+            events.append(message.get("body", message["type"]))
+
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/stream/",
+            "query_string": b"",
+            "headers": [(b"host", b"testserver")],
+        }
+        with override_settings(ROOT_URLCONF=URLConf):
+            async_to_sync(ASGIHandler())(scope, receive, send)
+
+        self.assertEqual(
+            events,
+            [
+                "http.response.start",
+                "read first",
+                b"first",
+                "read second",
+                b"second",
+                "http.response.body",
+            ],
+        )
+
+    def test_streams_are_read_concurrently(self):
+        # Each stream waits for the other one to be read at the same time.
+        barrier = threading.Barrier(2, timeout=5)
+        threads = []
+
+        def content():
+            threads.append(threading.get_ident())
+            barrier.wait()
+            yield b"content"
+
+        def view(request):
+            return StreamingHttpResponse(content())
+
+        class URLConf:
+            urlpatterns = [path("stream/", async_view(view))]
+
+        async def receive():
+            return {"type": "http.request"}
+
+        async def send(message):
+            pass
+
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/stream/",
+            "query_string": b"",
+            "headers": [(b"host", b"testserver")],
+        }
+
+        async def serve_both():
+            handler = ASGIHandler()
+            await asyncio.gather(
+                handler(dict(scope), receive, send),
+                handler(dict(scope), receive, send),
+            )
+
+        with override_settings(ROOT_URLCONF=URLConf):
+            async_to_sync(serve_both)()
+
+        self.assertFalse(barrier.broken)
+        self.assertEqual(len(set(threads)), 2)
+
+    def test_queries_of_async_view_are_counted(self):
+        def view(request):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            # The pool thread outlives the test.
+            connection.close()
+            return HttpResponse()
+
+        middleware = QueryInstrumentationMiddleware(async_view(view))
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = async_to_sync(middleware)(RequestFactory().get("/"))
+
+        self.assertEqual(response["X-DB-Queries"], "1")
+
+
+class CursorPaginationTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+        recipes = [
+            cls.create_recipe(cls.author, f"Рецепт {i}") for i in range(5)
+        ]
+        # Equal dates are told apart by the id.
+        Recipe.objects.filter(pk__in=[r.pk for r in recipes[1:4]]).update(
+            pub_date=recipes[0].pub_date
+        )
+        cls.expected = list(
+            Recipe.objects.order_by("-pub_date", "-id").values_list(
+                "pk", flat=True
+            )
+        )
+
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def walk(self, url, direction):
+        pages = []
+        while url:
+            page = self.get(url)
+            pages.append([recipe["id"] for recipe in page["results"]])
+            url = page[direction]
+        return pages
+
+    def test_pages_cover_every_recipe_once(self):
+        first = self.get("/api/recipes/", cursor="", limit=2)
+        self.assertEqual(first["count"], 5)
+        self.assertIsNone(first["previous"])
+
+        pages = self.walk(first["next"], "next")
+
+        self.assertEqual(
+            [recipe["id"] for recipe in first["results"]]
+            + [pk for page in pages for pk in page],
+            self.expected,
+        )
+        self.assertEqual([len(page) for page in pages], [2, 1])
+
+    def test_previous_links_return_the_same_pages(self):
+        url = self.get("/api/recipes/", cursor="", limit=2)["next"]
+        last = self.get(url)
+        last = self.get(last["next"])
+        self.assertIsNone(last["next"])
+
+        pages = self.walk(last["previous"], "previous")
+
+        self.assertEqual(pages, [self.expected[2:4], self.expected[:2]])
+
+    def test_page_size_is_capped(self):
+        with mock.patch.object(MyPageNumberPagination, "max_page_size", 3):
+            page = self.get("/api/recipes/", cursor="", limit=100000)
+
+        self.assertEqual(len(page["results"]), 3)
+
+    def test_invalid_cursor_is_not_found(self):
+        for cursor in ("abc", "eyJwIjpbMV19"):
+            with self.subTest(cursor=cursor):
+                response = self.client.get("/api/recipes/", {"cursor": cursor})
+                self.assertEqual(response.status_code, 404)
+
+    def test_page_numbers_still_work(self):
+        page = self.get("/api/recipes/", page=2, limit=2)
+
+        self.assertEqual(page["count"], 5)
+        self.assertEqual(
+            [recipe["id"] for recipe in page["results"]], self.expected[2:4]
+        )
+
+    def test_count_of_marked_recipes_is_current(self):
+        self.client.force_authenticate(self.author)
+        first, *others = self.expected
+        RecipeInFavorite.objects.bulk_create(
+            RecipeInFavorite(user=self.author, recipe_id=pk) for pk in others
+        )
+        page = self.get("/api/recipes/", is_favorited=1, limit=4)
+        self.assertEqual(page["count"], 4)
+        self.assertIsNone(page["next"])
+
+        url = f"/api/recipes/{first}/favorite/"
+        self.assertEqual(self.client.post(url).status_code, 201)
+
+        for params in ({}, {"cursor": ""}):
+            with self.subTest(**params):
+                page = self.get(
+                    "/api/recipes/", is_favorited=1, limit=4, **params
+                )
+                self.assertEqual(page["count"], 5)
+                self.assertIsNotNone(page["next"])
+        page = self.get("/api/recipes/", is_favorited=1, limit=4, page=2)
+        self.assertEqual(
+            [recipe["id"] for recipe in page["results"]], self.expected[4:]
+        )
+
+
+class BatchMarkTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+        cls.reader = cls.create_user("reader")
+        salt = Ingredient.objects.create(name="Соль", measurement_unit="г")
+        cls.recipes = [
+            cls.create_recipe(cls.author, f"Рецепт {i}", ((salt, 5),))
+            for i in range(5)
+        ]
+        cls.ids = [recipe.pk for recipe in cls.recipes]
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.reader)
+
+    def batch(self, action, **data):
+        response = self.client.post(
+            f"/api/recipes/{action}/batch/", data, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        return [result["status"] for result in response.json()["results"]]
+
+    def carts_counts(self):
+        return list(
+            Recipe.objects.filter(pk__in=self.ids)
+            .order_by("pk")
+            .values_list("carts_count", flat=True)
+        )
+
+    def test_batch_is_idempotent(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.batch("shopping_cart", add=self.ids[:2])
+            second = self.batch("shopping_cart", add=self.ids[:3])
+
+        self.assertEqual(first, ["added"] * 2)
+        self.assertEqual(second, ["already_added"] * 2 + ["added"])
+        self.assertEqual(self.carts_counts(), [1, 1, 1, 0, 0])
+        self.assertEqual(
+            list(self.reader.cart_totals.values_list("name", "amount")),
+            [("Соль", 15)],
+        )
+
+    def test_concurrently_added_mark_is_counted_once(self):
+        insert_marks = views._insert_marks
+        concurrent = []
+
+        def insert_after_another_request(*args):
+            if not concurrent:
+                concurrent.append(None)
+                concurrent[0] = self.batch("shopping_cart", add=self.ids[:1])
+            return insert_marks(*args)
+
+        with mock.patch.object(
+            views, "_insert_marks", side_effect=insert_after_another_request
+        ):
+            statuses = self.batch("shopping_cart", add=self.ids[:2])
+
+        self.assertEqual(concurrent, [["added"]])
+        self.assertEqual(statuses, ["already_added", "added"])
+        self.assertEqual(self.carts_counts(), [1, 1, 0, 0, 0])
+        self.assertEqual(
+            list(self.reader.cart_totals.values_list("name", "amount")),
+            [("Соль", 10)],
+        )
+
+    def test_removal_is_idempotent(self):
+        self.batch("favorite", add=self.ids[:2])
+
+        first = self.batch("favorite", remove=self.ids[:1])
+        second = self.batch("favorite", remove=self.ids[:1])
+
+        self.assertEqual((first, second), (["removed"], ["not_added"]))
+        self.assertEqual(
+            list(
+                self.reader.recipeinfavorite_set.values_list(
+                    "recipe_id", flat=True
+                )
+            ),
+            self.ids[1:2],
+        )
+
+    def test_removal_recounts_and_updates_totals(self):
+        RecipeInCart.objects.bulk_create(
+            RecipeInCart(user=self.reader, recipe_id=pk) for pk in self.ids[:3]
+        )
+        counters.reconcile(counters.RECIPE_CARTS)
+        cart_totals.rebuild([self.reader.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            removed = self.batch("shopping_cart", remove=self.ids[:2])
+
+        self.assertEqual(removed, ["removed"] * 2)
+        self.assertEqual(self.carts_counts(), [0, 0, 1, 0, 0])
+        self.assertEqual(
+            list(self.reader.cart_totals.values_list("name", "amount")),
+            [("Соль", 5)],
+        )
+
+    def test_missing_recipe_is_reported(self):
+        missing = max(self.ids) + 1
+
+        self.assertEqual(
+            self.batch("favorite", add=[self.ids[0], missing]),
+            ["added", "not_found"],
+        )
+
+    def test_invalid_batches_are_rejected(self):
+        for data in ({}, {"add": [self.ids[0]], "remove": [self.ids[0]]}):
+            with self.subTest(data=data):
+                response = self.client.post(
+                    "/api/recipes/favorite/batch/", data, format="json"
+                )
+                self.assertEqual(response.status_code, 400)
+
+    def test_queries_do_not_depend_on_batch_size(self):
+        queries = []
+        for action in ("add", "remove"):
+            for ids in (self.ids[:1], self.ids[1:]):
+                with CaptureQueriesContext(connection) as context:
+                    self.batch("favorite", **{action: ids})
+                queries.append(len(context))
+
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(queries[2], queries[3])
+
+
+class CartTotalTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+        cls.buyer = cls.create_user("buyer")
+        cls.ingredients = ingredients = {
+            (name, unit): Ingredient.objects.create(
+                name=name, measurement_unit=unit
+            )
+            for name, unit in (
+                ("Соль", "г"),
+                ("Соль", "кг"),
+                ("Вода", "мл"),
+                ("Вода", "Л"),
+                ("Перец", "щепотка"),
+            )
+        }
+        cls.first = cls.create_recipe(
+            cls.author,
+            "Первый",
+            (
+                (ingredients["Соль", "г"], 5),
+                (ingredients["Вода", "мл"], 200),
+                (ingredients["Перец", "щепотка"], 1),
+            ),
+        )
+        cls.second = cls.create_recipe(
+            cls.author,
+            "Второй",
+            (
+                (ingredients["Соль", "кг"], 1),
+                (ingredients["Вода", "Л"], 1),
+                (ingredients["Перец", "щепотка"], 2),
+            ),
+        )
+
+    def test_units_are_normalized(self):
+        self.assertEqual(cart_totals.normalize(" КГ ", 2), ("г", 2000))
+        self.assertEqual(cart_totals.normalize("шт", 3), ("шт.", 3))
+        self.assertEqual(cart_totals.normalize("щепотка", 1), ("щепотка", 1))
+
+    def test_compatible_units_are_added_up(self):
+        self.client.force_authenticate(self.author)
+        # Added in the transaction of the cart row, not after commit.
+        for recipe in (self.first, self.second):
+            url = f"/api/recipes/{recipe.pk}/shopping_cart/"
+            self.assertEqual(self.client.post(url).status_code, 201)
+
+        response = self.client.get("/api/recipes/shopping_cart/summary/")
+
+        self.assertEqual(response.json()["recipes_count"], 2)
+        self.assertEqual(
+            [
+                (row["name"], row["amount"], row["measurement_unit"])
+                for row in response.json()["ingredients"]
+            ],
+            [
+                ("Вода", 1200, "мл"),
+                ("Перец", 3, "щепотка"),
+                ("Соль", 1005, "г"),
+            ],
+        )
+
+    def totals(self):
+        return dict(
+            (name, amount)
+            for name, amount in self.buyer.cart_totals.values_list(
+                "name", "amount"
+            )
+        )
+
+    def cart(self, *recipes):
+        RecipeInCart.objects.bulk_create(
+            RecipeInCart(user=self.buyer, recipe=recipe) for recipe in recipes
+        )
+        cart_totals.rebuild([self.buyer.pk])
+
+    def test_removed_recipe_is_subtracted(self):
+        self.cart(self.first, self.second)
+
+        RecipeInCart.objects.filter(recipe=self.second).delete()
+
+        self.assertEqual(
+            self.totals(), {"Вода": 200, "Перец": 1, "Соль": 5}
+        )
+
+    def test_totals_are_changed_not_recomputed(self):
+        self.cart(self.first)
+        # Drift a full rebuild would repair.
+        self.buyer.cart_totals.filter(name="Перец").update(amount=10)
+
+        RecipeInCart.objects.create(user=self.buyer, recipe=self.second)
+
+        self.assertEqual(
+            self.totals(), {"Вода": 1200, "Перец": 12, "Соль": 1005}
+        )
+        self.assertEqual(cart_totals.rebuild_all(), (1, 3))
+        self.assertEqual(self.totals()["Перец"], 3)
+
+    def test_changed_ingredient_rows_are_applied(self):
+        self.cart(self.first, self.second)
+        salt = self.first.ingredientinrecipe_set.get(
+            ingredient=self.ingredients["Соль", "г"]
+        )
+
+        salt.amount = 50
+        salt.save()
+        self.assertEqual(self.totals()["Соль"], 1050)
+
+        salt.ingredient = self.ingredients["Соль", "кг"]
+        salt.save()
+        self.assertEqual(self.totals()["Соль"], 51000)
+
+        IngredientInRecipe.objects.filter(
+            recipe=self.second, ingredient__name="Перец"
+        ).delete()
+        self.assertEqual(self.totals()["Перец"], 1)
+
+    def test_emptied_totals_are_deleted(self):
+        self.cart(self.first)
+
+        IngredientInRecipe.objects.filter(
+            recipe=self.first, ingredient__name="Перец"
+        ).delete()
+
+        self.assertEqual(self.totals(), {"Вода": 200, "Соль": 5})
+
+    def test_renamed_ingredient_is_moved(self):
+        self.cart(self.first, self.second)
+
+        pepper = self.ingredients["Перец", "щепотка"]
+        pepper.name = "Перец чёрный"
+        pepper.save()
+        water = self.ingredients["Вода", "Л"]
+        water.measurement_unit = "стакан"
+        water.save()
+
+        self.assertEqual(
+            sorted(
+                self.buyer.cart_totals.values_list(
+                    "name", "measurement_unit", "amount"
+                )
+            ),
+            [
+                ("Вода", "мл", 200),
+                ("Вода", "стакан", 1),
+                ("Перец чёрный", "щепотка", 3),
+                ("Соль", "г", 1005),
+            ],
+        )
+
+    def test_deleted_ingredient_is_subtracted(self):
+        self.cart(self.first, self.second)
+
+        self.ingredients["Соль", "кг"].delete()
+
+        self.assertEqual(self.totals()["Соль"], 5)
+
+    def test_queries_do_not_depend_on_carts(self):
+        buyers = [self.create_user(f"buyer{i}") for i in range(5)]
+        queries = []
+        for users in (buyers[:1], buyers):
+            recipe = self.create_recipe(
+                self.author,
+                ingredients=[
+                    (ingredient, 2) for ingredient in self.ingredients.values()
+                ],
+            )
+            RecipeInCart.objects.bulk_create(
+                RecipeInCart(user=user, recipe=recipe) for user in users
+            )
+            with CaptureQueriesContext(connection) as context:
+                cart_totals.change_ingredients(
+                    (recipe.pk, ingredient.pk, 1)
+                    for ingredient in self.ingredients.values()
+                )
+            queries.append(len(context))
+
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(
+            dict(buyers[-1].cart_totals.values_list("name", "amount")),
+            {"Вода": 1001, "Перец": 1, "Соль": 1001},
+        )
+
+
+class BulkRecipeTests(FoodgramTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = cls.create_user("author")
+        cls.admin = User.objects.create_superuser(
+            username="admin", email="admin@example.com", password="password"
+        )
+        cls.tag = Tag.objects.create(
+            name="Завтрак", color="#E26C2D", slug="breakfast"
+        )
+        cls.salt = Ingredient.objects.create(name="Соль", measurement_unit="г")
+
+    def line(self, name, **fields):
+        record = {
+            "name": name,
+            "author": {"email": self.author.email},
+            "tags": [self.tag.slug],
+            "ingredients": [
+                {"name": "Соль", "measurement_unit": "г", "amount": 5}
+            ],
+            "image": IMAGE,
+            "text": "Описание",
+            "cooking_time": 10,
+            **fields,
+        }
+        return json.dumps(record, ensure_ascii=False)
+
+    def test_invalid_lines_are_reported_by_number(self):
+        lines = [
+            self.line("Первый"),
+            "{not json",
+            json.dumps(["Второй"]),
+            "",
+            self.line("Третий", tags=["dinner"]),
+            self.line("Четвёртый", author={"email": "nobody@example.com"}),
+            self.line("Пятый"),
+        ]
+
+        result = bulk.import_recipes(lines, chunk_size=2)
+
+        self.assertEqual((result.created, result.failed), (2, 4))
+        self.assertEqual(
+            [error["line"] for error in result.errors], [2, 3, 5, 6]
+        )
+        self.assertIn("Unknown tag", result.errors[2]["error"])
+        self.assertIn("Unknown author", result.errors[3]["error"])
+        self.assertCountEqual(
+            Recipe.objects.values_list("name", flat=True), ["Первый", "Пятый"]
+        )
+
+    def test_unknown_authors_go_to_the_default_author(self):
+        line = self.line("Рецепт", author={"email": "nobody@example.com"})
+
+        result = bulk.import_recipes([line], default_author=self.admin)
+
+        self.assertEqual((result.created, result.failed), (1, 0))
+        self.assertEqual(Recipe.objects.get().author, self.admin)
+
+    def test_export_is_imported_back(self):
+        recipe = self.create_recipe(
+            self.author, "Рецепт", ((self.salt, 5),), (self.tag,)
+        )
+        exported = "".join(bulk.to_ndjson(bulk.export_recipes()))
+
+        result = bulk.import_recipes(exported.splitlines())
+
+        self.assertEqual((result.created, result.failed), (1, 0))
+        copy = Recipe.objects.exclude(pk=recipe.pk).get()
+        self.assertEqual(
+            (copy.name, copy.author, copy.image.name, copy.cooking_time),
+            (recipe.name, recipe.author, recipe.image.name, 10),
+        )
+        self.assertEqual(list(copy.tags.all()), [self.tag])
+        self.assertEqual(
+            list(
+                copy.ingredientinrecipe_set.values_list("ingredient", "amount")
+            ),
+            [(self.salt.pk, 5)],
+        )
+
+    def test_import_endpoint(self):
+        url = "/api/recipes/import/"
+        body = "\n".join((self.line("Рецепт"), "{not json"))
+
+        self.client.force_authenticate(self.author)
+        response = self.client.post(
+            url, body, content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_authenticate(self.admin)
+        response = self.client.post(
+            url, body, content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["created"], 1)
+        self.assertEqual(response.json()["errors"][0]["line"], 2)
+
+        response = self.client.post(
+            url, "{not json", content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["failed"], 1)
@@ -1,12 +1,17 @@
+from django.conf import settings
 from django.urls import include, path
 from rest_framework import routers
 
+from foodgram.async_views import async_patterns
 from recipes.views import IngredientViewSet, RecipeViewSet, TagViewSet
 
 router = routers.DefaultRouter()
 router.register("recipes", RecipeViewSet)
 router.register("tags", TagViewSet)
 router.register("ingredients", IngredientViewSet)
+routes = router.urls
+if settings.ASYNC_VIEWS:
+    routes = async_patterns(routes)
 urlpatterns = [
-    path("", include(router.urls)),
+    path("", include(routes)),
 ]
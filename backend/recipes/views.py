@@ -1,36 +1,146 @@
-from datetime import datetime
+import hashlib
+from pathlib import Path
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import F, Sum
-from django.http import HttpResponse
+from django.db import connection, transaction
+from django.db.models import (BooleanField, F, Prefetch, Value,
+                              prefetch_related_objects)
+from django.http import StreamingHttpResponse
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers, quote_etag)
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
-from rest_framework.pagination import PageNumberPagination
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import NotFound
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
+from recipes import bulk, cart_totals, counters
+from recipes.cache import (GLOBAL_VERSION_KEY, RECIPES_VERSION_KEY,
+                           author_version_key, bump_versions_on_commit,
+                           get_versions, recipe_version_key, user_version_key)
 from recipes.filters import IngredientFilter, RecipeFilter
-from recipes.models import (Follow, Ingredient, IngredientInRecipe, Recipe,
-                            RecipeInCart, RecipeInFavorite, Tag)
+from recipes.ingredient_index import ingredient_index
+from recipes.models import (Follow, Ingredient, Recipe, RecipeInCart,
+                            RecipeInFavorite, Tag)
+from recipes.pagination import MyPageNumberPagination, SubscriptionPagination
+from recipes.parsers import MultiPartJSONParser, NDJSONParser
 from recipes.permissions import IsAuthorOrReadOnly
-from recipes.serializers import (IngredientSerializer, RecipeSerializer,
-                                 TagSerializer, UserSerializer)
+from recipes.reference import reference_data
+from recipes.renderers import (CSVShoppingListRenderer,
+                               PDFShoppingListRenderer, ShoppingListRenderer,
+                               TextShoppingListRenderer)
+from recipes.serializers import (CartTotalSerializer, IngredientSerializer,
+                                 RecipeBatchSerializer, RecipeSerializer,
+                                 SubscriptionSerializer, TagSerializer,
+                                 UserSerializer, get_recipes_limit)
+
+
+class ConditionalGetMixin:
+    """Answers If-None-Match from the cache version stamps.
+
+    The ETag is derived from the stamps returned by ``get_version_keys``
+    and the request itself, so a revalidation is checked before the
+    queryset is evaluated and ends in 304 Not Modified without serializing
+    anything.
+    """
+
+    personalized = False
+    # Lifetime of the responses in client caches, in seconds.
+    max_age = None
+
+    def get_version_keys(self):
+        return (GLOBAL_VERSION_KEY,)
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional(super().retrieve, request, *args, **kwargs)
+
+    def _conditional(self, view, request, *args, **kwargs):
+        keys = self.get_version_keys()
+        if keys is None:
+            return view(request, *args, **kwargs)
+
+        etag = self._etag(request, keys)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = view(request, *args, **kwargs)
+        if response.status_code in (
+            status.HTTP_200_OK,
+            status.HTTP_304_NOT_MODIFIED,
+        ):
+            response["ETag"] = etag
+            if self.max_age is not None:
+                patch_cache_control(
+                    response, public=True, max_age=self.max_age
+                )
+        if self.personalized:
+            patch_vary_headers(response, ("Authorization",))
 
+        return response
+
+    def _etag(self, request, keys):
+        versions = get_versions(keys)
+        parts = [
+            request.get_full_path(),
+            request.accepted_renderer.format,
+            *(f"{key}={versions[key]}" for key in sorted(versions)),
+        ]
+        if self.personalized:
+            parts.append(str(request.user.pk))
 
-class MyPageNumberPagination(PageNumberPagination):
-    page_size_query_param = "limit"
+        return quote_etag(hashlib.md5("|".join(parts).encode()).hexdigest())
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
+    personalized = True
+    parser_classes = (JSONParser, MultiPartJSONParser)
     pagination_class = MyPageNumberPagination
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
     serializer_class = RecipeSerializer
     permission_classes = (IsAuthorOrReadOnly,)
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action not in ("list", "retrieve"):
+            return queryset
+
+        # Related rows are prefetched by the serializer for the recipes
+        # missing from the fragment cache only.
+        return queryset.with_user_flags(self.request.user)
+
+    def get_version_keys(self):
+        keys = [GLOBAL_VERSION_KEY]
+        if self.request.user.is_authenticated:
+            keys.append(user_version_key(self.request.user.pk))
+
+        if self.action == "list":
+            return (*keys, RECIPES_VERSION_KEY)
+
+        try:
+            author_id = (
+                Recipe.objects.filter(pk=self.kwargs["pk"])
+                .values_list("author_id", flat=True)
+                .first()
+            )
+        except (ValueError, TypeError):
+            # Not a valid pk, get_object() answers 404.
+            author_id = None
+        if author_id is None:
+            return None
+
+        return (
+            *keys,
+            recipe_version_key(self.kwargs["pk"]),
+            author_version_key(author_id),
+        )
+
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
@@ -60,7 +170,7 @@ class RecipeViewSet(viewsets.ModelViewSet):
             data = {"message": "No active favorite found."}
             return Response(data, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response({}, status=status.HTTP_204_NO_CONTENT)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=True, methods=("POST",))
     def shopping_cart(self, request, **kwargs):
@@ -88,42 +198,183 @@ class RecipeViewSet(viewsets.ModelViewSet):
             data = {"message": "No recipe found."}
             return Response(data, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response({}, status=status.HTTP_204_NO_CONTENT)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(
+        detail=False,
+        methods=("POST",),
+        url_path="favorite/batch",
+        permission_classes=(IsAuthenticated,),
+    )
+    def favorite_batch(self, request):
+        return self._change_marks(
+            request, RecipeInFavorite, counters.RECIPE_FAVORITES
+        )
 
-    @action(detail=False)
-    def download_shopping_cart(self, request):
-        ingredients = (
-            IngredientInRecipe.objects.filter(
-                recipe__in=(request.user.purchases.values("recipe"))
-            )
-            .values(
-                name=F("ingredient__name"),
-                measurement_unit=F("ingredient__measurement_unit"),
+    @action(
+        detail=False,
+        methods=("POST",),
+        url_path="shopping_cart/batch",
+        permission_classes=(IsAuthenticated,),
+    )
+    def shopping_cart_batch(self, request):
+        return self._change_marks(request, RecipeInCart, counters.RECIPE_CARTS)
+
+    def _change_marks(self, request, model, counter):
+        """Add and remove many recipes of the user's ``model`` at once.
+
+        Every recipe gets its own status. The whole batch takes a fixed
+        number of queries: the recipes are read once, the new marks are
+        inserted by one INSERT and ``counter`` of their recipes recounted by
+        one UPDATE. The removed ones are locked and deleted together, their
+        rows_deleted receivers recount and invalidate what depends on them.
+        Only the marks this request inserted or deleted are reported and
+        counted, whatever concurrent requests do.
+        """
+        serializer = RecipeBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        add = serializer.validated_data["add"]
+        remove = serializer.validated_data["remove"]
+        user = request.user
+
+        found = set(
+            Recipe.objects.filter(pk__in=add + remove).values_list(
+                "pk", flat=True
             )
-            .annotate(amount=Sum("amount"))
         )
 
-        shopping_list = []
-        for i, ingredient in enumerate(ingredients):
-            shopping_list.append(
-                f"{i + 1}. {ingredient['name']} - {ingredient['amount']} "
-                f"{ingredient['measurement_unit']}\n"
+        with transaction.atomic():
+            added = _insert_marks(
+                model, user, [pk for pk in add if pk in found]
             )
-        shopping_list.append(f"\nfoodgram, {datetime.now().year}")
+            # Locked, a concurrent request can't delete them as well.
+            removed = set(
+                model.objects.select_for_update()
+                .filter(user=user, recipe_id__in=remove)
+                .values_list("recipe_id", flat=True)
+            )
+            if removed:
+                model.objects.filter(user=user, recipe_id__in=removed).delete()
+            if added:
+                # The INSERT sends no signals.
+                counters.recount(counter, added)
+                bump_versions_on_commit(user_version_key(user.pk))
+                if model is RecipeInCart:
+                    cart_totals.change_carts(
+                        ((user.pk, pk) for pk in added), 1
+                    )
+
+        results = [
+            _batch_result(pk, "add", found, added, "added", "already_added")
+            for pk in add
+        ] + [
+            _batch_result(pk, "remove", found, removed, "removed", "not_added")
+            for pk in remove
+        ]
+
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+    @action(
+        detail=False,
+        permission_classes=(IsAuthenticated,),
+        renderer_classes=(
+            TextShoppingListRenderer,
+            CSVShoppingListRenderer,
+            PDFShoppingListRenderer,
+            ShoppingListRenderer,
+        ),
+    )
+    def download_shopping_cart(self, request):
+        # Precomputed by recipes.cart_totals.
+        ingredients = request.user.cart_totals.order_by(
+            "name", "measurement_unit"
+        ).values("name", "measurement_unit", "amount")
+
+        renderer = request.accepted_renderer
+        content_type = renderer.media_type
+        if renderer.charset:
+            content_type = f"{content_type}; charset={renderer.charset}"
+
+        response = StreamingHttpResponse(
+            renderer.stream(ingredients.iterator(chunk_size=500)),
+            content_type=content_type,
+        )
+        file_name = Path(settings.SHOPPING_LIST_FILE_NAME).with_suffix(
+            f".{renderer.format}"
+        )
+        response["Content-Disposition"] = f'attachment; filename="{file_name}"'
+
+        return response
+
+    @action(
+        detail=False,
+        url_path="shopping_cart/summary",
+        permission_classes=(IsAuthenticated,),
+    )
+    def shopping_cart_summary(self, request):
+        totals = request.user.cart_totals.order_by("name", "measurement_unit")
+
+        return Response(
+            {
+                "recipes_count": request.user.purchases.count(),
+                "ingredients": CartTotalSerializer(totals, many=True).data,
+            }
+        )
 
-        response = HttpResponse(shopping_list)
-        type = "Content-Type"
-        response[type] = "text/plain"
+    @action(detail=False, permission_classes=(IsAuthenticated,))
+    def export(self, request):
+        """Stream the (filtered) recipes as NDJSON, see recipes.bulk."""
+        queryset = self.filter_queryset(self.get_queryset())
+        records = bulk.export_recipes(
+            queryset, build_uri=request.build_absolute_uri
+        )
+
+        response = StreamingHttpResponse(
+            bulk.to_ndjson(records), content_type=NDJSONParser.media_type
+        )
         response[
             "Content-Disposition"
-        ] = f'attachment; filename="{settings.SHOPPING_LIST_FILE_NAME}"'
+        ] = 'attachment; filename="recipes.ndjson"'
 
         return response
 
+    @action(
+        detail=False,
+        methods=("POST",),
+        url_path="import",
+        permission_classes=(IsAdminUser,),
+        parser_classes=(NDJSONParser,),
+    )
+    def import_recipes(self, request):
+        # Recipes of authors missing from this catalog go to the importer.
+        result = bulk.import_recipes(request.data, default_author=request.user)
+
+        return Response(
+            result._asdict(),
+            status=status.HTTP_201_CREATED
+            if result.created
+            else status.HTTP_400_BAD_REQUEST,
+        )
+
 
-class TagViewSet(viewsets.ModelViewSet):
+class TagViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
+    max_age = settings.REFERENCE_DATA_MAX_AGE
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional(self._list, request)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional(self._retrieve, request, *args, **kwargs)
+
+    def _list(self, request):
+        serializer = self.get_serializer(reference_data.tags(), many=True)
+        return Response(serializer.data)
+
+    def _retrieve(self, request, pk, **kwargs):
+        tag = _get_reference(reference_data.get_tag, pk)
+        return Response(self.get_serializer(tag).data)
 
 
 User = get_user_model()
@@ -133,18 +384,35 @@ class FollowViewSet(viewsets.GenericViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = (IsAuthenticated,)
-    pagination_class = PageNumberPagination
+    pagination_class = SubscriptionPagination
 
     @action(detail=False)
     def subscriptions(self, request):
-        queryset = User.objects.filter(following__user=request.user)
-
-        paginator = PageNumberPagination()
-        paginator.page_size = 10
-        paginator.page_size_query_param = "limit"
+        recipes_limit = get_recipes_limit(request.query_params)
+        queryset = User.objects.filter(following__user=request.user).annotate(
+            recipes_count=F("profile__recipes_count"),
+            is_subscribed=Value(True, output_field=BooleanField()),
+            subscription_id=F("following__id"),
+        )
 
+        paginator = self.paginator
         page = paginator.paginate_queryset(queryset=queryset, request=request)
-        serializer = self.get_serializer(page, many=True)
+
+        recipes = Recipe.objects.filter(author__in=page)
+        if recipes_limit is not None:
+            recipes = recipes.newest_per_author(recipes_limit)
+        prefetch_related_objects(
+            page,
+            Prefetch(
+                "recipes",
+                queryset=recipes.order_by("-pub_date", "-id"),
+                to_attr="newest_recipes",
+            ),
+        )
+
+        serializer = SubscriptionSerializer(
+            page, many=True, context=self.get_serializer_context()
+        )
 
         return paginator.get_paginated_response(serializer.data)
 
@@ -170,11 +438,83 @@ class FollowViewSet(viewsets.GenericViewSet):
             data = {"message": "No active subscription found."}
             return Response(data, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response({}, status=status.HTTP_204_NO_CONTENT)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class IngredientViewSet(viewsets.ModelViewSet):
+class IngredientViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     filter_backends = (DjangoFilterBackend,)
     filterset_class = IngredientFilter
+    max_age = settings.REFERENCE_DATA_MAX_AGE
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional(self._search, request)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional(self._retrieve, request, *args, **kwargs)
+
+    @staticmethod
+    def _search(request):
+        # Autocomplete is answered from the shared prefix index, the
+        # filterset is kept for the browsable API and the schema. Without a
+        # prefix there is nothing to complete, the catalog isn't listed.
+        name = request.query_params.get("name", "")
+        if not name.strip():
+            return Response([])
+
+        return Response(
+            ingredient_index.search(
+                name, limit=settings.INGREDIENT_SEARCH_LIMIT
+            )
+        )
+
+    def _retrieve(self, request, pk, **kwargs):
+        ingredient = _get_reference(reference_data.get_ingredient, pk)
+        return Response(self.get_serializer(ingredient).data)
+
+
+def _batch_result(pk, action, found, changed, if_changed, if_unchanged):
+    if pk not in found:
+        result = "not_found"
+    else:
+        result = if_changed if pk in changed else if_unchanged
+
+    return {"id": pk, "action": action, "status": result}
+
+
+def _insert_marks(model, user, recipe_ids):
+    """Insert the missing marks of ``user``, return their recipe ids.
+
+    The marks that exist already, also the ones a concurrent request has
+    just inserted, are skipped by ON CONFLICT.
+    """
+    recipe_ids = sorted(set(recipe_ids))
+    if not recipe_ids:
+        return set()
+
+    meta = model._meta
+    quote = connection.ops.quote_name
+    user_column = quote(meta.get_field("user").column)
+    recipe_column = quote(meta.get_field("recipe").column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {quote(meta.db_table)} "
+            f"({user_column}, {recipe_column}) VALUES "
+            + ", ".join(["(%s, %s)"] * len(recipe_ids))
+            + f" ON CONFLICT ({user_column}, {recipe_column}) DO NOTHING"
+            f" RETURNING {recipe_column}",
+            [value for pk in recipe_ids for value in (user.pk, pk)],
+        )
+        return {pk for (pk,) in cursor.fetchall()}
+
+
+def _get_reference(getter, pk):
+    try:
+        obj = getter(int(pk))
+    except ValueError:
+        obj = None
+    if obj is None:
+        raise NotFound()
+
+    return obj